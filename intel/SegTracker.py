@@ -2,11 +2,18 @@ import sys
 sys.path.append("..")
 sys.path.append("./sam")
 from sam.segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+from sam.segment_anything.utils.amg import rle_to_indices
 from aot_tracker import get_aot
+import copy
 import numpy as np
+import torch
 from tool.segmentor import Segmentor
 from tool.detector import Detector
 from tool.transfer_tools import draw_outline, draw_points
+from tool.mask_analytics import label_areas, relabel
+from tool.memory_policy import MemoryPolicy
+from tool.keyframe_scheduler import build_keyframe_scheduler
+from tool.device import set_num_threads
 import cv2
 from seg_track_anything import draw_mask
 
@@ -17,15 +24,29 @@ class SegTracker():
          Initialize SAM and AOT.
         """
         self.sam = Segmentor(sam_args)
-        self.tracker = get_aot(aot_args)
-        self.detector = Detector(self.sam.device)
+        self.device = self.sam.device
+        if self.device.type == 'cpu':
+            # intra-op threads of this worker, the node may run several replicas
+            set_num_threads(segtracker_args.get('num_threads'), segtracker_args.get('num_workers', 1))
+        # AOT follows the SAM device unless aot_args sets its own
+        self.tracker = get_aot(dict(aot_args, device=aot_args.get('device', self.device)))
+        self.detector = Detector(self.device)
         self.sam_gap = segtracker_args['sam_gap']
+        # which frames run the segment / detect stage, see tool/keyframe_scheduler.py
+        self.keyframe_args = segtracker_args.get('keyframe')
+        self.keyframe_scheduler = build_keyframe_scheduler(self.sam_gap, self.keyframe_args)
         self.min_area = segtracker_args['min_area']
         self.max_obj_num = segtracker_args['max_obj_num']
         self.min_new_obj_iou = segtracker_args['min_new_obj_iou']
+        # when to give cached memory back during a run, see tool/memory_policy.py
+        self.memory_policy = MemoryPolicy(**dict(segtracker_args.get('memory_policy', {}), device=self.device))
         self.reference_objs_list = []
         self.object_idx = 1
         self.curr_idx = 1
+        # retire an object after it is missing on this many keyframes in a row, None keeps all
+        self.retire_after = segtracker_args.get('retire_after')
+        self.missing_keyframes = {}
+        self.retired_ids = set()
         self.origin_merged_mask = None  # init by segment-everything or update
         self.first_frame_mask = None
 
@@ -34,41 +55,78 @@ class SegTracker():
         self.everything_labels = []
         print("SegTracker has been initialized")
 
-    def seg(self,frame):
+    def fork(self):
+        '''
+        A SegTracker with its own objects, tracker memory and keyframe schedule
+        that shares SAM, Grounding-DINO and the AOT weights with this one, e.g.
+        to follow another caption on the same video without loading the models again.
+        '''
+        segtracker = copy.copy(self)
+        segtracker.tracker = self.tracker.fork()
+        segtracker.keyframe_scheduler = build_keyframe_scheduler(self.sam_gap, self.keyframe_args)
+        segtracker.reference_objs_list = []
+        segtracker.object_idx = 1
+        segtracker.curr_idx = 1
+        segtracker.missing_keyframes = {}
+        segtracker.retired_ids = set()
+        segtracker.origin_merged_mask = None
+        segtracker.first_frame_mask = None
+        segtracker.everything_points = []
+        segtracker.everything_labels = []
+        return segtracker
+
+    def encode(self, frame, frame_idx=None):
+        '''
+        AOT encoder features of a frame, shared by the trackers forked from this one.
+        Arguments:
+            frame_idx: index of the frame in the video, reuses the cached features
+        Return:
+            encoded: pass as `encoded` to track / add_reference
+        '''
+        return self.tracker.encode(frame, frame_idx)
+
+    def seg(self,frame,track_mask=None):
         '''
         Arguments:
             frame: numpy array (h,w,3)
+            track_mask: optional, numpy array (h,w) of the tracked objects on
+                this frame, SAM is only prompted outside of them
         Return:
             origin_merged_mask: numpy array (h,w)
         '''
         frame = frame[:, :, ::-1]
-        anns = self.sam.everything_generator.generate(frame)
+        exclude_mask = track_mask > 0 if track_mask is not None else None
+        anns = self.sam.everything_generator.generate(frame, exclude_mask=exclude_mask)
 
         # anns is a list recording all predictions in an image
         if len(anns) == 0:
-            return
+            # e.g. every grid point fell on a tracked object
+            self.origin_merged_mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+            return self.origin_merged_mask
         # merge all predictions into one mask (h,w)
         # note that the merged mask may lost some objects due to the overlapping
-        self.origin_merged_mask = np.zeros(anns[0]['segmentation'].shape,dtype=np.uint8)
+        # with output_mode 'uncompressed_rle' the masks are painted from their runs, never densified
+        rle_output = isinstance(anns[0]['segmentation'], dict)
+        mask_shape = anns[0]['segmentation']['size'] if rle_output else anns[0]['segmentation'].shape
+        self.origin_merged_mask = np.zeros(mask_shape,dtype=np.uint8)
         idx = 1
         for ann in anns:
             if ann['area'] > self.min_area:
                 m = ann['segmentation']
-                self.origin_merged_mask[m==1] = idx
+                if rle_output:
+                    self.origin_merged_mask.T.flat[rle_to_indices(m)] = idx
+                else:
+                    self.origin_merged_mask[m==1] = idx
                 idx += 1
                 self.everything_points.append(ann["point_coords"][0])
                 self.everything_labels.append(1)
 
-        obj_ids = np.unique(self.origin_merged_mask)
-        obj_ids = obj_ids[obj_ids!=0]
-
-        self.object_idx = 1
-        for id in obj_ids:
-            if np.sum(self.origin_merged_mask==id) < self.min_area or self.object_idx > self.max_obj_num:
-                self.origin_merged_mask[self.origin_merged_mask==id] = 0
-            else:
-                self.origin_merged_mask[self.origin_merged_mask==id] = self.object_idx
-                self.object_idx += 1
+        # drop objects smaller than min_area and relabel the rest as 1..max_obj_num
+        areas = label_areas(self.origin_merged_mask)
+        obj_ids = np.flatnonzero(areas >= self.min_area)
+        obj_ids = obj_ids[obj_ids!=0][:self.max_obj_num]
+        self.origin_merged_mask = relabel(self.origin_merged_mask, obj_ids)
+        self.object_idx = len(obj_ids) + 1
 
         self.first_frame_mask = self.origin_merged_mask
         return self.origin_merged_mask
@@ -83,29 +141,102 @@ class SegTracker():
         self.origin_merged_mask = mask
         self.curr_idx = id
 
-    def add_reference(self,frame,mask,frame_step=0):
+    def add_reference(self,frame,mask,frame_step=0,encoded=None,frame_idx=None):
         '''
         Add objects in a mask for tracking.
         Arguments:
             frame: numpy array (h,w,3)
             mask: numpy array (h,w)
+            encoded: optional, output of self.encode(frame)
+            frame_idx: optional, index of the frame in the video, reuses the
+                encoder features cached when the frame was tracked
         '''
         self.reference_objs_list.append(np.unique(mask))
         self.curr_idx = self.get_obj_num()
-        self.tracker.add_reference_frame(frame,mask, self.curr_idx, frame_step)
+        self.tracker.add_reference_frame(frame,mask, self.curr_idx, frame_step, encoded=encoded, frame_idx=frame_idx)
 
-    def track(self,frame,update_memory=False):
+    def add_objects(self,frame,mask,frame_step=0,encoded=None,frame_idx=None):
+        '''
+        Add the new objects of a mask for tracking, on a frame that was just
+        tracked (track without update_memory). Unlike add_reference, only the
+        AOT sub-engines that receive new ids take the frame as a reference,
+        the other ones update their memory as on any tracked frame.
+        Arguments:
+            frame: numpy array (h,w,3)
+            mask: numpy array (h,w), tracked objects and new objects with ids
+                above the current ones, e.g. track_mask + find_new_objs(...)
+            encoded: optional, output of self.encode(frame)
+            frame_idx: optional, see add_reference
+        '''
+        self.reference_objs_list.append(np.unique(mask))
+        self.curr_idx = self.get_obj_num()
+        self.tracker.add_objects(frame, mask, self.curr_idx, frame_step, encoded=encoded, frame_idx=frame_idx)
+
+    def retire_objects(self, obj_ids):
+        '''
+        Stop tracking obj_ids, their ids are not reused. AOT sub-engines left
+        without live objects free their memory and are skipped.
+        '''
+        obj_ids = [int(obj_id) for obj_id in obj_ids if int(obj_id) not in self.retired_ids]
+        if len(obj_ids) == 0:
+            return
+        self.retired_ids.update(obj_ids)
+        for obj_id in obj_ids:
+            self.missing_keyframes.pop(obj_id, None)
+        self.tracker.retire_objects(obj_ids)
+
+    def retire_lost_objects(self, track_mask):
+        '''
+        Call on keyframes with the tracked mask, retires the objects missing
+        from it on retire_after keyframes in a row.
+        Return:
+            retired: list of the ids retired on this call
+        '''
+        if self.retire_after is None:
+            return []
+        present = label_areas(track_mask) > 0
+        retired = []
+        for obj_id in self.get_tracking_objs():
+            obj_id = int(obj_id)
+            if obj_id in self.retired_ids:
+                continue
+            if obj_id < len(present) and present[obj_id]:
+                self.missing_keyframes.pop(obj_id, None)
+                continue
+            self.missing_keyframes[obj_id] = self.missing_keyframes.get(obj_id, 0) + 1
+            if self.missing_keyframes[obj_id] >= self.retire_after:
+                retired.append(obj_id)
+        self.retire_objects(retired)
+        return retired
+
+    def track(self,frame,update_memory=False,lowres=False,encoded=None,frame_idx=None):
         '''
         Track all known objects.
         Arguments:
             frame: numpy array (h,w,3)
+            lowres: return the label map at decoder resolution, skipping the
+                upsampling to frame resolution
+            encoded: optional, output of self.encode(frame)
+            frame_idx: optional, index of the frame in the video, caches the
+                encoder features for add_reference / add_objects on the same frame
         Return:
             origin_merged_mask: numpy array (h,w)
+            scale: (y, x) factor from the returned mask to the frame, only with lowres
         '''
-        pred_mask = self.tracker.track(frame)
+        needs_entropy = self.keyframe_scheduler.needs_entropy
+        if lowres:
+            pred_mask, scale = self.tracker.track(frame, with_entropy=needs_entropy, return_lowres=True,
+                                                  encoded=encoded, frame_idx=frame_idx)
+        else:
+            pred_mask = self.tracker.track(frame, with_entropy=needs_entropy, encoded=encoded, frame_idx=frame_idx)
+        if needs_entropy:
+            self.keyframe_scheduler.observe_entropy(self.tracker.last_entropy)
         if update_memory:
             self.tracker.update_memory(pred_mask)
-        return pred_mask.squeeze(0).squeeze(0).detach().cpu().numpy().astype(np.uint8)
+        pred_mask = pred_mask.squeeze(0).squeeze(0).detach().cpu().numpy().astype(np.uint8)
+        if lowres:
+            return pred_mask, scale
+        return pred_mask
     
     def get_tracking_objs(self):
         objs = set()
@@ -130,23 +261,25 @@ class SegTracker():
             new_obj_mask: numpy array (h,w)
         '''
         new_obj_mask = (track_mask==0) * seg_mask
-        new_obj_ids = np.unique(new_obj_mask)
+        # background area and full area of every SAM object, one pass each
+        new_obj_areas = label_areas(new_obj_mask)
+        obj_areas = label_areas(seg_mask, minlength=len(new_obj_areas))[:len(new_obj_areas)]
+        new_obj_ids = np.flatnonzero(new_obj_areas)
         new_obj_ids = new_obj_ids[new_obj_ids!=0]
         # obj_num = self.get_obj_num() + 1
-        obj_num = self.curr_idx
-        for idx in new_obj_ids:
-            new_obj_area = np.sum(new_obj_mask==idx)
-            obj_area = np.sum(seg_mask==idx)
-            if new_obj_area/obj_area < self.min_new_obj_iou or new_obj_area < self.min_area\
-                or obj_num > self.max_obj_num:
-                new_obj_mask[new_obj_mask==idx] = 0
-            else:
-                new_obj_mask[new_obj_mask==idx] = obj_num
-                obj_num += 1
+        # never reuse a tracked (or retired) id
+        obj_num = max(self.curr_idx, self.get_obj_num() + 1)
+        keep = (new_obj_areas[new_obj_ids] / obj_areas[new_obj_ids] >= self.min_new_obj_iou) & \
+            (new_obj_areas[new_obj_ids] >= self.min_area)
+        new_obj_ids = new_obj_ids[keep][:max(self.max_obj_num - obj_num + 1, 0)]
+        new_obj_mask = relabel(new_obj_mask, new_obj_ids, start_id=obj_num)
         return new_obj_mask
         
     def restart_tracker(self):
         self.tracker.restart()
+        self.missing_keyframes = {}
+        self.retired_ids = set()
+        self.keyframe_scheduler.reset()
 
     def seg_acc_bbox(self, origin_frame: np.ndarray, bbox: np.ndarray,):
         ''''
@@ -226,24 +359,31 @@ class SegTracker():
             refined_merged_mask: numpy array (h, w)
             annotated_frame: numpy array (h, w, 3)
         '''
-        # backup id and origin-merged-mask
-        bc_id = self.curr_idx
-        bc_mask = self.origin_merged_mask
         refined_merged_mask = self.origin_merged_mask.copy()
 
         # get annotated_frame and boxes
         annotated_frame, boxes = self.detector.run_grounding(origin_frame, grounding_caption, box_threshold, text_threshold)
-        for i in range(len(boxes)):
-            bbox = boxes[i]
-            if (bbox[1][0] - bbox[0][0]) * (bbox[1][1] - bbox[0][1]) > annotated_frame.shape[0] * annotated_frame.shape[1] * box_size_threshold:
-                continue
-            interactive_mask = self.sam.segment_with_box(origin_frame, bbox, reset_image)[0]
-            refined_merged_mask = self.add_mask(interactive_mask)
-            self.update_origin_merged_mask(refined_merged_mask)
-            self.curr_idx += 1
-
-        # reset origin_mask
-        self.reset_origin_merged_mask(bc_mask, bc_id)
+        if len(boxes) == 0:
+            return refined_merged_mask, annotated_frame
+
+        # drop boxes that cover too much of the frame
+        boxes = np.asarray(boxes).reshape(-1, 2, 2)
+        box_areas = (boxes[:, 1, 0] - boxes[:, 0, 0]) * (boxes[:, 1, 1] - boxes[:, 0, 1])
+        boxes = boxes[box_areas <= annotated_frame.shape[0] * annotated_frame.shape[1] * box_size_threshold]
+        if len(boxes) == 0:
+            return refined_merged_mask, annotated_frame
+
+        # one image embedding and one batched decoder pass for all boxes
+        masks = self.sam.segment_with_boxes(origin_frame, boxes, reset_image)
+
+        # box i gets id curr_idx + i, later boxes win where masks overlap
+        num_masks = masks.shape[0]
+        flipped = masks.flip(0).to(torch.uint8)
+        covered = flipped.amax(dim=0) > 0
+        last_box = num_masks - 1 - flipped.argmax(dim=0)
+        covered = covered.cpu().numpy()
+        last_box = last_box.cpu().numpy()
+        refined_merged_mask[covered] = (self.curr_idx + last_box[covered]).astype(refined_merged_mask.dtype)
 
         return refined_merged_mask, annotated_frame
 
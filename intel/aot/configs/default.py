@@ -99,6 +99,16 @@ class DefaultEngineConfig():
         self.TEST_MAX_SHORT_EDGE = None
         self.TEST_MAX_LONG_EDGE = 800 * 1.3
         self.TEST_WORKERS = 4
+        # long-term memory at inference, see networks/engines/long_term_memory.py
+        self.TEST_LONG_TERM_MEM_MAX_LEN = 9999
+        self.TEST_LONG_TERM_MEM_POLICY = 'fifo'
+        self.TEST_LONG_TERM_MEM_TOKEN_BUDGET = None
+        # long-term attention at inference, see set_long_term_attention
+        self.TEST_LONG_TERM_ATTN_CHUNK = -1
+        self.TEST_LONG_TERM_ATTN_INDEX_BLOCK = 64
+        self.TEST_LONG_TERM_ATTN_INDEX_TOP_BLOCKS = -1
+        # one forward for all the sub-engines of a video with many objects
+        self.TEST_BATCH_SUB_ENGINES = False
 
         # GPU distribution
         self.DIST_ENABLE = True
@@ -18,6 +18,8 @@ class DefaultModelConfig():
         self.MODEL_LSTT_NUM = 1
         self.MODEL_EPSILON = 1e-5
         self.MODEL_USE_PREV_PROB = False
+        # short-term attention backend: 'auto', 'corr', 'unfold' or 'window'
+        self.MODEL_LOCAL_ATTN = 'auto'
 
         self.TRAIN_LONG_TERM_MEM_GAP = 9999
         self.TRAIN_AUG_TYPE = 'v1'
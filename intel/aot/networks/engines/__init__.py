@@ -1,4 +1,4 @@
-from networks.engines.aot_engine import AOTEngine, AOTInferEngine
+from networks.engines.aot_engine import AOTEngine, AOTInferEngine, MultiVideoInferEngine
 from networks.engines.deaot_engine import DeAOTEngine, DeAOTInferEngine
 
 
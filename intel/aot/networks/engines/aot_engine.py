@@ -7,7 +7,12 @@ import numpy as np
 from utils.math import generate_permute_matrix
 from utils.image import one_hot_mask
 
+import contextlib
+
 from networks.layers.basic import seq_to_2d
+from networks.layers.transformer import long_term_key_padding
+from networks.engines.long_term_memory import LongTermMemory
+from networks.engines.compiled import stack_memories, unstack_memories
 
 
 class AOTEngine(nn.Module):
@@ -16,7 +21,18 @@ class AOTEngine(nn.Module):
                  gpu_id=0,
                  long_term_mem_gap=9999,
                  short_term_mem_skip=1,
-                 max_len_long_term=9999):
+                 max_len_long_term=9999,
+                 long_term_memory_args=None,
+                 compiled_step=None):
+        '''
+        Arguments:
+            long_term_memory_args: dict of LongTermMemory options (policy,
+                token_budget, ...), used at inference
+            compiled_step: compiled PropagateStep of aot_model, see
+                networks.engines.compiled.compile_inference, used at inference
+                to propagate frames, only with the 'fifo' long-term memory
+                policy (the usage hooks do not run in the compiled graph)
+        '''
         super().__init__()
 
         self.cfg = aot_model.cfg
@@ -28,6 +44,13 @@ class AOTEngine(nn.Module):
         self.long_term_mem_gap = long_term_mem_gap
         self.short_term_mem_skip = short_term_mem_skip
         self.max_len_long_term = max_len_long_term
+        # preallocated long-term memory used at inference, training keeps the
+        # torch.cat path so that gradients flow through the memory
+        self.long_term_memory = LongTermMemory(max_len_long_term, **(long_term_memory_args or {}))
+        assert compiled_step is None or not self.long_term_memory.records_usage, \
+            f"the compiled step does not record attention usage, use the 'fifo' long-term " \
+            f"memory policy with compile instead of '{self.long_term_memory.policy}'"
+        self.compiled_step = compiled_step
         self.losses = None
 
         self.restart_engine()
@@ -138,7 +161,8 @@ class AOTEngine(nn.Module):
             curr_enc_embs = self.AOT.encode_image(img)
 
         if mask is not None:
-            curr_one_hot_mask = one_hot_mask(mask, self.max_obj_num)
+            # a label map is kept as is when assign_identity can take it directly
+            curr_one_hot_mask = mask if self.label_identity(mask) else one_hot_mask(mask, self.max_obj_num)
         elif self.enable_offline_enc:
             curr_one_hot_mask = self.offline_one_hot_masks[frame_step]
         else:
@@ -167,7 +191,20 @@ class AOTEngine(nn.Module):
             self.update_size(all_frames.size()[2:],
                              self.offline_enc_embs[0][-1].size()[2:])
 
+    def label_identity(self, mask):
+        '''
+        At inference a label map (bs,1,h,w) indexes the ID bank directly
+        (conv_from_label) instead of going through a dense one-hot mask.
+        '''
+        return not self.training and not self.enable_id_shuffle and (
+            mask.dim() == 3 or mask.size(1) == 1)
+
     def assign_identity(self, one_hot_mask):
+        if self.label_identity(one_hot_mask):
+            id_emb = self.AOT.get_id_emb(one_hot_mask, label=True).view(
+                self.batch_size, -1, self.enc_hw).permute(2, 0, 1)
+            return id_emb
+
         if self.enable_id_shuffle:
             one_hot_mask = torch.einsum('bohw,bot->bthw', one_hot_mask,
                                         self.id_shuffle_matrix)
@@ -242,7 +279,7 @@ class AOTEngine(nn.Module):
 
         lstt_embs, lstt_curr_memories, lstt_long_memories, lstt_short_memories = self.curr_lstt_output
 
-        if self.long_term_memories is None:
+        if self.long_term_memories is None and self.training:
             self.long_term_memories = lstt_long_memories
         else:
             self.update_long_term_memory(lstt_long_memories)
@@ -281,7 +318,7 @@ class AOTEngine(nn.Module):
 
         lstt_embs, lstt_curr_memories, lstt_long_memories, lstt_short_memories = self.curr_lstt_output
 
-        if self.long_term_memories is None:
+        if self.long_term_memories is None and self.training:
             self.long_term_memories = lstt_long_memories
         else:
             self.update_long_term_memory(lstt_long_memories)
@@ -291,6 +328,12 @@ class AOTEngine(nn.Module):
         self.short_term_memories = lstt_short_memories
 
     def update_long_term_memory(self, new_long_term_memories):
+        if not self.training:
+            # O(token) write into the ring buffer, attention reads a view
+            self.long_term_memory.append(new_long_term_memories, self.frame_step)
+            self.long_term_memories = self.long_term_memory.views()
+            return
+
         TOKEN_NUM = new_long_term_memories[0][0].shape[0]
         if self.long_term_memories is None:
             self.long_term_memories = new_long_term_memories
@@ -311,7 +354,9 @@ class AOTEngine(nn.Module):
 
     def update_short_term_memory(self, curr_mask, curr_id_emb=None, skip_long_term_update=False):
         if curr_id_emb is None:
-            if len(curr_mask.size()) == 3 or curr_mask.size()[0] == 1:
+            if self.label_identity(curr_mask):
+                curr_one_hot_mask = curr_mask
+            elif len(curr_mask.size()) == 3 or curr_mask.size()[0] == 1:
                 curr_one_hot_mask = one_hot_mask(curr_mask, self.max_obj_num)
             else:
                 curr_one_hot_mask = curr_mask
@@ -350,20 +395,41 @@ class AOTEngine(nn.Module):
         else:
             curr_enc_embs = img_embs
         self.curr_enc_embs = curr_enc_embs
-
-        self.curr_lstt_output = self.AOT.LSTT_forward(curr_enc_embs,
-                                                      self.long_term_memories,
-                                                      self.short_term_memories,
-                                                      None,
-                                                      pos_emb=self.pos_emb,
-                                                      size_2d=self.enc_size_2d)
+        self.curr_id_logits = None
+
+        if self.compiled_step is not None and not self.training and self.long_term_memory.storage is not None:
+            # one graph for LSTT + decoder, the long-term attention is not
+            # observed, hence 'fifo' only (see __init__)
+            self.curr_id_logits, lstt_embs, curr_memories = self.compiled_step(
+                curr_enc_embs, self.long_term_memory.stacked_views(),
+                stack_memories(self.short_term_memories), self.pos_emb,
+                tuple(self.enc_size_2d))
+            self.curr_lstt_output = (lstt_embs,
+                                     unstack_memories(curr_memories, len(self.AOT.LSTT.layers)),
+                                     None, None)
+            return
+
+        # the usage-based eviction policies score memory frames by the
+        # attention they receive here
+        with self.long_term_memory.record_usage(self.AOT.LSTT.layers):
+            self.curr_lstt_output = self.AOT.LSTT_forward(curr_enc_embs,
+                                                          self.long_term_memories,
+                                                          self.short_term_memories,
+                                                          None,
+                                                          pos_emb=self.pos_emb,
+                                                          size_2d=self.enc_size_2d)
 
     def decode_current_logits(self, output_size=None):
         curr_enc_embs = self.curr_enc_embs
         curr_lstt_embs = self.curr_lstt_output[0]
 
-        pred_id_logits = self.AOT.decode_id_logits(curr_lstt_embs,
-                                                   curr_enc_embs)
+        if self.curr_id_logits is not None:
+            # decoded by the compiled step
+            pred_id_logits = self.curr_id_logits
+            self.curr_id_logits = None
+        else:
+            pred_id_logits = self.AOT.decode_id_logits(curr_lstt_embs,
+                                                       curr_enc_embs)
 
         if self.enable_id_shuffle:  # reverse shuffle
             pred_id_logits = torch.einsum('bohw,bto->bthw', pred_id_logits,
@@ -462,6 +528,7 @@ class AOTEngine(nn.Module):
         self.input_size_2d = None
 
         self.long_term_memories = None
+        self.long_term_memory.reset()
         self.short_term_memories_list = []
         self.short_term_memories = None
 
@@ -474,13 +541,26 @@ class AOTEngine(nn.Module):
         self.curr_enc_embs = None
         self.curr_memories = None
         self.curr_id_embs = None
+        self.curr_id_logits = None
 
         if enable_id_shuffle:
             self.id_shuffle_matrix = generate_permute_matrix(
-                self.max_obj_num + 1, batch_size, gpu_id=self.gpu_id)
+                self.max_obj_num + 1, batch_size, gpu_id=self.gpu_id,
+                device=next(self.AOT.parameters()).device)
         else:
             self.id_shuffle_matrix = None
 
+    def release_memory(self):
+        # drop every memory but keep obj_nums and the sizes, see AOTInferEngine.retire_objects
+        self.long_term_memories = None
+        self.long_term_memory.reset()
+        self.short_term_memories_list = []
+        self.short_term_memories = None
+        self.curr_enc_embs = None
+        self.curr_lstt_output = None
+        self.curr_id_logits = None
+        self.pred_id_logits = None
+
     def update_size(self, input_size, enc_size):
         self.input_size_2d = input_size
         self.enc_size_2d = enc_size
@@ -494,7 +574,19 @@ class AOTInferEngine(nn.Module):
                  long_term_mem_gap=9999,
                  short_term_mem_skip=1,
                  max_aot_obj_num=None,
-                 max_len_long_term=9999,):
+                 max_len_long_term=9999,
+                 long_term_memory_args=None,
+                 batched=False,
+                 compiled_step=None):
+        '''
+        Arguments:
+            batched: with more than one sub-engine (more objects than
+                max_aot_obj_num), stack their memories along the batch
+                dimension and run one LSTT and one decoder forward per frame
+                instead of one per sub-engine
+            compiled_step: see AOTEngine, the sub-engines propagate through it
+                when batched is off or there is a single sub-engine
+        '''
         super().__init__()
 
         self.cfg = aot_model.cfg
@@ -509,13 +601,40 @@ class AOTInferEngine(nn.Module):
         self.long_term_mem_gap = long_term_mem_gap
         self.short_term_mem_skip = short_term_mem_skip
         self.max_len_long_term = max_len_long_term
+        self.long_term_memory_args = long_term_memory_args
+        self.batched = batched
+        self.compiled_step = compiled_step
         self.aot_engines = []
+        if compiled_step is not None:
+            # fail here rather than on the first reference frame, a sub-engine
+            # checks that its long-term memory policy works with the step
+            self.new_engine()
 
         self.restart_engine()
     def restart_engine(self):
         del (self.aot_engines)
         self.aot_engines = []
         self.obj_nums = None
+        self.batch = SubEngineBatch()
+        # ids that left the video, and sub-engines all of whose ids did
+        self.retired_ids = set()
+        self.retired_engines = set()
+        self.logit_size = None
+        self.dec_size_2d = None
+
+    def new_engine(self):
+        new_engine = AOTEngine(self.AOT, self.gpu_id,
+                               self.long_term_mem_gap,
+                               self.short_term_mem_skip,
+                               self.max_len_long_term,
+                               self.long_term_memory_args,
+                               self.compiled_step)
+        new_engine.eval()
+        return new_engine
+
+    def active_engines(self):
+        return [aot_engine for idx, aot_engine in enumerate(self.aot_engines)
+                if idx not in self.retired_engines]
 
     def separate_mask(self, mask, obj_nums):
         if mask is None:
@@ -530,13 +649,11 @@ class AOTInferEngine(nn.Module):
             separated_obj_nums[-1] = obj_nums % self.max_aot_obj_num
 
         if len(mask.size()) == 3 or mask.size()[0] == 1:
-            separated_masks = []
-            for idx in range(len(self.aot_engines)):
-                start_id = idx * self.max_aot_obj_num + 1
-                end_id = (idx + 1) * self.max_aot_obj_num
-                fg_mask = ((mask >= start_id) & (mask <= end_id)).float()
-                separated_mask = (fg_mask * mask - start_id + 1) * fg_mask
-                separated_masks.append(separated_mask)
+            # sub-engine and id within it of every pixel, background in none
+            engine_idx = torch.div(mask - 1, self.max_aot_obj_num, rounding_mode='floor')
+            local_mask = mask - engine_idx * self.max_aot_obj_num
+            separated_masks = [local_mask * (engine_idx == idx)
+                               for idx in range(len(self.aot_engines))]
             return separated_masks, separated_obj_nums
         else:
             prob = mask
@@ -586,24 +703,21 @@ class AOTInferEngine(nn.Module):
 
         return merged_logit
 
-    def add_reference_frame(self, img, mask, obj_nums, frame_step=-1):
+    def add_reference_frame(self, img, mask, obj_nums, frame_step=-1, img_embs=None):
+        # img_embs: encoder features of img computed by the caller, skips the encoder
         if isinstance(obj_nums, list):
             obj_nums = obj_nums[0]
         self.obj_nums = obj_nums
         aot_num = max(np.ceil(obj_nums / self.max_aot_obj_num), 1)
         while (aot_num > len(self.aot_engines)):
-            new_engine = AOTEngine(self.AOT, self.gpu_id,
-                                   self.long_term_mem_gap,
-                                   self.short_term_mem_skip,
-                                   self.max_len_long_term,)
-            new_engine.eval()
-            self.aot_engines.append(new_engine)
+            self.aot_engines.append(self.new_engine())
 
         separated_masks, separated_obj_nums = self.separate_mask(
             mask, obj_nums)
-        img_embs = None
-        for aot_engine, separated_mask, separated_obj_num in zip(
-                self.aot_engines, separated_masks, separated_obj_nums):
+        for idx, (aot_engine, separated_mask, separated_obj_num) in enumerate(zip(
+                self.aot_engines, separated_masks, separated_obj_nums)):
+            if idx in self.retired_engines:
+                continue
             aot_engine.add_reference_frame(img,
                                         separated_mask,
                                         obj_nums=[separated_obj_num],
@@ -615,29 +729,337 @@ class AOTInferEngine(nn.Module):
 
         self.update_size()
 
-    def match_propogate_one_frame(self, img=None):
-        img_embs = None
-        for aot_engine in self.aot_engines:
+    def add_objects(self, img, mask, obj_nums, frame_step=-1, img_embs=None):
+        '''
+        Start tracking the objects of mask with ids above the current obj_nums,
+        on a frame that was just propagated (match_propogate_one_frame). Only
+        the sub-engines that receive new ids take the frame as a new reference,
+        the others treat it as a tracked frame (update_short_term_memory, the
+        long-term memory follows long_term_mem_gap as usual).
+        Arguments:
+            mask: tensor (1,1,h,w), label map of the tracked and the new objects
+            obj_nums: largest id in mask
+        '''
+        if isinstance(obj_nums, list):
+            obj_nums = obj_nums[0]
+        self.obj_nums = obj_nums
+        aot_num = max(np.ceil(obj_nums / self.max_aot_obj_num), 1)
+        while (aot_num > len(self.aot_engines)):
+            self.aot_engines.append(self.new_engine())
+
+        separated_masks, separated_obj_nums = self.separate_mask(
+            mask, obj_nums)
+        for idx, (aot_engine, separated_mask, separated_obj_num) in enumerate(zip(
+                self.aot_engines, separated_masks, separated_obj_nums)):
+            if aot_engine.obj_nums is None or aot_engine.obj_nums[0] < separated_obj_num:
+                # a retired sub-engine comes back for new ids in its range
+                self.retired_engines.discard(idx)
+                aot_engine.add_reference_frame(img,
+                                            separated_mask,
+                                            obj_nums=[separated_obj_num],
+                                            frame_step=frame_step,
+                                            img_embs=img_embs)
+            elif idx not in self.retired_engines:
+                aot_engine.update_short_term_memory(separated_mask)
+            else:
+                continue
+            if img_embs is None:  # reuse image embeddings
+                img_embs = aot_engine.curr_enc_embs
+
+        self.update_size()
+
+    def retire_objects(self, obj_ids):
+        '''
+        Stop tracking obj_ids (e.g. objects that left the scene). Their logits
+        are masked out. A sub-engine whose ids are all retired releases its
+        memory and is skipped on every following frame.
+        Arguments:
+            obj_ids: iterable of ids in 1..obj_nums
+        '''
+        self.retired_ids.update(int(obj_id) for obj_id in obj_ids)
+        for idx, aot_engine in enumerate(self.aot_engines):
+            if idx in self.retired_engines or aot_engine.obj_nums is None:
+                continue
+            start_id = idx * self.max_aot_obj_num + 1
+            end_id = start_id + aot_engine.obj_nums[0]
+            if all(obj_id in self.retired_ids for obj_id in range(start_id, end_id)):
+                aot_engine.release_memory()
+                self.retired_engines.add(idx)
+
+    def mask_retired_logits(self, all_logits):
+        '''
+        Arguments:
+            all_logits: logits of the active sub-engines
+        Return:
+            one entry per sub-engine, retired ids masked and retired
+            sub-engines replaced by background logits
+        '''
+        if len(all_logits) > 0:
+            self.logit_size = all_logits[0].shape[2:]
+        logits = iter(all_logits)
+        masked_logits = []
+        for idx in range(len(self.aot_engines)):
+            if idx in self.retired_engines:
+                logit = torch.full((1, self.max_aot_obj_num + 1) + tuple(self.logit_size), -1e+4,
+                                   device=next(self.AOT.parameters()).device)
+                logit[:, 0] = 0
+            else:
+                logit = next(logits)
+                start_id = idx * self.max_aot_obj_num
+                for obj_id in self.retired_ids:
+                    if start_id < obj_id <= start_id + self.max_aot_obj_num:
+                        logit[:, obj_id - start_id] = - \
+                            1e+10 if logit.dtype == torch.float32 else -1e+4
+            masked_logits.append(logit)
+        return masked_logits
+
+    def match_propogate_one_frame(self, img=None, img_embs=None):
+        if self.batched and len(self.active_engines()) > 1:
+            self.batched_match_propogate_one_frame(img, img_embs)
+            return
+        for aot_engine in self.active_engines():
             aot_engine.match_propogate_one_frame(img, img_embs=img_embs)
             if img_embs is None:  # reuse image embeddings
                 img_embs = aot_engine.curr_enc_embs
 
+    def batched_match_propogate_one_frame(self, img=None, img_embs=None):
+        if img_embs is None:
+            img_embs = self.AOT.encode_image(img)
+        self.batch.propagate(self.AOT, self.active_engines(), img_embs)
+
     def decode_current_logits(self, output_size=None):
+        if self.batched and len(self.active_engines()) > 1:
+            return self.batched_decode_current_logits(output_size)
         all_logits = []
-        for aot_engine in self.aot_engines:
+        for aot_engine in self.active_engines():
             all_logits.append(aot_engine.decode_current_logits(output_size))
+        if len(self.retired_ids) > 0:
+            if len(all_logits) == 0:
+                # every id is retired, background logits at the size the
+                # sub-engines would have returned
+                self.logit_size = output_size if output_size is not None else self.dec_size_2d
+            all_logits = self.mask_retired_logits(all_logits)
         pred_id_logits = self.soft_logit_aggregation(all_logits)
         return pred_id_logits
 
+    def batched_decode_current_logits(self, output_size=None):
+        pred_id_logits = self.batch.decode(self.AOT, self.active_engines(), output_size)
+        all_logits = list(pred_id_logits.split(1))
+        if len(self.retired_ids) > 0:
+            all_logits = self.mask_retired_logits(all_logits)
+        return self.soft_logit_aggregation(all_logits)
+
     def update_memory(self, curr_mask, skip_long_term_update=False):
         _curr_mask = F.interpolate(curr_mask,self.input_size_2d)
         separated_masks, _ = self.separate_mask(_curr_mask, self.obj_nums)
-        for aot_engine, separated_mask in zip(self.aot_engines,
-                                              separated_masks):
+        for idx, (aot_engine, separated_mask) in enumerate(zip(self.aot_engines,
+                                                               separated_masks)):
+            if idx in self.retired_engines:
+                continue
             aot_engine.update_short_term_memory(separated_mask, 
                                                 skip_long_term_update=skip_long_term_update)
 
     def update_size(self):
-        self.input_size_2d = self.aot_engines[0].input_size_2d
-        self.enc_size_2d = self.aot_engines[0].enc_size_2d
-        self.enc_hw = self.aot_engines[0].enc_hw
+        aot_engine = self.active_engines()[0]
+        self.input_size_2d = aot_engine.input_size_2d
+        self.enc_size_2d = aot_engine.enc_size_2d
+        self.enc_hw = aot_engine.enc_hw
+        if aot_engine.curr_enc_embs is not None:
+            # the decoder predicts at the size of the stride 4 encoder feature
+            self.dec_size_2d = aot_engine.curr_enc_embs[0].size()[2:]
+
+
+class SubEngineBatch():
+    def __init__(self):
+        '''
+        One LSTT and one decoder forward for a list of sub-engines (AOTEngine
+        in eval mode, of one video or of several) with the same encoder
+        feature size, sub-engine i is batch entry i. Sub-engines created at
+        different frames hold long-term memories of different lengths, the
+        shorter ones are zero padded and the padding is masked in the
+        long-term attention.
+        '''
+        self.lstt_output = None
+        self.curr_embs = None
+        self.stacked_long_term = None
+
+    def propagate(self, aot_model, engines, img_embs, emb_index=None):
+        '''
+        Arguments:
+            engines: list of AOTEngine
+            img_embs: encoder features of one frame shared by all engines, or
+                of a batch of frames
+            emb_index: with a batch of frames, the frame of every engine
+        '''
+        batch_size = len(engines)
+        if emb_index is None:
+            curr_embs = [emb.expand(batch_size, -1, -1, -1) for emb in img_embs]
+            engine_embs = [img_embs] * batch_size
+        else:
+            index = torch.as_tensor(emb_index, device=img_embs[-1].device)
+            curr_embs = [emb.index_select(0, index) for emb in img_embs]
+            engine_embs = [[emb[frame_idx:frame_idx + 1] for emb in img_embs] for frame_idx in emb_index]
+        for aot_engine, embs in zip(engines, engine_embs):
+            aot_engine.frame_step += 1
+            aot_engine.curr_enc_embs = embs
+        self.curr_embs = curr_embs
+
+        pos_emb = engines[0].pos_emb.expand(-1, batch_size, -1)
+        long_term_memories, key_padding_bias = self.stack_long_term_memories(engines)
+        short_term_memories = [
+            [self._cat([aot_engine.short_term_memories[layer_idx][idx] for aot_engine in engines], dim=0)
+             for idx in range(len(engines[0].short_term_memories[layer_idx]))]
+            for layer_idx in range(len(engines[0].short_term_memories))
+        ]
+
+        with contextlib.ExitStack() as stack:
+            for batch_idx, aot_engine in enumerate(engines):
+                stack.enter_context(aot_engine.long_term_memory.record_usage(
+                    aot_model.LSTT.layers, batch_idx=batch_idx))
+            stack.enter_context(long_term_key_padding(aot_model.LSTT, key_padding_bias))
+            self.lstt_output = aot_model.LSTT_forward(curr_embs,
+                                                      long_term_memories,
+                                                      short_term_memories,
+                                                      None,
+                                                      pos_emb=pos_emb,
+                                                      size_2d=engines[0].enc_size_2d)
+
+        # every sub-engine sees its own slice, update_memory works unchanged
+        lstt_embs, lstt_curr_memories, _, lstt_short_memories = self.lstt_output
+        for batch_idx, aot_engine in enumerate(engines):
+            aot_engine.curr_lstt_output = (
+                [emb[:, batch_idx:batch_idx + 1] for emb in lstt_embs],
+                [[self._select(x, batch_idx, dim=1) for x in memory] for memory in lstt_curr_memories],
+                aot_engine.long_term_memories,
+                [[self._select(x, batch_idx, dim=0) for x in memory] for memory in lstt_short_memories])
+
+    def decode(self, aot_model, engines, output_size=None):
+        '''
+        Return:
+            logits (num engines, max_obj_num + 1, h, w), unused identities removed
+        '''
+        pred_id_logits = aot_model.decode_id_logits(self.lstt_output[0], self.curr_embs)
+
+        # remove unused identities
+        for batch_idx, aot_engine in enumerate(engines):
+            obj_num = aot_engine.obj_nums[0]
+            pred_id_logits[batch_idx, (obj_num + 1):] = - \
+                1e+10 if pred_id_logits.dtype == torch.float32 else -1e+4
+            aot_engine.pred_id_logits = pred_id_logits[batch_idx:batch_idx + 1]
+
+        if output_size is not None:
+            pred_id_logits = F.interpolate(pred_id_logits,
+                                           size=output_size,
+                                           mode="bilinear",
+                                           align_corners=engines[0].align_corners)
+        return pred_id_logits
+
+    def stack_long_term_memories(self, engines):
+        '''
+        Return:
+            per LSTT layer, list of tensors (max T_k, num engines, c), and the
+            key padding bias (num engines, 1, 1, max T_k), None when all
+            memories have the same length. Rebuilt only when one of the
+            memories changed.
+        '''
+        key = tuple((id(aot_engine.long_term_memory), aot_engine.long_term_memory.version)
+                    for aot_engine in engines)
+        if self.stacked_long_term is not None and self.stacked_long_term[0] == key:
+            return self.stacked_long_term[1:]
+
+        all_memories = [aot_engine.long_term_memories for aot_engine in engines]
+        lengths = [self._seq_len(memories) for memories in all_memories]
+        max_len = max(lengths)
+        stacked = []
+        for layer_idx in range(len(all_memories[0])):
+            layer_stacked = []
+            for idx in range(len(all_memories[0][layer_idx])):
+                entries = [memories[layer_idx][idx] for memories in all_memories]
+                if entries[0] is None:
+                    layer_stacked.append(None)
+                    continue
+                x = entries[0]
+                out = x.new_zeros((max_len, len(entries)) + tuple(x.shape[2:]))
+                for batch_idx, entry in enumerate(entries):
+                    out[:entry.shape[0], batch_idx:batch_idx + 1] = entry
+                layer_stacked.append(out)
+            stacked.append(layer_stacked)
+
+        key_padding_bias = None
+        if min(lengths) < max_len:
+            # -1e+4 stays finite in fp16
+            valid = torch.arange(max_len, device=out.device).unsqueeze(0) < torch.tensor(
+                lengths, device=out.device).unsqueeze(1)
+            key_padding_bias = torch.zeros(valid.shape, device=out.device).masked_fill_(
+                ~valid, -1e+4).view(len(engines), 1, 1, max_len)
+        self.stacked_long_term = (key, stacked, key_padding_bias)
+        return stacked, key_padding_bias
+
+    def _seq_len(self, memories):
+        for layer_memories in memories:
+            for memory in layer_memories:
+                if memory is not None:
+                    return memory.shape[0]
+        return 0
+
+    def _cat(self, xs, dim):
+        return None if xs[0] is None else torch.cat(xs, dim=dim)
+
+    def _select(self, x, batch_idx, dim):
+        return None if x is None else x.narrow(dim, batch_idx, 1)
+
+
+class MultiVideoInferEngine():
+    def __init__(self, aot_model):
+        '''
+        Tracks independent videos (sessions, one AOTInferEngine each) in lock
+        step: their frames are encoded as one batch and the active sub-engines
+        of all sessions run one LSTT and one decoder forward, see
+        SubEngineBatch. Sessions differ in memory length and object number,
+        the frames of one call must have the same size.
+        '''
+        self.AOT = aot_model
+        self.batch = SubEngineBatch()
+        self.engines = []
+
+    def match_propogate(self, infer_engines, imgs):
+        '''
+        Arguments:
+            infer_engines: list of AOTInferEngine with a reference frame
+            imgs: list of tensors (1,3,h,w), the next frame of every session
+        '''
+        img_embs = self.AOT.encode_image(torch.cat(imgs, dim=0))
+        self.engines = []
+        emb_index = []
+        for frame_idx, infer_engine in enumerate(infer_engines):
+            for aot_engine in infer_engine.active_engines():
+                self.engines.append(aot_engine)
+                emb_index.append(frame_idx)
+        self.batch.propagate(self.AOT, self.engines, img_embs, emb_index)
+
+    def decode_logits(self, infer_engines, output_sizes=None):
+        '''
+        Arguments:
+            output_sizes: list, per session None or the size to interpolate
+                the logits to before merging the sub-engines
+        Return:
+            list, per session the merged logits as AOTInferEngine.decode_current_logits
+        '''
+        all_logits = list(self.batch.decode(self.AOT, self.engines).split(1))
+        session_logits = []
+        start = 0
+        for session_idx, infer_engine in enumerate(infer_engines):
+            num_engines = len(infer_engine.active_engines())
+            logits = all_logits[start:start + num_engines]
+            start += num_engines
+            output_size = output_sizes[session_idx] if output_sizes is not None else None
+            if output_size is not None:
+                logits = [F.interpolate(logit,
+                                        size=output_size,
+                                        mode="bilinear",
+                                        align_corners=infer_engine.aot_engines[0].align_corners)
+                          for logit in logits]
+            if len(infer_engine.retired_ids) > 0:
+                logits = infer_engine.mask_retired_logits(logits)
+            session_logits.append(infer_engine.soft_logit_aggregation(logits))
+        return session_logits
@@ -0,0 +1,195 @@
+import os
+import torch
+import torch.nn as nn
+from torch.utils._pytree import tree_map
+
+# Compiled inference. The eager step goes AOTEngine -> AOT.LSTT_forward ->
+# LSTT layers -> decoder through per-layer lists of memories, and on CPU most
+# of a small frame is spent dispatching those Python calls. PropagateStep
+# takes the memories as one tensor per entry stacked over the layers, so the
+# whole LSTT + decoder step is a single graph that torch.compile fuses and
+# torch.export can trace.
+
+
+def stack_memories(memories):
+    '''
+    Arguments:
+        memories: per LSTT layer, list of tensors or None
+    Return:
+        per entry, tensor stacked over the layers (num_layers, ...) when every
+        layer has it, None when no layer has it, else the per layer list (the
+        current memories of DeAOT have no ID_V on the first layer, it is only
+        fused in with the identity)
+    '''
+    stacked = []
+    for entry in zip(*memories):
+        present = [memory is not None for memory in entry]
+        if all(present):
+            stacked.append(torch.stack(entry))
+        elif any(present):
+            stacked.append(list(entry))
+        else:
+            stacked.append(None)
+    return tuple(stacked)
+
+
+def unstack_memories(memories, num_layers):
+    '''
+    Inverse of stack_memories, per layer lists of views.
+    '''
+    entries = [entry.unbind(0) if torch.is_tensor(entry) else entry for entry in memories]
+    return [[entry[layer_idx] if entry is not None else None for entry in entries]
+            for layer_idx in range(num_layers)]
+
+
+class PropagateStep(nn.Module):
+    def __init__(self, aot_model):
+        '''
+        One inference step of an AOT / DeAOT model against its memories:
+        propagate(frame, memory) -> (logits, new memory).
+        '''
+        super().__init__()
+        self.AOT = aot_model
+        self.num_layers = len(aot_model.LSTT.layers)
+
+    def forward(self, curr_embs, long_term_memories, short_term_memories, pos_emb, size_2d):
+        '''
+        Arguments:
+            curr_embs: encoder outputs of the frame, see AOT.encode_image
+            long_term_memories: per entry, tensor (num_layers, T, bs, c) or
+                None, see LongTermMemory.stacked_views
+            short_term_memories: per entry, tensor (num_layers, bs, c, h, w)
+                or None, see stack_memories
+            pos_emb: tensor (hw, bs, c)
+            size_2d: (h, w) of the encoder output
+        Return:
+            pred_id_logits: tensor (bs, max_obj_num + 1, h, w) at the encoder
+                stride, before the unused identities are masked
+            lstt_embs: list of tensors (hw, bs, c), the decoder inputs
+            curr_memories: per entry, tensor (num_layers, hw, bs, c), per
+                layer list or None (see stack_memories), the memories of this
+                frame before the identity is fused in
+        '''
+        lstt_embs, lstt_curr_memories, _, _ = self.AOT.LSTT_forward(
+            curr_embs,
+            unstack_memories(long_term_memories, self.num_layers),
+            unstack_memories(short_term_memories, self.num_layers),
+            None,
+            pos_emb=pos_emb,
+            size_2d=size_2d)
+        pred_id_logits = self.AOT.decode_id_logits(lstt_embs, curr_embs)
+        return pred_id_logits, lstt_embs, stack_memories(lstt_curr_memories)
+
+
+def enable_compile_cache(cache_dir=None):
+    '''
+    Warm start: keep the compiled kernels and graphs on disk, so a new process
+    with the same model, shapes and torch version skips most of the compile.
+    Arguments:
+        cache_dir: inductor cache directory, None keeps the torch default
+            (/tmp/torchinductor_<user>), which does not survive a reboot
+    '''
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, 'autotune_local_cache'):
+        inductor_config.autotune_local_cache = True
+
+
+def compile_inference(aot_model, mode=None, dynamic=None, cache_dir=None):
+    '''
+    Arguments:
+        aot_model: AOT / DeAOT model in eval mode
+        mode: torch.compile mode, None / 'reduce-overhead' / 'max-autotune'
+        dynamic: torch.compile dynamic, None compiles static shapes first and
+            makes a dimension dynamic once it changes (the long-term memory
+            length grows until the memory is full)
+        cache_dir: see enable_compile_cache
+    Return:
+        compiled PropagateStep, passed to the engines as compiled_step. The
+        encoder of aot_model is compiled in place. The long-term attention
+        usage hooks do not run in the compiled graph, the engines reject the
+        'usage' / 'merge' long-term memory policies with it.
+    '''
+    enable_compile_cache(cache_dir)
+    aot_model.encoder.compile(mode=mode, dynamic=dynamic)
+    aot_model.encoder_projector.compile(mode=mode, dynamic=dynamic)
+    return torch.compile(PropagateStep(aot_model), mode=mode, dynamic=dynamic)
+
+
+def export_propagate_step(aot_model, engine, path=None):
+    '''
+    torch.export the step with the memories of a running engine as example
+    inputs, the long-term memory length is exported as a dynamic dimension
+    where the model allows it.
+    Arguments:
+        engine: AOTEngine that has taken a reference frame and propagated
+            at least one frame
+        path: save the ExportedProgram there when given
+    Return:
+        torch.export.ExportedProgram
+    '''
+    step = PropagateStep(aot_model).eval()
+    long_term_memories = engine.long_term_memory.stacked_views()
+    short_term_memories = stack_memories(engine.short_term_memories)
+    args = (engine.curr_enc_embs, long_term_memories, short_term_memories,
+            engine.pos_emb, tuple(engine.enc_size_2d))
+    # AUTO: the range of the memory length follows the guards of the traced model
+    dynamic_shapes = tuple(tree_map(lambda _: None, arg) for arg in args)
+    dynamic_shapes = dynamic_shapes[:1] + (tuple({1: torch.export.Dim.AUTO} if memory is not None else None
+                                                 for memory in long_term_memories), ) + dynamic_shapes[2:]
+    exported = torch.export.export(step, args, dynamic_shapes=dynamic_shapes)
+    if path is not None:
+        torch.export.save(exported, path)
+    return exported
+
+
+def _benchmark(model_name='r50_deaotl', size=(241, 433), num_frames=10, cache_dir=None):
+    # per-frame latency of an inference engine with eager and compiled steps,
+    # random weights, run from intel/aot: python -m networks.engines.compiled
+    import importlib
+    import time
+    from networks.models import build_vos_model
+    from networks.engines import build_engine
+    torch.manual_seed(0)
+    cfg = importlib.import_module('configs.pre_ytb_dav').EngineConfig('benchmark', model_name)
+    cfg.MODEL_ENCODER_PRETRAIN = ''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = build_vos_model(cfg.MODEL_VOS, cfg).to(device).eval()
+    frames = [torch.randn(1, 3, size[0], size[1], device=device) for _ in range(num_frames + 1)]
+    mask = torch.zeros(1, 1, size[0], size[1], device=device)
+    mask[:, :, size[0] // 4:size[0] // 2, size[1] // 4:size[1] // 2] = 1
+    mask[:, :, size[0] // 2:, size[1] // 2:] = 2
+
+    def run(compiled_step):
+        engine = build_engine(cfg.MODEL_ENGINE, phase='eval', aot_model=model, gpu_id=0,
+                              long_term_mem_gap=2, compiled_step=compiled_step)
+        engine.add_reference_frame(frames[0], mask, obj_nums=[2], frame_step=0)
+        latencies = []
+        for frame in frames[1:]:
+            start = time.perf_counter()
+            engine.match_propogate_one_frame(frame)
+            pred_logit = engine.decode_current_logits(size)
+            engine.update_memory(torch.argmax(pred_logit, dim=1, keepdim=True).float())
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start)
+        return pred_logit, latencies
+
+    with torch.no_grad():
+        eager_logit, latencies = run(None)
+        print(f'{model_name} eager    {device}: {sum(latencies) / len(latencies) * 1000:8.2f} ms/frame')
+        start = time.perf_counter()
+        compiled_step = compile_inference(model, cache_dir=cache_dir)
+        # the first pass compiles, and recompiles once the memory length changes
+        run(compiled_step)
+        print(f'{model_name} compile  {device}: {time.perf_counter() - start:8.2f} s')
+        compiled_logit, latencies = run(compiled_step)
+        print(f'{model_name} compiled {device}: {sum(latencies) / len(latencies) * 1000:8.2f} ms/frame, '
+              f'max logit difference {(compiled_logit - eager_logit).abs().max().item():.2e}')
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -13,14 +13,19 @@ class DeAOTEngine(AOTEngine):
                  long_term_mem_gap=9999,
                  short_term_mem_skip=1,
                  layer_loss_scaling_ratio=2.,
-                 max_len_long_term=9999):
+                 max_len_long_term=9999,
+                 long_term_memory_args=None,
+                 compiled_step=None):
         super().__init__(aot_model, gpu_id, long_term_mem_gap,
-                         short_term_mem_skip, max_len_long_term)
+                         short_term_mem_skip, max_len_long_term,
+                         long_term_memory_args, compiled_step)
         self.layer_loss_scaling_ratio = layer_loss_scaling_ratio
     def update_short_term_memory(self, curr_mask, curr_id_emb=None, skip_long_term_update=False):
 
         if curr_id_emb is None:
-            if len(curr_mask.size()) == 3 or curr_mask.size()[0] == 1:
+            if self.label_identity(curr_mask):
+                curr_one_hot_mask = curr_mask
+            elif len(curr_mask.size()) == 3 or curr_mask.size()[0] == 1:
                 curr_one_hot_mask = one_hot_mask(curr_mask, self.max_obj_num)
             else:
                 curr_one_hot_mask = curr_mask
@@ -63,36 +68,24 @@ class DeAOTInferEngine(AOTInferEngine):
                  long_term_mem_gap=9999,
                  short_term_mem_skip=1,
                  max_aot_obj_num=None,
-                 max_len_long_term=9999):
+                 max_len_long_term=9999,
+                 long_term_memory_args=None,
+                 batched=False,
+                 compiled_step=None):
         super().__init__(aot_model, gpu_id, long_term_mem_gap,
-                         short_term_mem_skip, max_aot_obj_num, max_len_long_term)
-    def add_reference_frame(self, img, mask, obj_nums, frame_step=-1):
-        if isinstance(obj_nums, list):
-            obj_nums = obj_nums[0]
-        self.obj_nums = obj_nums
-        aot_num = max(np.ceil(obj_nums / self.max_aot_obj_num), 1)
-        while (aot_num > len(self.aot_engines)):
-            new_engine = DeAOTEngine(self.AOT, self.gpu_id,
-                                     self.long_term_mem_gap,
-                                     self.short_term_mem_skip,
-                                     max_len_long_term = self.max_len_long_term)
-            new_engine.eval()
-            self.aot_engines.append(new_engine)
+                         short_term_mem_skip, max_aot_obj_num, max_len_long_term,
+                         long_term_memory_args, batched, compiled_step)
 
-        separated_masks, separated_obj_nums = self.separate_mask(
-            mask, obj_nums)
-        img_embs = None
-        for aot_engine, separated_mask, separated_obj_num in zip(
-                self.aot_engines, separated_masks, separated_obj_nums):
-            if aot_engine.obj_nums is None or aot_engine.obj_nums[0] < separated_obj_num:
-                aot_engine.add_reference_frame(img,
-                                            separated_mask,
-                                            obj_nums=[separated_obj_num],
-                                            frame_step=frame_step,
-                                            img_embs=img_embs)
-            else:
-                aot_engine.update_short_term_memory(separated_mask)
-            if img_embs is None:  # reuse image embeddings
-                img_embs = aot_engine.curr_enc_embs
+    def new_engine(self):
+        new_engine = DeAOTEngine(self.AOT, self.gpu_id,
+                                 self.long_term_mem_gap,
+                                 self.short_term_mem_skip,
+                                 max_len_long_term=self.max_len_long_term,
+                                 long_term_memory_args=self.long_term_memory_args,
+                                 compiled_step=self.compiled_step)
+        new_engine.eval()
+        return new_engine
 
-        self.update_size()
+    def add_reference_frame(self, img, mask, obj_nums, frame_step=-1, img_embs=None):
+        # sub-engines without new ids keep their memory
+        self.add_objects(img, mask, obj_nums, frame_step, img_embs)
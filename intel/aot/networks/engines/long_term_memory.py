@@ -0,0 +1,336 @@
+import contextlib
+import torch
+import torch.nn.functional as F
+
+# 'fifo': overwrite the oldest frame (the torch.cat prepend behavior)
+# 'usage': evict the frame the long-term attention used least
+# 'merge': fold a new frame into a near duplicate, else evict as 'usage'
+POLICIES = ('fifo', 'usage', 'merge')
+
+
+class LongTermMemory():
+    def __init__(self,
+                 max_len=9999,
+                 init_len=8,
+                 policy='fifo',
+                 token_budget=None,
+                 usage_decay=0.9,
+                 merge_thresh=0.95,
+                 keep_first=True):
+        '''
+        Long-term memory of an AOT engine as one preallocated buffer per LSTT
+        layer entry (K, V, ...). Each memory frame owns a slot of token_num
+        rows, a new frame is written into the next free slot, or into a slot
+        chosen by the policy once the memory is full. Long-term attention does
+        not depend on the order of the memory tokens, so the valid frames are
+        always the contiguous prefix buffer[:num_frames * token_num].
+        Buffers start with room for init_len frames and double when full
+        (amortized O(token) inserts) until they reach the frame limit. The
+        buffers of one entry are views into a single storage stacked over the
+        layers, see stacked_views().
+        Arguments:
+            max_len: maximal number of memory frames
+            policy: one of POLICIES, what happens to a new frame once full
+            token_budget: maximal number of memory tokens, lowers the frame
+                limit to token_budget // token_num once the feature size is known
+            usage_decay: 'usage' / 'merge', decay of the running average of the
+                attention mass every frame receives
+            merge_thresh: 'merge', mean cosine similarity of the keys above which
+                a new frame is averaged into an existing one
+            keep_first: 'usage' / 'merge', never evict or merge into the first
+                frame (the reference frame with the given mask)
+        '''
+        assert policy in POLICIES, f'unknown long-term memory policy {policy}'
+        self.max_len = max(int(max_len), 1)
+        self.init_len = max(min(int(init_len), self.max_len), 1)
+        self.policy = policy
+        self.token_budget = token_budget
+        self.usage_decay = usage_decay
+        self.merge_thresh = merge_thresh
+        self.keep_first = keep_first
+        self.num_evictions = 0
+        self.num_merges = 0
+        # bumped on every change, lets callers cache tensors built from views()
+        self.version = 0
+        self.reset()
+
+    def reset(self):
+        self.version += 1
+        self.buffers = None
+        self.storage = None
+        self.token_num = None
+        self.capacity = 0
+        self.num_frames = 0
+        self.next_slot = 0
+        self.frame_steps = []
+        self.max_frames = self.max_len
+        # per slot: running attention mass relative to a uniform split (1.0),
+        # and number of frames averaged into the slot
+        self.usage = None
+        self.merge_counts = []
+
+    @property
+    def records_usage(self):
+        return self.policy != 'fifo'
+
+    def __len__(self):
+        return self.num_frames
+
+    def append(self, memories, frame_step=-1):
+        '''
+        Arguments:
+            memories: per LSTT layer, list of tensors (token_num, bs, c) or None
+            frame_step: frame the memory comes from
+        Return:
+            slot: index of the slot the frame was written / merged to
+        '''
+        self.version += 1
+        token_num = self._token_num(memories)
+        if self.buffers is None or token_num != self.token_num:
+            self.reset()
+            self.token_num = token_num
+            if self.token_budget is not None:
+                self.max_frames = max(min(self.max_len, self.token_budget // token_num), 1)
+            self._allocate(memories, min(self.init_len, self.max_frames))
+
+        if self.num_frames < self.max_frames:
+            slot = self.num_frames
+            if slot >= self.capacity:
+                self._grow(min(self.capacity * 2, self.max_frames))
+            self.num_frames += 1
+            self.frame_steps.append(frame_step)
+            self.merge_counts.append(1)
+            self.usage[slot] = 1.
+            self.write(slot, memories)
+        else:
+            slot, merge = self._select_slot(memories)
+            self.frame_steps[slot] = frame_step
+            if merge:
+                self.merge(slot, memories)
+            else:
+                self.merge_counts[slot] = 1
+                self.usage[slot] = 1.
+                self.write(slot, memories)
+                self.num_evictions += 1
+        self.next_slot = (slot + 1) % self.max_frames
+        return slot
+
+    def _select_slot(self, memories):
+        '''
+        Return:
+            slot: the slot the new frame replaces or is merged into
+            merge: bool
+        '''
+        if self.policy == 'fifo':
+            return self.next_slot, False
+        first = 1 if self.keep_first and self.num_frames > 1 else 0
+        if self.policy == 'merge':
+            similarity = self.similarity(memories)[first:]
+            best = int(torch.argmax(similarity))
+            if similarity[best] >= self.merge_thresh:
+                return first + best, True
+        return first + int(torch.argmin(self.usage[first:self.num_frames])), False
+
+    def similarity(self, memories):
+        '''
+        Return:
+            tensor (num_frames,), mean cosine similarity between the keys of the
+            new frame and of every stored frame at the same token positions
+            (a hovering camera produces aligned near duplicates), from the
+            deepest layer
+        '''
+        for layer_idx in reversed(range(len(memories))):
+            if memories[layer_idx][0] is not None:
+                break
+        key = memories[layer_idx][0]
+        stored = self.buffers[layer_idx][0][:self.num_frames * self.token_num]
+        stored = stored.view((self.num_frames, ) + tuple(key.shape))
+        similarity = (F.normalize(stored.float(), dim=-1) * F.normalize(key.float(), dim=-1)).sum(dim=-1)
+        return similarity.flatten(1).mean(dim=1)
+
+    def merge(self, slot, memories):
+        # running mean of all the frames merged into the slot
+        self.merge_counts[slot] += 1
+        weight = 1. / self.merge_counts[slot]
+        start, end = slot * self.token_num, (slot + 1) * self.token_num
+        for layer_buffers, layer_memories in zip(self.buffers, memories):
+            for buffer, memory in zip(layer_buffers, layer_memories):
+                if buffer is not None and memory is not None:
+                    buffer[start:end].lerp_(memory.to(buffer.dtype), weight)
+        self.num_merges += 1
+
+    def record_usage(self, layers, batch_idx=None):
+        '''
+        Context manager around one LSTT forward pass, accumulates the attention
+        mass the long-term attention of every layer puts on every memory frame.
+        Arguments:
+            layers: the LSTT blocks, each with a long_term_attn module that
+                returns (outputs, attn) with attn (bs, head, T_q, T_k). The
+                streaming / indexed attention returns attn None and leaves the
+                usage unchanged, 'usage' then degrades to evicting the slot
+                with the lowest recorded usage.
+            batch_idx: position of this memory in a batch of stacked (and
+                padded) memories, see AOTInferEngine(batched=True)
+        '''
+        if not self.records_usage or self.num_frames == 0:
+            return contextlib.nullcontext()
+        return _UsageRecorder(self, layers, batch_idx)
+
+    def observe_usage(self, frame_mass):
+        # frame_mass: tensor (num_frames,), attention mass of one frame summing to 1
+        n = self.num_frames
+        self.usage[:n].mul_(self.usage_decay).add_(frame_mass * n, alpha=1 - self.usage_decay)
+
+    def write(self, slot, memories):
+        start, end = slot * self.token_num, (slot + 1) * self.token_num
+        for layer_buffers, layer_memories in zip(self.buffers, memories):
+            for buffer, memory in zip(layer_buffers, layer_memories):
+                if buffer is not None and memory is not None:
+                    buffer[start:end].copy_(memory)
+
+    def views(self):
+        '''
+        Return:
+            per LSTT layer, list of contiguous views (num_frames * token_num, bs, c),
+            in the format LSTT_forward expects for long_term_memories
+        '''
+        if self.buffers is None:
+            return None
+        length = self.num_frames * self.token_num
+        return [[buffer[:length] if buffer is not None else None for buffer in layer_buffers]
+                for layer_buffers in self.buffers]
+
+    def stacked_views(self):
+        '''
+        Return:
+            per entry, view (num_layers, num_frames * token_num, bs, c) of the
+            storage or None, the tensorized layout of
+            networks.engines.compiled.PropagateStep
+        '''
+        if self.storage is None:
+            return None
+        length = self.num_frames * self.token_num
+        return tuple(storage[:, :length] if storage is not None else None for storage in self.storage)
+
+    def _token_num(self, memories):
+        for layer_memories in memories:
+            for memory in layer_memories:
+                if memory is not None:
+                    return memory.shape[0]
+        return 0
+
+    def _allocate(self, memories, capacity):
+        num_layers = len(memories)
+        self.storage = [
+            memory.new_empty((num_layers, capacity * self.token_num) + tuple(memory.shape[1:]))
+            if memory is not None else None for memory in memories[0]
+        ]
+        self._link_buffers(num_layers)
+        self.capacity = capacity
+        self.usage = torch.ones(capacity, device=self._device())
+
+    def _grow(self, capacity):
+        length = self.num_frames * self.token_num
+        for idx, storage in enumerate(self.storage):
+            if storage is None:
+                continue
+            new_storage = storage.new_empty((storage.shape[0], capacity * self.token_num) + tuple(storage.shape[2:]))
+            new_storage[:, :length].copy_(storage[:, :length])
+            self.storage[idx] = new_storage
+        self._link_buffers(len(self.buffers))
+        usage = torch.ones(capacity, device=self.usage.device)
+        usage[:self.num_frames] = self.usage[:self.num_frames]
+        self.usage = usage
+        self.capacity = capacity
+
+    def _link_buffers(self, num_layers):
+        # per layer views into the stacked storage, what write / merge / views use
+        self.buffers = [[storage[layer_idx] if storage is not None else None for storage in self.storage]
+                        for layer_idx in range(num_layers)]
+
+    def _device(self):
+        for layer_buffers in self.buffers:
+            for buffer in layer_buffers:
+                if buffer is not None:
+                    return buffer.device
+
+    def memory_bytes(self):
+        if self.buffers is None:
+            return 0
+        return sum(buffer.numel() * buffer.element_size()
+                   for layer_buffers in self.buffers for buffer in layer_buffers if buffer is not None)
+
+    def summary(self):
+        return 'long-term memory ({}): {} frames, {} evictions, {} merges, {:.1f} MB'.format(
+            self.policy, self.num_frames, self.num_evictions, self.num_merges, self.memory_bytes() / 1024**2)
+
+
+class _UsageRecorder():
+    def __init__(self, memory, layers, batch_idx=None):
+        self.memory = memory
+        self.layers = layers
+        self.batch_idx = batch_idx
+        self.handles = []
+        self.mass = None
+        self.count = 0
+
+    def __enter__(self):
+        self.handles = [layer.long_term_attn.register_forward_hook(self.hook) for layer in self.layers]
+        return self
+
+    def hook(self, module, inputs, outputs):
+        attn = outputs[1]
+        memory = self.memory
+        length = memory.num_frames * memory.token_num
+        if attn is not None and self.batch_idx is not None:
+            attn = attn[self.batch_idx:self.batch_idx + 1, ..., :length]
+        if attn is None or attn.shape[-1] != length:
+            return
+        mass = attn.detach().float().sum(dim=(0, 1, 2)).view(memory.num_frames, memory.token_num).sum(dim=1)
+        mass = mass / mass.sum().clamp(min=1e-6)
+        self.mass = mass if self.mass is None else self.mass + mass
+        self.count += 1
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        if self.count > 0:
+            self.memory.observe_usage(self.mass / self.count)
+
+
+def _legacy_update(long_term_memories, new_long_term_memories, max_len):
+    # the torch.cat prepend this class replaces, kept for the benchmark below
+    token_num = new_long_term_memories[0][0].shape[0]
+    updated = []
+    for new_memory, last_memory in zip(new_long_term_memories, long_term_memories):
+        updated_e = []
+        for new_e, last_e in zip(new_memory, last_memory):
+            if last_e.shape[0] >= max_len * token_num:
+                last_e = last_e[:(max_len - 1) * token_num]
+            updated_e.append(torch.cat([new_e, last_e], dim=0))
+        updated.append(updated_e)
+    return updated
+
+
+if __name__ == '__main__':
+    import time
+    # 3 LSTT layers, K / V of a 1/16 feature map of a 465x465 input
+    num_layers, token_num, channels, max_len, num_updates = 3, 30 * 30, 256, 64, 200
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    new = [[torch.randn(token_num, 1, channels, device=device) for _ in range(2)] for _ in range(num_layers)]
+    for name in ['torch.cat', 'ring buffer']:
+        memory = LongTermMemory(max_len)
+        legacy = new
+        latencies = []
+        for step in range(num_updates):
+            start = time.perf_counter()
+            if name == 'ring buffer':
+                memory.append(new, step)
+                memory.views()
+            else:
+                legacy = _legacy_update(legacy, new, max_len)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            latencies.append(time.perf_counter() - start)
+        first, last = sum(latencies[:10]) / 10 * 1000, sum(latencies[-10:]) / 10 * 1000
+        print(f'{name:12s} {device}: first 10 updates {first:7.3f} ms, last 10 updates {last:7.3f} ms')
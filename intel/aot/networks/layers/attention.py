@@ -19,6 +19,232 @@ def multiply_by_xchunks(x, y, chunks=1):
         return torch.cat([_x @ y for _x in x.chunk(chunks, dim=-2)], dim=-2)
 
 
+def streaming_attention(Q, K, V, chunk_size, key_bias=None, top_k=-1):
+    '''
+    softmax(Q @ K + key_bias) @ V over chunks of chunk_size memory tokens with
+    an online softmax, the [T_q, T_k] attention matrix is never materialized.
+    Arguments:
+        Q: (bs, head, T_q, d), already scaled
+        K: (bs, head, d, T_k)
+        V: (bs, head, T_k, d_v)
+        key_bias: None or (bs, head, 1, T_k), added to the scores of every query
+        top_k: > 0 keeps only the top_k scores of every query (running top-k
+            over the chunks)
+    Return:
+        (bs, head, T_q, d_v)
+    '''
+    T_k = K.size(-1)
+    if top_k > 0 and top_k < T_k:
+        return _streaming_top_k_attention(Q, K, V, chunk_size, key_bias, top_k)
+
+    max_score, denom, outputs = None, None, None
+    for start in range(0, T_k, chunk_size):
+        end = start + chunk_size
+        score = (Q @ K[..., start:end]).float()
+        if key_bias is not None:
+            score = score + key_bias[..., start:end]
+        chunk_max = score.amax(dim=-1, keepdim=True)
+        if max_score is None:
+            new_max = chunk_max
+        else:
+            new_max = torch.maximum(max_score, chunk_max)
+        prob = torch.exp(score - new_max)
+        chunk_outputs = (prob.to(V.dtype) @ V[:, :, start:end]).float()
+        if max_score is None:
+            denom = prob.sum(dim=-1, keepdim=True)
+            outputs = chunk_outputs
+        else:
+            rescale = torch.exp(max_score - new_max)
+            denom = denom * rescale + prob.sum(dim=-1, keepdim=True)
+            outputs = outputs * rescale + chunk_outputs
+        max_score = new_max
+    return (outputs / denom).to(V.dtype)
+
+
+def _streaming_top_k_attention(Q, K, V, chunk_size, key_bias, top_k):
+    top_score, top_idx = None, None
+    for start in range(0, K.size(-1), chunk_size):
+        end = start + chunk_size
+        score = (Q @ K[..., start:end]).float()
+        if key_bias is not None:
+            score = score + key_bias[..., start:end]
+        score, idx = torch.topk(score, k=min(top_k, score.size(-1)), dim=-1)
+        idx = idx + start
+        if top_score is not None:
+            score = torch.cat([top_score, score], dim=-1)
+            idx = torch.cat([top_idx, idx], dim=-1)
+            score, sel = torch.topk(score, k=min(top_k, score.size(-1)), dim=-1)
+            idx = torch.gather(idx, -1, sel)
+        top_score, top_idx = score, idx
+    attn = torch.softmax(top_score, dim=-1).to(V.dtype)
+    # (bs, head, T_q, top_k, d_v), only the selected values
+    bs, num_head, T_q, k = top_idx.size()
+    top_V = torch.gather(V.unsqueeze(2).expand(bs, num_head, T_q, -1, -1), 3,
+                         top_idx.unsqueeze(-1).expand(-1, -1, -1, -1, V.size(-1)))
+    return (attn.unsqueeze(-2) @ top_V).squeeze(-2)
+
+
+def indexed_attention(Q, K, V, block_size, top_blocks, chunk_size=-1, key_bias=None, top_k=-1):
+    '''
+    Retrieval attention over a coarse index of the memory: the memory tokens
+    are grouped in blocks of block_size consecutive tokens (one memory frame
+    holds several blocks), every block is summarized by its mean key, and
+    every head only attends to the top_blocks blocks the queries of the frame
+    weight most. The cost of the exact attention then stays at
+    T_q * top_blocks * block_size however large the memory grows, on top of
+    T_q * T_k / block_size for the index. The index is rebuilt on every call,
+    which costs T_k * d, negligible next to the attention itself.
+    Arguments:
+        Q, K, V, key_bias, top_k: see streaming_attention
+        chunk_size: > 0 streams the attention over the selected tokens
+    Return:
+        (bs, head, T_q, d_v)
+    '''
+    bs, num_head, d, T_k = K.size()
+    num_blocks = (T_k + block_size - 1) // block_size
+    if num_blocks <= top_blocks:
+        return _dense_or_streaming_attention(Q, K, V, chunk_size, key_bias, top_k)
+
+    # block mean keys, the last block may be partial
+    pad = num_blocks * block_size - T_k
+    padded_K = F.pad(K, (0, pad)) if pad > 0 else K
+    block_sums = padded_K.view(bs, num_head, d, num_blocks, block_size).sum(dim=-1)
+    block_lens = K.new_full((num_blocks, ), block_size)
+    block_lens[-1] = block_size - pad
+    centroids = block_sums / block_lens
+    coarse = torch.softmax((Q @ centroids).float(), dim=-1).sum(dim=2)
+    blocks = torch.topk(coarse, k=top_blocks, dim=-1)[1]
+
+    # token indices of the selected blocks, (bs, head, top_blocks * block_size)
+    idx = (blocks.unsqueeze(-1) * block_size +
+           torch.arange(block_size, device=K.device)).flatten(-2)
+    valid = idx < T_k
+    idx = idx.clamp(max=T_k - 1)
+    sel_K = torch.gather(K, -1, idx.unsqueeze(2).expand(-1, -1, d, -1))
+    sel_V = torch.gather(V, 2, idx.unsqueeze(-1).expand(-1, -1, -1, V.size(-1)))
+    sel_bias = torch.zeros(idx.size(), device=K.device).masked_fill_(~valid, float('-inf')).unsqueeze(2)
+    if key_bias is not None:
+        sel_bias = sel_bias + torch.gather(key_bias, -1, idx.unsqueeze(2))
+    return _dense_or_streaming_attention(Q, sel_K, sel_V, chunk_size, sel_bias, top_k)
+
+
+def _dense_or_streaming_attention(Q, K, V, chunk_size, key_bias, top_k):
+    if chunk_size > 0:
+        return streaming_attention(Q, K, V, chunk_size, key_bias, top_k)
+    QK = (Q @ K).float()
+    if key_bias is not None:
+        QK = QK + key_bias
+    if top_k > 0 and top_k < QK.size(-1):
+        top_QK, indices = torch.topk(QK, k=top_k, dim=-1)
+        attn = torch.zeros_like(QK).scatter_(-1, indices, torch.softmax(top_QK, dim=-1))
+    else:
+        attn = torch.softmax(QK, dim=-1)
+    return attn.to(V.dtype) @ V
+
+
+def memory_efficient_attention(module, Q, K, V):
+    '''
+    Inference path of the long-term attention modules when kv_chunk_size or
+    index_top_blocks is set, see streaming_attention / indexed_attention.
+    Return:
+        outputs: (bs, head, T_q, d_v)
+    '''
+    key_bias = None
+    if module.use_dis:
+        # 2 * QK - |K|^2 as (2 * Q) K plus a per-key bias
+        Q = Q * 2
+        key_bias = -K.pow(2).sum(dim=-2, keepdim=True).float()
+    if module.key_padding_bias is not None:
+        padding_bias = module.key_padding_bias.float()
+        key_bias = padding_bias if key_bias is None else key_bias + padding_bias
+    if module.index_top_blocks > 0:
+        return indexed_attention(Q, K, V, module.index_block_size, module.index_top_blocks,
+                                 module.kv_chunk_size, key_bias, module.top_k)
+    return streaming_attention(Q, K, V, module.kv_chunk_size, key_bias, module.top_k)
+
+
+def set_memory_efficient_attention(module, kv_chunk_size=-1, index_block_size=64, index_top_blocks=-1):
+    '''
+    Inference settings of a MultiheadAttention / GatedPropagation module.
+    Arguments:
+        kv_chunk_size: > 0 streams over chunks of this many memory tokens
+        index_block_size: tokens per block of the coarse memory index
+        index_top_blocks: > 0 only attends to this many blocks of the memory
+    '''
+    module.kv_chunk_size = kv_chunk_size
+    module.index_block_size = index_block_size
+    module.index_top_blocks = index_top_blocks
+
+
+# Short-term (local) attention backends:
+# 'corr': spatial_correlation_sampler, a CUDA extension
+# 'unfold': F.unfold copies of K with (2 * max_dis + 1)^2 entries per pixel, and
+#     local2global, a [h*w, h*w] attention map to aggregate V
+# 'window': loops over the window offsets on shifted views of the padded K / V,
+#     memory stays O(c * h * w), runs on CPU and GPU
+LOCAL_BACKENDS = ('corr', 'unfold', 'window')
+
+
+def window_correlation(q, k, max_dis, dilation=1):
+    '''
+    Same values as summing q against pad_and_unfold(k).
+    Arguments:
+        q, k: (B, c, h, w)
+    Return:
+        qk: (B, window_size * window_size, h, w), offsets in row-major order
+    '''
+    h, w = q.size()[-2:]
+    window_size = 2 * max_dis + 1
+    pad_pixel = max_dis * dilation
+    k = F.pad(k, (pad_pixel, pad_pixel, pad_pixel, pad_pixel), mode='constant', value=0)
+    qk = []
+    for idx in range(window_size * window_size):
+        dy, dx = idx // window_size * dilation, idx % window_size * dilation
+        qk.append((q * k[:, :, dy:dy + h, dx:dx + w]).sum(dim=1))
+    return torch.stack(qk, dim=1)
+
+
+def window_aggregate(local_attn, v, max_dis, dilation=1):
+    '''
+    Same values as local2global(local_attn) @ v, without the [h*w, h*w] map.
+    Arguments:
+        local_attn: (B, window_size * window_size, h, w)
+        v: (B, c, h, w)
+    Return:
+        (B, c, h, w)
+    '''
+    h, w = v.size()[-2:]
+    window_size = 2 * max_dis + 1
+    pad_pixel = max_dis * dilation
+    v = F.pad(v, (pad_pixel, pad_pixel, pad_pixel, pad_pixel), mode='constant', value=0)
+    local_attn = local_attn.to(v.dtype)
+    output = torch.zeros((v.size(0), v.size(1), h, w), dtype=v.dtype, device=v.device)
+    for idx in range(window_size * window_size):
+        dy, dx = idx // window_size * dilation, idx % window_size * dilation
+        output.addcmul_(local_attn[:, idx:idx + 1], v[:, :, dy:dy + h, dx:dx + w])
+    return output
+
+
+def set_local_backend(module, backend):
+    '''
+    Arguments:
+        module: MultiheadLocalAttentionV2 / LocalGatedPropagation
+        backend: one of LOCAL_BACKENDS
+    '''
+    assert backend in LOCAL_BACKENDS, f'unknown local attention backend {backend}'
+    if backend == 'corr' and not hasattr(module, 'correlation_sampler'):
+        from spatial_correlation_sampler import SpatialCorrelationSampler
+        module.correlation_sampler = SpatialCorrelationSampler(
+            kernel_size=1,
+            patch_size=module.window_size,
+            stride=1,
+            padding=0,
+            dilation=1,
+            dilation_patch=module.dilation)
+    module.enable_corr = backend == 'corr'
+    module.backend = backend
+
+
 # Long-term attention
 class MultiheadAttention(nn.Module):
     def __init__(self,
@@ -38,6 +264,10 @@ class MultiheadAttention(nn.Module):
         self.qk_chunks = qk_chunks
         self.max_mem_len_ratio = float(max_mem_len_ratio)
         self.top_k = top_k
+        set_memory_efficient_attention(self)
+        # (bs, 1, 1, T_k) added to the scores, masks the padding of memories
+        # of different lengths stacked in one batch, see long_term_key_padding
+        self.key_padding_bias = None
 
         self.hidden_dim = d_model // num_head
         self.d_att = self.hidden_dim if d_att is None else d_att
@@ -86,25 +316,32 @@ class MultiheadAttention(nn.Module):
         K = K.view(-1, bs, num_head, self.d_att).permute(1, 2, 3, 0)
         V = V.view(-1, bs, num_head, hidden_dim).permute(1, 2, 0, 3)
 
-        # Multiplication
-        QK = multiply_by_ychunks(Q, K, self.qk_chunks)
-        if self.use_dis:
-            QK = 2 * QK - K.pow(2).sum(dim=-2, keepdim=True)
-
-        # Activation
-        if not self.training and self.top_k > 0 and self.top_k < QK.size()[-1]:
-            top_QK, indices = torch.topk(QK, k=self.top_k, dim=-1)
-            top_attn = torch.softmax(top_QK, dim=-1)
-            attn = torch.zeros_like(QK).scatter_(-1, indices, top_attn)
+        if not self.training and (self.kv_chunk_size > 0 or self.index_top_blocks > 0):
+            # no attention matrix to return
+            attn = None
+            outputs = memory_efficient_attention(self, Q, K, V).permute(2, 0, 1, 3)
         else:
-            attn = torch.softmax(QK, dim=-1)
+            # Multiplication
+            QK = multiply_by_ychunks(Q, K, self.qk_chunks)
+            if self.use_dis:
+                QK = 2 * QK - K.pow(2).sum(dim=-2, keepdim=True)
+            if self.key_padding_bias is not None:
+                QK = QK + self.key_padding_bias.to(QK.dtype)
+
+            # Activation
+            if not self.training and self.top_k > 0 and self.top_k < QK.size()[-1]:
+                top_QK, indices = torch.topk(QK, k=self.top_k, dim=-1)
+                top_attn = torch.softmax(top_QK, dim=-1)
+                attn = torch.zeros_like(QK).scatter_(-1, indices, top_attn)
+            else:
+                attn = torch.softmax(QK, dim=-1)
 
-        # Dropouts
-        attn = self.dropout(attn)
+            # Dropouts
+            attn = self.dropout(attn)
 
-        # Weighted sum
-        outputs = multiply_by_xchunks(attn, V,
-                                      self.qk_chunks).permute(2, 0, 1, 3)
+            # Weighted sum
+            outputs = multiply_by_xchunks(attn, V,
+                                          self.qk_chunks).permute(2, 0, 1, 3)
 
         # Restore shape
         outputs = outputs.reshape(-1, bs, self.d_model)
@@ -277,6 +514,7 @@ class MultiheadLocalAttentionV2(nn.Module):
             ]))
 
         self.enable_corr = enable_corr
+        self.backend = 'corr' if enable_corr else 'unfold'
 
         if enable_corr:
             from spatial_correlation_sampler import SpatialCorrelationSampler
@@ -330,9 +568,12 @@ class MultiheadLocalAttentionV2(nn.Module):
                                          self.window_size * self.window_size,
                                          h * w)
 
-        if self.enable_corr:
+        if self.backend == 'corr':
             qk = self.correlation_sampler(q, k).view(
                 n, self.num_head, self.window_size * self.window_size, h * w)
+        elif self.backend == 'window':
+            qk = window_correlation(q, k, self.max_dis, self.dilation).view(
+                n, self.num_head, self.window_size * self.window_size, h * w)
         else:
             unfolded_k = self.pad_and_unfold(k).view(
                 n * self.num_head, hidden_dim,
@@ -356,9 +597,16 @@ class MultiheadLocalAttentionV2(nn.Module):
         agg_bias = torch.einsum('bhwn,hcw->bhnc', local_attn,
                                 self.relative_emb_v)
 
-        global_attn = self.local2global(local_attn, h, w)
+        if self.backend == 'window':
+            agg_value = window_aggregate(
+                local_attn.view(n * self.num_head, -1, h, w),
+                v.view(n * self.num_head, hidden_dim, h, w), self.max_dis,
+                self.dilation).view(n, self.num_head, hidden_dim,
+                                    h * w).transpose(-2, -1)
+        else:
+            global_attn = self.local2global(local_attn, h, w)
 
-        agg_value = (global_attn @ v.transpose(-2, -1))
+            agg_value = (global_attn @ v.transpose(-2, -1))
 
         output = (agg_value + agg_bias).permute(2, 0, 1,
                                                 3).reshape(h * w, n, c)
@@ -602,6 +850,10 @@ class GatedPropagation(nn.Module):
         self.qk_chunks = qk_chunks
         self.max_mem_len_ratio = float(max_mem_len_ratio)
         self.top_k = top_k
+        set_memory_efficient_attention(self)
+        # (bs, 1, 1, T_k) added to the scores, masks the padding of memories
+        # of different lengths stacked in one batch, see long_term_key_padding
+        self.key_padding_bias = None
 
         self.hidden_dim = self.expand_d_vu // num_head
         self.d_att = d_qk // num_head if d_att is None else d_att
@@ -675,25 +927,32 @@ class GatedPropagation(nn.Module):
         K = K.view(-1, bs, num_head, self.d_att).permute(1, 2, 3, 0)
         V = V.view(-1, bs, num_head, hidden_dim).permute(1, 2, 0, 3)
 
-        # Multiplication
-        QK = multiply_by_ychunks(Q, K, self.qk_chunks)
-        if self.use_dis:
-            QK = 2 * QK - K.pow(2).sum(dim=-2, keepdim=True)
-
-        # Activation
-        if not self.training and self.top_k > 0 and self.top_k < QK.size()[-1]:
-            top_QK, indices = torch.topk(QK, k=self.top_k, dim=-1)
-            top_attn = linear_gate(top_QK, dim=-1)
-            attn = torch.zeros_like(QK).scatter_(-1, indices, top_attn)
+        if not self.training and (self.kv_chunk_size > 0 or self.index_top_blocks > 0):
+            # linear_gate is a softmax, no attention matrix to return
+            attn = None
+            outputs = memory_efficient_attention(self, Q, K, V).permute(2, 0, 1, 3)
         else:
-            attn = linear_gate(QK, dim=-1)
+            # Multiplication
+            QK = multiply_by_ychunks(Q, K, self.qk_chunks)
+            if self.use_dis:
+                QK = 2 * QK - K.pow(2).sum(dim=-2, keepdim=True)
+            if self.key_padding_bias is not None:
+                QK = QK + self.key_padding_bias.to(QK.dtype)
+
+            # Activation
+            if not self.training and self.top_k > 0 and self.top_k < QK.size()[-1]:
+                top_QK, indices = torch.topk(QK, k=self.top_k, dim=-1)
+                top_attn = linear_gate(top_QK, dim=-1)
+                attn = torch.zeros_like(QK).scatter_(-1, indices, top_attn)
+            else:
+                attn = linear_gate(QK, dim=-1)
 
-        # Dropouts
-        attn = self.dropout(attn)
+            # Dropouts
+            attn = self.dropout(attn)
 
-        # Weighted sum
-        outputs = multiply_by_xchunks(attn, V,
-                                      self.qk_chunks).permute(2, 0, 1, 3)
+            # Weighted sum
+            outputs = multiply_by_xchunks(attn, V,
+                                          self.qk_chunks).permute(2, 0, 1, 3)
 
         # Restore shape
         outputs = outputs.reshape(l, bs, -1) * U
@@ -756,6 +1015,7 @@ class LocalGatedPropagation(nn.Module):
                                         groups=num_head)
 
         self.enable_corr = enable_corr
+        self.backend = 'corr' if enable_corr else 'unfold'
 
         if enable_corr:
             from spatial_correlation_sampler import SpatialCorrelationSampler
@@ -816,9 +1076,12 @@ class LocalGatedPropagation(nn.Module):
                                          self.window_size * self.window_size,
                                          h * w)
 
-        if self.enable_corr:
+        if self.backend == 'corr':
             qk = self.correlation_sampler(q, k).view(
                 n, self.num_head, self.window_size * self.window_size, h * w)
+        elif self.backend == 'window':
+            qk = window_correlation(q, k, self.max_dis, self.dilation).view(
+                n, self.num_head, self.window_size * self.window_size, h * w)
         else:
             unfolded_k = self.pad_and_unfold(k).view(
                 n * self.num_head, self.d_att,
@@ -839,10 +1102,18 @@ class LocalGatedPropagation(nn.Module):
 
         local_attn = self.dropout(local_attn)
 
-        global_attn = self.local2global(local_attn, h, w)
+        if self.backend == 'window':
+            agg_value = window_aggregate(
+                local_attn.view(n * self.num_head, -1, h, w),
+                v.view(n * self.num_head, hidden_dim, h, w), self.max_dis,
+                self.dilation).view(n, self.num_head, hidden_dim,
+                                    h * w).permute(3, 0, 1, 2).reshape(
+                                        h * w, n, -1)
+        else:
+            global_attn = self.local2global(local_attn, h, w)
 
-        agg_value = (global_attn @ v.transpose(-2, -1)).permute(
-            2, 0, 1, 3).reshape(h * w, n, -1)
+            agg_value = (global_attn @ v.transpose(-2, -1)).permute(
+                2, 0, 1, 3).reshape(h * w, n, -1)
 
         output = agg_value * u
 
@@ -903,3 +1174,73 @@ class LocalGatedPropagation(nn.Module):
                      stride=(1, 1),
                      dilation=self.dilation)
         return x
+
+
+def _benchmark_long_term(device, repeats=3):
+    # per-frame cost of the long-term attention of one layer as the memory
+    # grows, 30x30 tokens per frame, 8 heads, 256 channels
+    import time
+    torch.manual_seed(0)
+    token_num, channels = 30 * 30, 256
+    settings = [('dense', {}), ('streaming', {'kv_chunk_size': 4096}),
+                ('indexed', {'index_block_size': 64, 'index_top_blocks': 64})]
+    attn = MultiheadAttention(channels, 8, use_linear=False).to(device).eval()
+    Q = torch.randn(token_num, 1, channels, device=device)
+    for num_frames in [4, 16, 64]:
+        K = torch.randn(token_num * num_frames, 1, channels, device=device)
+        V = torch.randn(token_num * num_frames, 1, channels, device=device)
+        for name, kwargs in settings:
+            set_memory_efficient_attention(attn, **kwargs)
+            with torch.no_grad():
+                attn(Q, K, V)
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    attn(Q, K, V)
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+            latency = (time.perf_counter() - start) / repeats * 1000
+            print(f'{num_frames:3d} memory frames, {name:9s} {device}: {latency:8.2f} ms')
+
+
+def _benchmark_local(device, repeats=3):
+    # short-term attention of one layer on the 1/16 feature map of 480p and
+    # 720p frames, AOT (MultiheadLocalAttentionV2, 8 heads) and DeAOT
+    # (LocalGatedPropagation, 1 head)
+    import time
+    torch.manual_seed(0)
+    backends = ['unfold', 'window']
+    try:
+        import spatial_correlation_sampler
+        if device == 'cuda':
+            backends.append('corr')
+    except ImportError:
+        pass
+    for name, size_2d in [('480p', (30, 54)), ('720p', (45, 80))]:
+        h, w = size_2d
+        aot = MultiheadLocalAttentionV2(256, 8, use_linear=False, enable_corr=False).to(device).eval()
+        deaot = LocalGatedPropagation(256, 512, 1, use_linear=False, enable_corr=False, d_att=128).to(device).eval()
+        aot_inputs = [torch.randn(1, 256, h, w, device=device) for _ in range(3)]
+        deaot_inputs = [torch.randn(1, 128, h, w, device=device), torch.randn(1, 128, h, w, device=device),
+                        torch.randn(1, 1024, h, w, device=device), torch.randn(h * w, 1, 1024, device=device), size_2d]
+        for model_name, module, inputs in [('aot', aot, aot_inputs), ('deaot', deaot, deaot_inputs)]:
+            for backend in backends:
+                set_local_backend(module, backend)
+                with torch.no_grad():
+                    module(*inputs)
+                    if device == 'cuda':
+                        torch.cuda.synchronize()
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        module(*inputs)
+                    if device == 'cuda':
+                        torch.cuda.synchronize()
+                latency = (time.perf_counter() - start) / repeats * 1000
+                print(f'{name} {model_name:5s} local attention, {backend:6s} {device}: {latency:8.2f} ms')
+
+
+if __name__ == '__main__':
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    _benchmark_long_term(device)
+    _benchmark_local(device)
@@ -92,6 +92,51 @@ def seq_to_2d(tensor, size_2d):
     return tensor
 
 
+def conv_from_label(conv, label):
+    '''
+    conv(one_hot(label)) without building the one-hot tensor: the output at
+    every position is the bias plus the kernel taps W[:, label(p), ky, kx] of
+    its window, summed with embedding_bag over a cached tap table. Labels
+    outside 0..in_channels-1 and the padding add nothing, as in the one-hot.
+    Arguments:
+        conv: nn.Conv2d, in_channels is the number of labels, no dilation / groups
+        label: tensor (bs,1,h,w) or (bs,h,w) of integer labels, any dtype
+    Return:
+        tensor (bs,out_channels,h',w'), conv(one_hot_mask(label, in_channels - 1))
+    '''
+    if label.dim() == 4:
+        label = label.squeeze(1)
+    kh, kw = conv.kernel_size
+    sh, sw = conv.stride
+    ph, pw = conv.padding
+    num_labels = conv.in_channels
+    taps = kh * kw
+
+    weight = conv.weight
+    key = (weight.data_ptr(), weight._version, weight.dtype)
+    cache = getattr(conv, '_label_table', None)
+    if cache is None or cache[0] != key:
+        # row label * taps + tap, followed by one zero row per tap for invalid labels
+        table = torch.cat([weight.detach().permute(1, 2, 3, 0).reshape(num_labels * taps, -1),
+                           weight.new_zeros(taps, weight.size(0))])
+        cache = (key, table)
+        conv._label_table = cache
+    table = cache[1]
+
+    label = label.to(torch.int32)
+    label = label.masked_fill((label < 0) | (label >= num_labels), num_labels)
+    if ph > 0 or pw > 0:
+        label = F.pad(label, (pw, pw, ph, ph), value=num_labels)
+    windows = label.unfold(1, kh, sh).unfold(2, kw, sw)
+    bs, out_h, out_w = windows.shape[:3]
+    index = windows * taps + torch.arange(taps, dtype=torch.int32, device=label.device).view(kh, kw)
+    emb = F.embedding_bag(index.reshape(-1, taps), table, mode='sum')
+    emb = emb.view(bs, out_h, out_w, -1).permute(0, 3, 1, 2)
+    if conv.bias is not None:
+        emb = emb + conv.bias.view(1, -1, 1, 1)
+    return emb
+
+
 def drop_path(x, drop_prob: float = 0., training: bool = False):
     if drop_prob == 0. or not training:
         return x
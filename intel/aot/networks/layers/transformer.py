@@ -1,9 +1,10 @@
+import contextlib
 import torch
 import torch.nn.functional as F
 from torch import nn
 
 from networks.layers.basic import DropPath, GroupNorm1D, GNActDWConv2d, seq_to_2d, ScaleOffset, mask_out
-from networks.layers.attention import silu, MultiheadAttention, MultiheadLocalAttentionV2, MultiheadLocalAttentionV3, GatedPropagation, LocalGatedPropagation
+from networks.layers.attention import silu, MultiheadAttention, MultiheadLocalAttentionV2, MultiheadLocalAttentionV3, GatedPropagation, LocalGatedPropagation, set_memory_efficient_attention, set_local_backend
 
 
 def _get_norm(indim, type='ln', groups=8):
@@ -275,22 +276,21 @@ class LongShortTermTransformerBlock(nn.Module):
                                                  use_linear=False,
                                                  dropout=lt_dropout)
 
-        # MultiheadLocalAttention = MultiheadLocalAttentionV2 if enable_corr else MultiheadLocalAttentionV3
+        # without the correlation sampler, MultiheadLocalAttentionV2 runs the
+        # 'unfold' or 'window' backend, see set_local_attention
         if enable_corr:
             try:
                 import spatial_correlation_sampler
-                MultiheadLocalAttention = MultiheadLocalAttentionV2
             except Exception as inst:
                 print(inst)
                 print("Failed to import PyTorch Correlation, For better efficiency, please install it.")
-                MultiheadLocalAttention = MultiheadLocalAttentionV3
-        else:
-            MultiheadLocalAttention = MultiheadLocalAttentionV3
-        self.short_term_attn = MultiheadLocalAttention(d_model,
-                                                       att_nhead,
-                                                       dilation=local_dilation,
-                                                       use_linear=False,
-                                                       dropout=st_dropout)
+                enable_corr = False
+        self.short_term_attn = MultiheadLocalAttentionV2(d_model,
+                                                         att_nhead,
+                                                         dilation=local_dilation,
+                                                         use_linear=False,
+                                                         enable_corr=enable_corr,
+                                                         dropout=st_dropout)
         self.lst_dropout = nn.Dropout(max(lt_dropout, st_dropout), True)
         self.droppath_lst = droppath_lst
 
@@ -408,22 +408,21 @@ class LongShortTermTransformerBlockV2(nn.Module):
                                                  use_linear=False,
                                                  dropout=lt_dropout)
 
-        # MultiheadLocalAttention = MultiheadLocalAttentionV2 if enable_corr else MultiheadLocalAttentionV3
+        # without the correlation sampler, MultiheadLocalAttentionV2 runs the
+        # 'unfold' or 'window' backend, see set_local_attention
         if enable_corr:
             try:
                 import spatial_correlation_sampler
-                MultiheadLocalAttention = MultiheadLocalAttentionV2
             except Exception as inst:
                 print(inst)
                 print("Failed to import PyTorch Correlation, For better efficiency, please install it.")
-                MultiheadLocalAttention = MultiheadLocalAttentionV3
-        else:
-            MultiheadLocalAttention = MultiheadLocalAttentionV3
-        self.short_term_attn = MultiheadLocalAttention(d_model,
-                                                       att_nhead,
-                                                       dilation=local_dilation,
-                                                       use_linear=False,
-                                                       dropout=st_dropout)
+                enable_corr = False
+        self.short_term_attn = MultiheadLocalAttentionV2(d_model,
+                                                         att_nhead,
+                                                         dilation=local_dilation,
+                                                         use_linear=False,
+                                                         enable_corr=enable_corr,
+                                                         dropout=st_dropout)
         self.lst_dropout = nn.Dropout(max(lt_dropout, st_dropout), True)
         self.droppath_lst = droppath_lst
 
@@ -688,3 +687,52 @@ class GatedPropagationModule(nn.Module):
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
+
+
+def set_long_term_attention(lstt, kv_chunk_size=-1, index_block_size=64, index_top_blocks=-1):
+    '''
+    Inference settings of the long-term attention of every LSTT layer, see
+    networks.layers.attention.set_memory_efficient_attention. The defaults
+    restore the dense attention.
+    Arguments:
+        lstt: LongShortTermTransformer / DualBranchGPM (model.LSTT)
+    '''
+    for layer in lstt.layers:
+        set_memory_efficient_attention(layer.long_term_attn, kv_chunk_size,
+                                       index_block_size, index_top_blocks)
+
+
+def set_local_attention(lstt, backend='auto'):
+    '''
+    Backend of the short-term (local) attention of every LSTT layer.
+    Arguments:
+        lstt: LongShortTermTransformer / DualBranchGPM (model.LSTT)
+        backend: 'auto' ('corr' when spatial_correlation_sampler is installed,
+            else 'window'), or one of networks.layers.attention.LOCAL_BACKENDS
+    '''
+    if backend == 'auto':
+        try:
+            import spatial_correlation_sampler
+            backend = 'corr'
+        except ImportError:
+            backend = 'window'
+    for layer in lstt.layers:
+        set_local_backend(layer.short_term_attn, backend)
+
+
+@contextlib.contextmanager
+def long_term_key_padding(lstt, key_padding_bias):
+    '''
+    Mask padded memory tokens in the long-term attention of every LSTT layer
+    during one forward pass.
+    Arguments:
+        key_padding_bias: None or tensor (bs, 1, 1, T_k), 0 for valid tokens
+            and a large negative value for padding
+    '''
+    for layer in lstt.layers:
+        layer.long_term_attn.key_padding_bias = key_padding_bias
+    try:
+        yield
+    finally:
+        for layer in lstt.layers:
+            layer.long_term_attn.key_padding_bias = None
@@ -18,6 +18,7 @@ from utils.eval import zip_folder
 
 from networks.models import build_vos_model
 from networks.engines import build_engine
+from networks.layers.transformer import set_long_term_attention
 
 
 class Evaluator(object):
@@ -37,6 +38,10 @@ class Evaluator(object):
 
         self.print_log('Build VOS model.')
         self.model = build_vos_model(cfg.MODEL_VOS, cfg).cuda(self.gpu)
+        set_long_term_attention(self.model.LSTT,
+                                cfg.TEST_LONG_TERM_ATTN_CHUNK,
+                                cfg.TEST_LONG_TERM_ATTN_INDEX_BLOCK,
+                                cfg.TEST_LONG_TERM_ATTN_INDEX_TOP_BLOCKS)
 
         self.process_pretrained_model()
 
@@ -279,7 +284,17 @@ class Evaluator(object):
                                              long_term_mem_gap=self.cfg.
                                              TEST_LONG_TERM_MEM_GAP,
                                              short_term_mem_skip=self.cfg.
-                                             TEST_SHORT_TERM_MEM_SKIP))
+                                             TEST_SHORT_TERM_MEM_SKIP,
+                                             max_len_long_term=self.cfg.
+                                             TEST_LONG_TERM_MEM_MAX_LEN,
+                                             long_term_memory_args={
+                                                 'policy':
+                                                 self.cfg.TEST_LONG_TERM_MEM_POLICY,
+                                                 'token_budget':
+                                                 self.cfg.TEST_LONG_TERM_MEM_TOKEN_BUDGET
+                                             },
+                                             batched=self.cfg.
+                                             TEST_BATCH_SUB_ENGINES))
                             all_engines[-1].eval()
 
                         if aug_num > 1:  # if use test-time augmentation
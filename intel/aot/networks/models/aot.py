@@ -1,9 +1,10 @@
 import torch.nn as nn
 
 from networks.encoders import build_encoder
-from networks.layers.transformer import LongShortTermTransformer
+from networks.layers.transformer import LongShortTermTransformer, set_local_attention
 from networks.decoders import build_decoder
 from networks.layers.position import PositionEmbeddingSine
+from networks.layers.basic import conv_from_label
 
 
 class AOT(nn.Module):
@@ -33,6 +34,7 @@ class AOT(nn.Module):
             droppath_scaling=cfg.TRAIN_LSTT_DROPPATH_SCALING,
             intermediate_norm=cfg.MODEL_DECODER_INTERMEDIATE_LSTT,
             return_intermediate=True)
+        set_local_attention(self.LSTT, cfg.MODEL_LOCAL_ATTN)
 
         decoder_indim = cfg.MODEL_ENCODER_EMBEDDING_DIM * \
             (cfg.MODEL_LSTT_NUM +
@@ -73,8 +75,9 @@ class AOT(nn.Module):
         pos_emb = self.pos_generator(x)
         return pos_emb
 
-    def get_id_emb(self, x):
-        id_emb = self.patch_wise_id_bank(x)
+    def get_id_emb(self, x, label=False):
+        # label: x is a label map (bs,1,h,w) instead of a one-hot mask
+        id_emb = conv_from_label(self.patch_wise_id_bank, x) if label else self.patch_wise_id_bank(x)
         id_emb = self.id_dropout(id_emb)
         return id_emb
 
@@ -1,6 +1,8 @@
 import torch.nn as nn
 
-from networks.layers.transformer import DualBranchGPM
+from networks.layers.basic import conv_from_label
+
+from networks.layers.transformer import DualBranchGPM, set_local_attention
 from networks.models.aot import AOT
 from networks.decoders import build_decoder
 
@@ -22,6 +24,7 @@ class DeAOT(AOT):
             droppath_scaling=cfg.TRAIN_LSTT_DROPPATH_SCALING,
             intermediate_norm=cfg.MODEL_DECODER_INTERMEDIATE_LSTT,
             return_intermediate=True)
+        set_local_attention(self.LSTT, cfg.MODEL_LOCAL_ATTN)
 
         decoder_indim = cfg.MODEL_ENCODER_EMBEDDING_DIM * \
             (cfg.MODEL_LSTT_NUM * 2 +
@@ -48,8 +51,8 @@ class DeAOT(AOT):
         pred_logit = self.decoder(decoder_inputs, shortcuts)
         return pred_logit
 
-    def get_id_emb(self, x):
-        id_emb = self.patch_wise_id_bank(x)
+    def get_id_emb(self, x, label=False):
+        id_emb = conv_from_label(self.patch_wise_id_bank, x) if label else self.patch_wise_id_bank(x)
         id_emb = self.id_norm(id_emb.permute(2, 3, 0, 1)).permute(2, 3, 0, 1)
         id_emb = self.id_dropout(id_emb)
         return id_emb
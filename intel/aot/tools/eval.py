@@ -34,6 +34,14 @@ def main():
     parser.add_argument('--lstt_num', type=int, default=-1)
     parser.add_argument('--lt_gap', type=int, default=-1)
     parser.add_argument('--st_skip', type=int, default=-1)
+    parser.add_argument('--lt_max_len', type=int, default=-1)
+    parser.add_argument('--lt_policy', type=str, default='')
+    parser.add_argument('--lt_token_budget', type=int, default=-1)
+    parser.add_argument('--lt_attn_chunk', type=int, default=-1)
+    parser.add_argument('--lt_attn_top_blocks', type=int, default=-1)
+    parser.add_argument('--local_attn', type=str, default='')
+    parser.add_argument('--batch_engines', action='store_true')
+    parser.set_defaults(batch_engines=False)
     parser.add_argument('--max_id_num', type=int, default='-1')
 
     parser.add_argument('--gpu_id', type=int, default=0)
@@ -73,6 +81,20 @@ def main():
         cfg.TEST_LONG_TERM_MEM_GAP = args.lt_gap
     if args.st_skip > 0:
         cfg.TEST_SHORT_TERM_MEM_SKIP = args.st_skip
+    if args.lt_max_len > 0:
+        cfg.TEST_LONG_TERM_MEM_MAX_LEN = args.lt_max_len
+    if args.lt_policy != '':
+        cfg.TEST_LONG_TERM_MEM_POLICY = args.lt_policy
+    if args.lt_token_budget > 0:
+        cfg.TEST_LONG_TERM_MEM_TOKEN_BUDGET = args.lt_token_budget
+    if args.lt_attn_chunk > 0:
+        cfg.TEST_LONG_TERM_ATTN_CHUNK = args.lt_attn_chunk
+    if args.lt_attn_top_blocks > 0:
+        cfg.TEST_LONG_TERM_ATTN_INDEX_TOP_BLOCKS = args.lt_attn_top_blocks
+    if args.local_attn != '':
+        cfg.MODEL_LOCAL_ATTN = args.local_attn
+    if args.batch_engines:
+        cfg.TEST_BATCH_SUB_ENGINES = True
 
     if args.max_id_num > 0:
         cfg.MODEL_MAX_OBJ_NUM = args.max_id_num
@@ -0,0 +1,100 @@
+import importlib
+import os
+import sys
+
+sys.path.append('.')
+sys.path.append('..')
+
+import numpy as np
+from PIL import Image
+import torch
+
+from networks.managers.evaluator import Evaluator
+
+# Accuracy against long-term memory size: runs the evaluator on a DAVIS split
+# once per (policy, max_len) and scores the written masks with the region
+# similarity J (mean IoU per object) against the DAVIS annotations.
+
+
+def davis_region_similarity(result_root, label_root, seqs, single_obj=False):
+    '''
+    Arguments:
+        result_root: Annotations/480p folder written by the evaluator
+        label_root: DAVIS Annotations/480p folder
+        seqs: sequence names to score
+        single_obj: DAVIS 2016, every labelled pixel is object 1
+    Return:
+        mean J over all objects, first and last frames excluded as in the
+        DAVIS benchmark
+    '''
+    scores = []
+    for seq in seqs:
+        names = sorted(os.listdir(os.path.join(label_root, seq)))[1:-1]
+        if len(names) == 0:
+            continue
+        gts = np.stack([np.array(Image.open(os.path.join(label_root, seq, name))) for name in names])
+        preds = np.stack([np.array(Image.open(os.path.join(result_root, seq, name))) for name in names])
+        if single_obj:
+            gts = (gts > 0).astype(np.uint8)
+        for obj_id in np.unique(gts[gts > 0]):
+            gt, pred = gts == obj_id, preds == obj_id
+            union = np.logical_or(gt, pred).sum(axis=(1, 2))
+            inter = np.logical_and(gt, pred).sum(axis=(1, 2))
+            # frames where the object is absent and not predicted count as 1
+            iou = np.where(union > 0, inter / np.maximum(union, 1), 1.)
+            scores.append(iou.mean())
+    return float(np.mean(scores)) if len(scores) > 0 else 0.
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Long-term memory sweep")
+    parser.add_argument('--stage', type=str, default='pre_ytb_dav')
+    parser.add_argument('--model', type=str, default='r50_deaotl')
+    parser.add_argument('--ckpt_path', type=str, required=True)
+    parser.add_argument('--dataset', type=str, default='davis2017')
+    parser.add_argument('--split', type=str, default='val')
+    parser.add_argument('--gpu_id', type=int, default=0)
+    parser.add_argument('--lt_gap', type=int, default=-1)
+    parser.add_argument('--policies', nargs='+', type=str, default=['fifo', 'usage', 'merge'])
+    parser.add_argument('--max_lens', nargs='+', type=int, default=[2, 4, 8, 16])
+    args = parser.parse_args()
+
+    if 'davis' not in args.dataset:
+        print('Only the DAVIS datasets ship annotations for every frame.')
+        exit()
+
+    engine_config = importlib.import_module('configs.' + args.stage)
+    results = []
+    for max_len in args.max_lens:
+        for policy in args.policies:
+            exp_name = '{}_lt_{}_{}'.format(args.model, policy, max_len)
+            cfg = engine_config.EngineConfig(exp_name, args.model)
+            cfg.TEST_GPU_ID = args.gpu_id
+            cfg.TEST_CKPT_PATH = args.ckpt_path
+            cfg.TEST_DATASET = args.dataset
+            cfg.TEST_DATASET_SPLIT = args.split
+            if args.lt_gap > 0:
+                cfg.TEST_LONG_TERM_MEM_GAP = args.lt_gap
+            cfg.TEST_LONG_TERM_MEM_MAX_LEN = max_len
+            cfg.TEST_LONG_TERM_MEM_POLICY = policy
+
+            torch.cuda.reset_peak_memory_stats(args.gpu_id)
+            evaluator = Evaluator(cfg=cfg)
+            evaluator.evaluating()
+            max_mem = torch.cuda.max_memory_allocated(args.gpu_id) / 1024.**3
+
+            resolution = 'Full-Resolution' if cfg.TEST_DATASET_FULL_RESOLUTION else '480p'
+            label_root = os.path.join(cfg.DIR_DAVIS, 'Annotations', resolution)
+            j_mean = davis_region_similarity(evaluator.result_root, label_root,
+                                             evaluator.dataset.seqs,
+                                             single_obj=args.dataset == 'davis2016')
+            results.append((policy, max_len, j_mean, max_mem))
+
+    print('{:8s} {:>8s} {:>8s} {:>10s}'.format('policy', 'max_len', 'J', 'Max Mem'))
+    for policy, max_len, j_mean, max_mem in results:
+        print('{:8s} {:8d} {:8.4f} {:9.2f}G'.format(policy, max_len, j_mean, max_mem))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,10 @@ import torch.nn.functional as F
 import os
 import sys
 sys.path.append("./aot")
-from aot.networks.engines.aot_engine import AOTEngine,AOTInferEngine
+from aot.networks.engines.aot_engine import AOTEngine,AOTInferEngine,MultiVideoInferEngine
 from aot.networks.engines.deaot_engine import DeAOTEngine,DeAOTInferEngine
 import importlib
+import copy
 import numpy as np
 from PIL import Image
 from skimage.morphology.binary import binary_dilation
@@ -20,25 +21,73 @@ import aot.dataloaders.video_transforms as tr
 from aot.utils.checkpoint import load_network
 from aot.networks.models import build_vos_model
 from aot.networks.engines import build_engine
+from aot.networks.engines.compiled import compile_inference
+from aot.networks.layers.transformer import set_long_term_attention
 from torchvision import transforms
+from tool.device import resolve_device, channels_last
+from tool.feature_cache import FeatureCache
+
+UPSAMPLE_MODES = ('logits', 'nearest', 'present')
+
+
+def upsample_label(pred_logit, output_size, mode='present', align_corners=False):
+    '''
+    Label map at output_size from decoder resolution logits.
+    Arguments:
+        pred_logit: tensor (1,c,h,w) at decoder resolution
+        output_size: (height, width)
+        mode:
+            'logits': interpolate all c channels, then argmax (previous behavior)
+            'nearest': argmax at decoder resolution, nearest upsampling of the labels
+            'present': interpolate only the channels of labels that win somewhere
+                at decoder resolution, then argmax, so object edges are still
+                decided on bilinear logits
+    Return:
+        pred_label: float tensor (1,1,height,width)
+    '''
+    if mode == 'logits':
+        pred_logit = F.interpolate(pred_logit, size=output_size, mode='bilinear', align_corners=align_corners)
+        return torch.argmax(pred_logit, dim=1, keepdim=True).float()
+
+    lowres_label = torch.argmax(pred_logit, dim=1, keepdim=True)
+    if mode == 'nearest':
+        return F.interpolate(lowres_label.float(), size=output_size, mode='nearest')
+    elif mode == 'present':
+        present_ids = torch.unique(lowres_label)
+        if len(present_ids) == 1:
+            return present_ids.float().view(1, 1, 1, 1).expand(1, 1, output_size[0], output_size[1]).contiguous()
+        present_logit = F.interpolate(pred_logit[:, present_ids], size=output_size, mode='bilinear', align_corners=align_corners)
+        return present_ids[torch.argmax(present_logit, dim=1, keepdim=True)].float()
+    else:
+        raise NotImplementedError
+
 
 class AOTTracker(object):
-    def __init__(self, cfg, gpu_id=0):
+    def __init__(self, cfg, gpu_id=0, upsample='logits', device=None):
+        '''
+        Arguments:
+            upsample: how predictions reach frame resolution, see upsample_label
+            device: see tool.device.resolve_device, CUDA gpu_id when available
+        '''
+        assert upsample in UPSAMPLE_MODES, f'unknown upsample mode {upsample}'
         self.gpu_id = gpu_id
-        self.model = build_vos_model(cfg.MODEL_VOS, cfg).cuda(gpu_id)
-        self.model, _ = load_network(self.model, cfg.TEST_CKPT_PATH, gpu_id)
+        self.device = resolve_device(device, gpu_id)
+        self.upsample = upsample
+        self.align_corners = cfg.MODEL_ALIGN_CORNERS
+        self.model = build_vos_model(cfg.MODEL_VOS, cfg).to(self.device)
+        self.model, _ = load_network(self.model, cfg.TEST_CKPT_PATH, gpu_id, device=self.device)
+        self.model = channels_last(self.model, self.device)
+        # streaming / indexed long-term attention for long memories
+        set_long_term_attention(self.model.LSTT, **cfg.LONG_TERM_ATTENTION)
         # self.engine = self.build_tracker_engine(cfg.MODEL_ENGINE,
         #                            aot_model=self.model,
         #                            gpu_id=gpu_id,
         #                            short_term_mem_skip=4,
         #                            long_term_mem_gap=cfg.TEST_LONG_TERM_MEM_GAP)
-        self.engine = build_engine(cfg.MODEL_ENGINE,
-                                   phase='eval',
-                                   aot_model=self.model,
-                                   gpu_id=gpu_id,
-                                   short_term_mem_skip=1,
-                                   long_term_mem_gap=cfg.TEST_LONG_TERM_MEM_GAP,
-                                   max_len_long_term=cfg.MAX_LEN_LONG_TERM)
+        self.cfg = cfg
+        # torch.compile of the encoder and of the LSTT + decoder step
+        self.compiled_step = compile_inference(self.model, **cfg.COMPILE) if cfg.COMPILE else None
+        self.engine = self.build_engine()
        
         self.transform = transforms.Compose([
             tr.MultiRestrictSize(cfg.TEST_MAX_SHORT_EDGE,
@@ -48,10 +97,76 @@ class AOTTracker(object):
         ])
 
         self.model.eval()
+        self.last_entropy = None
+        # encoder outputs by frame index, shared with forked trackers (same video)
+        self.feature_cache = FeatureCache(cfg.FEATURE_CACHE) if cfg.FEATURE_CACHE > 0 else None
+
+    def build_engine(self):
+        return build_engine(self.cfg.MODEL_ENGINE,
+                            phase='eval',
+                            aot_model=self.model,
+                            gpu_id=self.gpu_id,
+                            short_term_mem_skip=1,
+                            long_term_mem_gap=self.cfg.TEST_LONG_TERM_MEM_GAP,
+                            max_len_long_term=self.cfg.MAX_LEN_LONG_TERM,
+                            long_term_memory_args=self.cfg.LONG_TERM_MEMORY,
+                            batched=self.cfg.BATCH_SUB_ENGINES,
+                            compiled_step=self.compiled_step)
+
+    def fork(self, share_features=True):
+        '''
+        A tracker with its own memory (engine state) that shares the model
+        weights of this one, e.g. to follow another caption on the same video.
+        Arguments:
+            share_features: share the feature cache, only for the same video
+        '''
+        tracker = copy.copy(self)
+        tracker.engine = self.build_engine()
+        tracker.last_entropy = None
+        if not share_features and self.feature_cache is not None:
+            tracker.feature_cache = FeatureCache(self.feature_cache.capacity)
+        return tracker
+
+    @torch.no_grad()
+    def encode(self, frame, frame_idx=None):
+        '''
+        Run the encoder once, the result can be passed as `encoded` to track /
+        add_reference_frame of every tracker forked from this one.
+        Arguments:
+            frame: numpy array (h,w,3)
+            frame_idx: index of the frame in the video, looks the features up
+                in the feature cache first. Leave None for frames without a
+                stable index.
+        Return:
+            (image, img_embs): input tensor (1,3,h',w') and encoder features
+        '''
+        key = None
+        if frame_idx is not None and self.feature_cache is not None:
+            key = (frame_idx, frame.shape)
+            encoded = self.feature_cache.get(key)
+            if encoded is not None:
+                return encoded
+        image = self.prepare(frame)
+        encoded = (image, self.model.encode_image(image))
+        if key is not None:
+            self.feature_cache.put(key, encoded)
+        return encoded
+
+    def prepare(self, frame):
+        '''
+        Arguments:
+            frame: numpy array (h,w,3)
+        Return:
+            image: input tensor (1,3,h',w') of the encoder
+        '''
+        sample = self.transform({'current_img': frame})
+        return channels_last(sample[0]['current_img'].unsqueeze(0).float().to(self.device), self.device)
 
     @torch.no_grad()
-    def add_reference_frame(self, frame, mask, obj_nums, frame_step, incremental=False):
+    def add_reference_frame(self, frame, mask, obj_nums, frame_step, incremental=False, encoded=None, frame_idx=None):
         # mask = cv2.resize(mask, frame.shape[:2][::-1], interpolation = cv2.INTER_NEAREST)
+        if encoded is None and frame_idx is not None:
+            encoded = self.encode(frame, frame_idx)
 
         sample = {
             'current_img': frame,
@@ -59,32 +174,91 @@ class AOTTracker(object):
         }
     
         sample = self.transform(sample)
-        frame = sample[0]['current_img'].unsqueeze(0).float().cuda(self.gpu_id)
-        mask = sample[0]['current_label'].unsqueeze(0).float().cuda(self.gpu_id)
+        frame = channels_last(sample[0]['current_img'].unsqueeze(0).float().to(self.device), self.device)
+        mask = sample[0]['current_label'].unsqueeze(0).float().to(self.device)
         _mask = F.interpolate(mask,size=frame.shape[-2:],mode='nearest')
+        img_embs = None
+        if encoded is not None:
+            frame, img_embs = encoded
 
         if incremental:
-            self.engine.add_reference_frame_incremental(frame, _mask, obj_nums=obj_nums, frame_step=frame_step)
+            self.engine.add_objects(frame, _mask, obj_nums=obj_nums, frame_step=frame_step, img_embs=img_embs)
         else:
-            self.engine.add_reference_frame(frame, _mask, obj_nums=obj_nums, frame_step=frame_step)
+            self.engine.add_reference_frame(frame, _mask, obj_nums=obj_nums, frame_step=frame_step, img_embs=img_embs)
 
+    @torch.no_grad()
+    def add_objects(self, frame, mask, obj_nums, frame_step, encoded=None, frame_idx=None):
+        '''
+        Start tracking the new ids (above the current obj_nums) of mask on a
+        frame that was just tracked, only the sub-engines of the new ids take
+        a new reference frame. See AOTInferEngine.add_objects.
+        '''
+        self.add_reference_frame(frame, mask, obj_nums, frame_step, incremental=True, encoded=encoded,
+                                 frame_idx=frame_idx)
 
+    @torch.no_grad()
+    def retire_objects(self, obj_ids):
+        '''
+        Stop tracking obj_ids, see AOTInferEngine.retire_objects.
+        '''
+        self.engine.retire_objects(obj_ids)
 
     @torch.no_grad()
-    def track(self, image):
+    def track(self, image, with_entropy=False, return_lowres=False, encoded=None, frame_idx=None):
+        '''
+        Arguments:
+            image: numpy array (h,w,3)
+            with_entropy: also set self.last_entropy
+            return_lowres: skip upsampling, return the label map at decoder
+                resolution and the (y, x) scale factor to frame resolution
+            encoded: output of self.encode(image), skips the encoder
+            frame_idx: see encode
+        Return:
+            pred_label: float tensor (1,1,h,w), or (pred_label, scale) with return_lowres
+        '''
         output_height, output_width = image.shape[0], image.shape[1]
-        sample = {'current_img': image}
-        sample = self.transform(sample)
-        image = sample[0]['current_img'].unsqueeze(0).float().cuda(self.gpu_id)
-        self.engine.match_propogate_one_frame(image)
-        pred_logit = self.engine.decode_current_logits((output_height, output_width))
+        if encoded is None:
+            encoded = self.encode(image, frame_idx)
+        image, img_embs = encoded
+        self.engine.match_propogate_one_frame(image, img_embs=img_embs)
 
-        # pred_prob = torch.softmax(pred_logit, dim=1)
-        pred_label = torch.argmax(pred_logit, dim=1,
-                                    keepdim=True).float()
+        if self.upsample == 'logits' and not return_lowres:
+            pred_logit = self.engine.decode_current_logits((output_height, output_width))
+            if with_entropy:
+                self.last_entropy = self.prediction_entropy(pred_logit)
+            # pred_prob = torch.softmax(pred_logit, dim=1)
+            pred_label = torch.argmax(pred_logit, dim=1,
+                                        keepdim=True).float()
+            return pred_label
+
+        # decoder resolution, never materializes full resolution logits
+        pred_logit = self.engine.decode_current_logits()
+        if with_entropy:
+            self.last_entropy = self.prediction_entropy(pred_logit, stride=1)
+        if return_lowres:
+            pred_label = torch.argmax(pred_logit, dim=1, keepdim=True).float()
+            scale = (output_height / pred_label.shape[2], output_width / pred_label.shape[3])
+            return pred_label, scale
+        return upsample_label(pred_logit, (output_height, output_width), self.upsample, self.align_corners)
+
+    @torch.no_grad()
+    def prediction_entropy(self, pred_logit, stride=4):
+        '''
+        Mean softmax entropy of a prediction, normalized by log(obj_num + 1),
+        on every stride-th pixel. Low when the tracker is confident.
+        Arguments:
+            pred_logit: tensor (1,c,h,w)
+        Return:
+            entropy: float in [0, 1]
+        '''
+        obj_num = self.engine.obj_nums[0] if isinstance(self.engine.obj_nums, list) else self.engine.obj_nums
+        if obj_num is None or obj_num < 1:
+            return 0.
+        logit = pred_logit[:, :obj_num + 1, ::stride, ::stride].float()
+        log_prob = torch.log_softmax(logit, dim=1)
+        entropy = -(log_prob.exp() * log_prob).sum(dim=1).mean()
+        return entropy.item() / np.log(obj_num + 1)
 
-        return  pred_label
-    
     @torch.no_grad()
     def update_memory(self, pred_label):
         self.engine.update_memory(pred_label)
@@ -92,6 +266,9 @@ class AOTTracker(object):
     @torch.no_grad()
     def restart(self):
         self.engine.restart_engine()
+        # cache keys are frame indices, they restart with the next video
+        if self.feature_cache is not None:
+            self.feature_cache.clear()
     
     @torch.no_grad()
     def build_tracker_engine(self, name, **kwargs):
@@ -103,10 +280,85 @@ class AOTTracker(object):
             raise NotImplementedError
 
 
+class MultiVideoTracker():
+    def __init__(self, tracker, max_batch=None):
+        '''
+        Independent video sessions tracked in lock step with the model of
+        tracker: on every step the next frames of the sessions are encoded as
+        one batch and run through one LSTT and one decoder forward, see
+        MultiVideoInferEngine. Sessions are grouped by input size.
+        Arguments:
+            tracker: AOTTracker, its weights and settings are shared
+            max_batch: maximal number of sessions per forward, None for all
+        '''
+        self.tracker = tracker
+        self.max_batch = max_batch
+        self.engine = MultiVideoInferEngine(tracker.model)
+        self.sessions = {}
+
+    def open(self, session_id):
+        '''
+        Return:
+            the AOTTracker of the session, add its reference frame (and later
+            add_objects / retire_objects) on it directly
+        '''
+        self.sessions[session_id] = self.tracker.fork(share_features=False)
+        return self.sessions[session_id]
+
+    def close(self, session_id):
+        self.sessions.pop(session_id).restart()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @torch.no_grad()
+    def step(self, frames, update_memory=True):
+        '''
+        Arguments:
+            frames: dict session id -> numpy array (h,w,3), next frame of the
+                session, sessions without a frame this step are left out
+            update_memory: as AOTTracker.track + update_memory
+        Return:
+            dict session id -> pred_label float tensor (1,1,h,w)
+        '''
+        groups = {}
+        for session_id, frame in frames.items():
+            image = self.sessions[session_id].prepare(frame)
+            groups.setdefault(tuple(image.shape[-2:]), []).append((session_id, image))
+
+        pred_labels = {}
+        for group in groups.values():
+            batch_size = self.max_batch or len(group)
+            for start in range(0, len(group), batch_size):
+                pred_labels.update(self._step(group[start:start + batch_size], frames, update_memory))
+        return pred_labels
+
+    def _step(self, batch, frames, update_memory):
+        trackers = [self.sessions[session_id] for session_id, _ in batch]
+        infer_engines = [tracker.engine for tracker in trackers]
+        output_sizes = [frames[session_id].shape[:2] for session_id, _ in batch]
+        self.engine.match_propogate(infer_engines, [image for _, image in batch])
+        pred_logits = self.engine.decode_logits(
+            infer_engines,
+            [output_size if tracker.upsample == 'logits' else None
+             for tracker, output_size in zip(trackers, output_sizes)])
+
+        pred_labels = {}
+        for (session_id, _), tracker, pred_logit, output_size in zip(batch, trackers, pred_logits, output_sizes):
+            if tracker.upsample == 'logits':
+                pred_label = torch.argmax(pred_logit, dim=1, keepdim=True).float()
+            else:
+                pred_label = upsample_label(pred_logit, output_size, tracker.upsample, tracker.align_corners)
+            if update_memory:
+                tracker.update_memory(pred_label)
+            pred_labels[session_id] = pred_label
+        return pred_labels
+
+
 class AOTTrackerInferEngine(AOTInferEngine):
     def __init__(self, aot_model, gpu_id=0, long_term_mem_gap=9999, short_term_mem_skip=1, max_aot_obj_num=None):
         super().__init__(aot_model, gpu_id, long_term_mem_gap, short_term_mem_skip, max_aot_obj_num)
-    def add_reference_frame_incremental(self, img, mask, obj_nums, frame_step=-1):
+    def add_reference_frame_incremental(self, img, mask, obj_nums, frame_step=-1, img_embs=None):
         if isinstance(obj_nums, list):
             obj_nums = obj_nums[0]
         self.obj_nums = obj_nums
@@ -120,7 +372,6 @@ class AOTTrackerInferEngine(AOTInferEngine):
 
         separated_masks, separated_obj_nums = self.separate_mask(
             mask, obj_nums)
-        img_embs = None
         for aot_engine, separated_mask, separated_obj_num in zip(
                 self.aot_engines, separated_masks, separated_obj_nums):
             if aot_engine.obj_nums is None or aot_engine.obj_nums[0] < separated_obj_num:
@@ -142,7 +393,7 @@ class AOTTrackerInferEngine(AOTInferEngine):
 class DeAOTTrackerInferEngine(DeAOTInferEngine):
     def __init__(self, aot_model, gpu_id=0, long_term_mem_gap=9999, short_term_mem_skip=1, max_aot_obj_num=None):
         super().__init__(aot_model, gpu_id, long_term_mem_gap, short_term_mem_skip, max_aot_obj_num)
-    def add_reference_frame_incremental(self, img, mask, obj_nums, frame_step=-1):
+    def add_reference_frame_incremental(self, img, mask, obj_nums, frame_step=-1, img_embs=None):
         if isinstance(obj_nums, list):
             obj_nums = obj_nums[0]
         self.obj_nums = obj_nums
@@ -156,7 +407,6 @@ class DeAOTTrackerInferEngine(DeAOTInferEngine):
 
         separated_masks, separated_obj_nums = self.separate_mask(
             mask, obj_nums)
-        img_embs = None
         for aot_engine, separated_mask, separated_obj_num in zip(
                 self.aot_engines, separated_masks, separated_obj_nums):
             if aot_engine.obj_nums is None or aot_engine.obj_nums[0] < separated_obj_num:
@@ -181,6 +431,75 @@ def get_aot(args):
     cfg.TEST_CKPT_PATH = args['model_path']
     cfg.TEST_LONG_TERM_MEM_GAP = args['long_term_mem_gap']
     cfg.MAX_LEN_LONG_TERM = args['max_len_long_term']
+    cfg.LONG_TERM_MEMORY = args.get('long_term_memory')
+    cfg.LONG_TERM_ATTENTION = args.get('long_term_attention', {})
+    cfg.MODEL_LOCAL_ATTN = args.get('local_attention', 'auto')
+    cfg.BATCH_SUB_ENGINES = args.get('batch_sub_engines', False)
+    cfg.FEATURE_CACHE = args.get('feature_cache', 0)
+    cfg.COMPILE = args.get('compile')
     # init AOTTracker
-    tracker = AOTTracker(cfg, args['gpu_id'])
+    tracker = AOTTracker(cfg, args['gpu_id'], args.get('upsample', 'logits'), args.get('device'))
     return tracker
+
+
+def _peak_cpu_memory(fn):
+    # high-water mark of the resident memory while fn runs in a forked
+    # process, in MB (ru_maxrss is in KB on Linux, a forked process starts
+    # from the current resident size of its parent)
+    import multiprocessing
+    import resource
+
+    def run(queue):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        queue.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024)
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=run, args=(queue, ))
+    process.start()
+    peak = queue.get()
+    process.join()
+    return peak
+
+
+def _benchmark_upsample(obj_nums=(1, 32, 255), lowres_size=(135, 240), output_size=(1080, 1920), repeats=10):
+    # decoder resolution logits with a few blobs per object, as after tracking:
+    # smooth logits peaking inside every object, weak noise elsewhere
+    import time
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    yy, xx = torch.meshgrid(torch.arange(lowres_size[0], dtype=torch.float),
+                            torch.arange(lowres_size[1], dtype=torch.float), indexing='ij')
+    for obj_num in obj_nums:
+        pred_logit = torch.randn(1, obj_num + 1, *lowres_size) * 0.5
+        centers = torch.rand(obj_num, 2) * torch.tensor(lowres_size, dtype=torch.float)
+        radii = 3 + torch.rand(obj_num) * 12
+        for obj_id, ((y, x), radius) in enumerate(zip(centers.tolist(), radii.tolist()), start=1):
+            distance = ((yy - y)**2 + (xx - x)**2).sqrt()
+            pred_logit[0, obj_id] += 10 * (1 - distance / radius)
+        pred_logit = pred_logit.to(device)
+        reference = upsample_label(pred_logit, output_size, 'logits')
+        results = []
+        for mode in UPSAMPLE_MODES:
+            disagree = (upsample_label(pred_logit, output_size, mode) != reference).float().mean().item()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                base = torch.cuda.memory_allocated()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                upsample_label(pred_logit, output_size, mode)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            latency = (time.perf_counter() - start) / repeats * 1000
+            if device == 'cuda':
+                peak = (torch.cuda.max_memory_allocated() - base) / 1024**2
+            else:
+                peak = _peak_cpu_memory(lambda: upsample_label(pred_logit, output_size, mode))
+            results.append(f'{mode} {latency:8.2f} ms / {peak:8.1f} MB / {disagree:.2e} of pixels differ')
+        print(f'K={obj_num:3d} {device}: ' + ', '.join(results))
+
+
+if __name__ == '__main__':
+    _benchmark_upsample()
@@ -25,6 +25,7 @@ import gc
 import numpy as np
 import json
 from tool.transfer_tools import mask2bbox
+from tool.device import autocast
 
 from ast_master.prepare import ASTpredict
 from moviepy.editor import VideoFileClip 
@@ -101,7 +102,7 @@ def get_meta_from_img_seq(input_img_seq):
     return first_frame, first_frame, first_frame, ""
 
 def SegTracker_add_first_frame(Seg_Tracker, origin_frame, predicted_mask):
-    with torch.cuda.amp.autocast():
+    with autocast(Seg_Tracker.device):
         # Reset the first frame's mask
         frame_idx = 0
         Seg_Tracker.restart_tracker()
@@ -324,10 +325,9 @@ def segment_everything(Seg_Tracker, aot_model, long_term_mem, max_len_long_term,
 
     frame_idx = 0
 
-    with torch.cuda.amp.autocast():
+    with autocast(Seg_Tracker.device):
         pred_mask = Seg_Tracker.seg(origin_frame)
-        torch.cuda.empty_cache()
-        gc.collect()
+        Seg_Tracker.memory_policy.step(frame_idx, keyframe=True)
         Seg_Tracker.add_reference(origin_frame, pred_mask, frame_idx)
         Seg_Tracker.first_frame_mask = pred_mask
 
@@ -345,12 +345,15 @@ def add_new_object(Seg_Tracker):
 
     return Seg_Tracker, [[], []]
 
-def tracking_objects(Seg_Tracker, input_video, input_img_seq, fps, frame_num=0):
+def tracking_objects(Seg_Tracker, input_video, input_img_seq, fps, pipeline=False, frame_num=0):
     print("Start tracking !")
     # pdb.set_trace()
     # output_video, output_mask=tracking_objects_in_video(Seg_Tracker, input_video, input_img_seq, fps)
     # pdb.set_trace()
-    return tracking_objects_in_video(Seg_Tracker, input_video, input_img_seq, fps, frame_num)
+    if pipeline and input_video is not None:
+        # decode / track / encode overlap in one pass, memory stays bounded, no GIF is written
+        print("Pipelined tracking, no GIF is saved")
+    return tracking_objects_in_video(Seg_Tracker, input_video, input_img_seq, fps, frame_num, pipeline=pipeline)
 
 
 def res_by_num(input_video, input_img_seq, frame_num):
@@ -650,6 +653,11 @@ def seg_track_app():
                             value="Start Tracking",
                                 interactive=True,
                                 )
+                        pipeline_tracking = gr.Checkbox(
+                            label="Pipelined tracking (video input, faster and bounded memory, no GIF)",
+                            value=False,
+                            interactive=True,
+                        )
 
             with gr.Column(scale=0.5):
                 # output_video = gr.Video(label='Output video').style(height=550)
@@ -957,6 +965,7 @@ def seg_track_app():
                 input_video,
                 input_img_seq,
                 fps,
+                pipeline_tracking,
             ],
             outputs=[
                 output_video, output_mask
@@ -1037,7 +1046,7 @@ def seg_track_app():
                 Seg_Tracker,
                 input_video,
                 input_img_seq,
-                fps, frame_num
+                fps, pipeline_tracking, frame_num
             ],
             outputs=[
                 output_video, output_mask
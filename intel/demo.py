@@ -1,6 +1,7 @@
 import os
 import cv2
 from SegTracker import SegTracker
+from tool.device import autocast
 from model_args import aot_args, sam_args, segtracker_args
 from PIL import Image
 from aot_tracker import _palette
@@ -82,7 +83,7 @@ cap = cv2.VideoCapture(io_args["input_video"])
 frame_idx = 0
 segtracker = SegTracker(segtracker_args, sam_args, aot_args)
 segtracker.restart_tracker()
-with torch.cuda.amp.autocast():
+with autocast(segtracker.device):
     while cap.isOpened():
         ret, frame = cap.read()
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -135,7 +136,7 @@ frame_idx = 0
 segtracker = SegTracker(segtracker_args, sam_args, aot_args)
 segtracker.restart_tracker()
 
-with torch.cuda.amp.autocast():
+with autocast(segtracker.device):
     while cap.isOpened():
         ret, frame = cap.read()
         if not ret:
@@ -147,10 +148,11 @@ with torch.cuda.amp.autocast():
             gc.collect()
             segtracker.add_reference(frame, pred_mask)
         elif (frame_idx % sam_gap) == 0:
-            seg_mask = segtracker.seg(frame)
+            track_mask = segtracker.track(frame)
+            # only prompt SAM outside the tracked objects
+            seg_mask = segtracker.seg(frame, track_mask)
             torch.cuda.empty_cache()
             gc.collect()
-            track_mask = segtracker.track(frame)
             # find new objects, and update tracker with new objects
             new_obj_mask = segtracker.find_new_objs(track_mask, seg_mask)
             save_prediction(new_obj_mask, output_dir, str(frame_idx) + "_new.png")
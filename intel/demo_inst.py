@@ -1,6 +1,10 @@
 import os
 import cv2
 from SegTracker import SegTracker
+from tool.mask_store import MaskStoreWriter
+from tool.mask_analytics import label_stats
+from tool.video_pipeline import FrameReader, FrameWriterPool, PipelineStats
+from tool.device import autocast
 from model_args import aot_args, sam_args, segtracker_args
 from PIL import Image
 from aot_tracker import _palette
@@ -12,6 +16,7 @@ from scipy.ndimage import binary_dilation
 import gc
 from tqdm import tqdm
 import pickle
+import json
 
 
 def save_prediction(pred_mask, output_dir, file_name):
@@ -61,6 +66,30 @@ def draw_mask(img, mask, alpha=0.7, id_countour=False):
     return img_mask.astype(img.dtype)
 
 
+def object_states_from_mask(pred_mask, prompt, scale=(1., 1.)):
+    '''
+    Per-object statistics of one tracked frame, computed in a single pass over
+    the label map instead of one np.argwhere scan per object id.
+    Arguments:
+        pred_mask: numpy array (h,w), uint8 label map
+        prompt: caption the objects were detected with
+        scale: (y, x) factor from pred_mask to frame resolution, for label maps
+            returned by segtracker.track(frame, lowres=True)
+    Return:
+        list of {"id", "centroid", "size", "prompt"} dicts, sorted by id
+    '''
+    stats = label_stats(pred_mask)
+    return [
+        {
+            "id": int(obj_id),
+            "centroid": (int(centroid[0] * scale[1]), int(centroid[1] * scale[0])),
+            "size": float(size * scale[0] * scale[1]),
+            "prompt": prompt,
+        }
+        for obj_id, centroid, size in zip(stats["ids"], stats["centroid"], stats["area"])
+    ]
+
+
 # Set Text args
 """
 parameter:
@@ -72,8 +101,10 @@ parameter:
 """
 #grounding_caption = "vehicle.car.tank"
 #grounding_caption = "smoke.steam.fire"
-grounding_caption = os.environ["CAPTION"]
-simple_caption = grounding_caption.split(".")[0]
+# several captions can be tracked in one pass over the video, separated by ","
+# e.g. CAPTION="tank.vehicle.car,smoke.fire"
+grounding_captions = [caption for caption in os.environ["CAPTION"].split(",") if caption]
+simple_captions = [caption.split(".")[0] for caption in grounding_captions]
 box_threshold, text_threshold, box_size_threshold, reset_image = 0.35, 0.5, 0.5, True
 #box_threshold, text_threshold, box_size_threshold, reset_image = 0.25, 0.15, 0.15, True
 
@@ -83,8 +114,9 @@ io_args = {
     "output_mask_dir": f"./assets/output/{video_name}_masks",  # save pred masks
     "output_video": f"./assets/output/{video_name}_seg.mp4",  # mask+frame vizualization, mp4 or avi, else the same as input video
     "output_gif": f"./assets/output/{video_name}_seg.gif",  # mask visualization
-    "output_json": f"./assets/output/{video_name}_{simple_caption}_output.pkl",
-    "output_masks": f"./assets/output/{video_name}_{simple_caption}_masks.npy",
+    "output_json": [f"./assets/output/{video_name}_{caption}_output.pkl" for caption in simple_captions],
+    "output_masks": [f"./assets/output/{video_name}_{caption}_masks.bin" for caption in simple_captions],
+    "output_merged_json": f"./assets/{video_name}.json",  # per-frame records of all captions, the only writer of this file
     "append_previous": False,
 }
 
@@ -97,7 +129,10 @@ sam_args['generator_args'] = {
         'stability_score_thresh': 0.9,
         'crop_n_layers': 1,
         'crop_n_points_downscale_factor': 2,
+        'crop_batch_size': 4, # the 4 crops of layer 1 go through the SAM image encoder in one forward, 4x its activation memory, use 1 on small CPU nodes
         'min_mask_region_area': 200,
+        'postprocess_workers': 4, # threads removing small regions and holes, each on the box around its mask
+        'low_res_stability': True, # stability score on the 256x256 logits, only masks passing both filters are upscaled
     }
 
 # For every sam_gap frames, we use SAM to find new objects and add them for tracking
@@ -107,157 +142,132 @@ segtracker_args = {
     'min_area': 125, # minimal mask area to add a new mask as a new object
     'max_obj_num': 255, # maximal object number to track in a video
     'min_new_obj_iou': 0.8, # the area of a new object in the background should > 80% 
+    'retire_after': 4, # stop tracking objects missing on 4 keyframes in a row
+    'memory_policy': {'release_on_keyframe': True, 'legacy': False}, # legacy=True releases memory after every frame
+    # run detection on scene changes, at least every 4 and at most every 60 frames
+    'keyframe': {'policy': 'frame_diff', 'min_gap': 4, 'max_gap': 60, 'frame_diff_thresh': 0.08},
 }
 
-# source video to segment
-cap = cv2.VideoCapture(io_args["input_video"])
-fps = cap.get(cv2.CAP_PROP_FPS)
+# source video to segment, decoded on a reader thread a few frames ahead of tracking
+stats = PipelineStats()
+reader = FrameReader(io_args["input_video"], prefetch=8, stats=stats)
+# per-frame stats and mask store appends run on a writer thread, in frame order
+writers = FrameWriterPool(num_workers=1, max_pending=16, stats=stats)
 # output masks
 output_dir = io_args["output_mask_dir"]
 if not os.path.exists(output_dir):
     os.makedirs(output_dir)
-pred_list = []
-masked_pred_list = []
+# one record list and one mask store per caption, masks are appended frame by
+# frame, only one block per caption is held in memory
+object_states = [[] for _ in grounding_captions]
+mask_writers = [
+    MaskStoreWriter(path, chunk_size=64, compression="zlib") for path in io_args["output_masks"]
+]
+
+
+def emit_frame(caption_idx, pred_mask):
+    # emit the per-frame record right away, no second decode pass
+    object_states[caption_idx].append(object_states_from_mask(pred_mask, simple_captions[caption_idx]))
+    mask_writers[caption_idx].append(pred_mask)
+
 
 torch.cuda.empty_cache()
 gc.collect()
-sam_gap = segtracker_args["sam_gap"]
-frame_idx = 0
 segtracker = SegTracker(segtracker_args, sam_args, aot_args)
 segtracker.restart_tracker()
+# every caption has its own objects and tracker memory, the models are shared
+segtrackers = [segtracker] + [segtracker.fork() for _ in grounding_captions[1:]]
 
 
 with tqdm() as pbar:
-    with torch.cuda.amp.autocast():
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if frame_idx == 0:
-                segtracker.init(frame)
-            if not ret:
-                break
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            if frame_idx == 0:
-                pred_mask, _ = segtracker.detect_and_seg(
-                    frame,
-                    grounding_caption,
-                    box_threshold,
-                    text_threshold,
-                    box_size_threshold,
-                    reset_image,
-                )
-                # pred_mask = cv2.imread('./debug/first_frame_mask.png', 0)
-                torch.cuda.empty_cache()
-                gc.collect()
-                segtracker.add_reference(frame, pred_mask)
-            elif (frame_idx % sam_gap) == 0:
-                seg_mask, _ = segtracker.detect_and_seg(
-                    frame,
-                    grounding_caption,
-                    box_threshold,
-                    text_threshold,
-                    box_size_threshold,
-                    reset_image,
+    with autocast(segtracker.device):
+        try:
+            for frame_idx, frame in reader:
+                keyframes = [tracker.keyframe_scheduler.is_keyframe(frame_idx, frame) for tracker in segtrackers]
+                with stats.timed("keyframe" if any(keyframes) else "track"):
+                    # decoded once, AOT encoder and SAM image encoder run once for all captions
+                    encoded = segtracker.encode(frame)
+                    if any(keyframes) and reset_image:
+                        segtracker.sam.embed_image(frame)
+
+                    for caption_idx, (tracker, grounding_caption, keyframe) in enumerate(
+                        zip(segtrackers, grounding_captions, keyframes)
+                    ):
+                        if frame_idx == 0:
+                            tracker.init(frame)
+                            pred_mask, _ = tracker.detect_and_seg(
+                                frame,
+                                grounding_caption,
+                                box_threshold,
+                                text_threshold,
+                                box_size_threshold,
+                                False,
+                            )
+                            # pred_mask = cv2.imread('./debug/first_frame_mask.png', 0)
+                            tracker.add_reference(frame, pred_mask, encoded=encoded)
+                        elif keyframe:
+                            seg_mask, _ = tracker.detect_and_seg(
+                                frame,
+                                grounding_caption,
+                                box_threshold,
+                                text_threshold,
+                                box_size_threshold,
+                                False,
+                            )
+
+                            #save_prediction(seg_mask, "./debug/seg_result", str(frame_idx) + ".png")
+                            track_mask = tracker.track(frame, encoded=encoded)
+                            #save_prediction(track_mask, "./debug/aot_result", str(frame_idx) + ".png")
+                            # find new objects, and update tracker with new objects
+                            new_obj_mask = tracker.find_new_objs(track_mask, seg_mask)
+                            if np.sum(new_obj_mask > 0) > frame.shape[0] * frame.shape[1] * 0.4:
+                                new_obj_mask = np.zeros_like(new_obj_mask)
+                            #save_prediction(new_obj_mask, output_dir, str(frame_idx) + "_new.png")
+                            pred_mask = track_mask + new_obj_mask
+                            # tracker.restart_tracker()
+                            # only the sub-engines of new ids take a reference, lost objects stop being tracked
+                            tracker.retire_lost_objects(track_mask)
+                            tracker.add_objects(frame, pred_mask, encoded=encoded)
+                        else:
+                            pred_mask = tracker.track(frame, update_memory=True, encoded=encoded)
+
+                        writers.submit("emit", emit_frame, caption_idx, pred_mask, ordered=True)
+                    del encoded
+                segtracker.memory_policy.step(frame_idx, keyframe=any(keyframes))
+
+                print(
+                    "processed frame {}, obj_num {}".format(
+                        frame_idx, [tracker.get_obj_num() for tracker in segtrackers]
+                    ),
+                    # end = '\r'
                 )
-
-                #save_prediction(seg_mask, "./debug/seg_result", str(frame_idx) + ".png")
-                torch.cuda.empty_cache()
-                gc.collect()
-                track_mask = segtracker.track(frame)
-                #save_prediction(track_mask, "./debug/aot_result", str(frame_idx) + ".png")
-                # find new objects, and update tracker with new objects
-                new_obj_mask = segtracker.find_new_objs(track_mask, seg_mask)
-                if np.sum(new_obj_mask > 0) > frame.shape[0] * frame.shape[1] * 0.4:
-                    new_obj_mask = np.zeros_like(new_obj_mask)
-                #save_prediction(new_obj_mask, output_dir, str(frame_idx) + "_new.png")
-                pred_mask = track_mask + new_obj_mask
-                # segtracker.restart_tracker()
-                segtracker.add_reference(frame, pred_mask)
-            else:
-                pred_mask = segtracker.track(frame, update_memory=True)
-            torch.cuda.empty_cache()
-            gc.collect()
-
-            # save_prediction(pred_mask, output_dir, str(frame_idx) + ".png")
-            # masked_frame = draw_mask(frame,pred_mask)
-            # masked_pred_list.append(masked_frame)
-            # plt.imshow(masked_frame)
-            # plt.show()
-
-            pred_list.append(pred_mask)
-
-            print(
-                "processed frame {}, obj_num {}".format(
-                    frame_idx, segtracker.get_obj_num()
-                ),
-                # end = '\r'
-            )
-            pbar.update(1)
-            frame_idx += 1
-        cap.release()
+                pbar.update(1)
+        finally:
+            # stop the reader and drain the emit jobs even if tracking fails
+            # mid-video, the mask stores are closed with a valid index
+            reader.close()
+            try:
+                writers.close()
+            finally:
+                for mask_writer in mask_writers:
+                    mask_writer.close()
         print("\nfinished")
+        print(stats.report())
+        print(segtracker.memory_policy.summary())
+        for simple_caption, tracker in zip(simple_captions, segtrackers):
+            print(simple_caption, tracker.keyframe_scheduler.summary())
 
 
-# draw pred mask on frame and save as a video
-cap = cv2.VideoCapture(io_args["input_video"])
-fps = cap.get(cv2.CAP_PROP_FPS)
-width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-object_states = []
-
-# setup text fonts
-font = cv2.FONT_HERSHEY_SIMPLEX
-font_scale = 1
-color = (0, 255, 170)  # Blue color in BGR
-thickness = 10
-line_space = 30
-
-masks = []
-
-frame_idx = 0
-while cap.isOpened():
-    ret, frame = cap.read()
-    if not ret:
-        break
-    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    pred_mask = pred_list[frame_idx]
-    masks.append(pred_mask)
-    
-    array = np.array(pred_mask)
-    flat_array = array.flatten()
-    unique_values = np.unique(flat_array)
-    object_stats = {}
-    for value in unique_values:
-        if value == 0:
-            continue
-        indices = np.argwhere(array == value) 
-        average_location = indices.mean(axis=0)
-        # Calculate size of the mask (number of occurrences)
-        size = len(indices)
-        # Store stats in dictionary
-        object_stats[value] = {
-            "id": int(value), 
-            "centroid": (int(average_location[1]), int(average_location[0])), 
-            "size": float(size), 
-            "prompt": simple_caption,
-        }
-
-    object_states.append(list(object_stats.values()))
-
-    # masked_frame = masked_pred_list[frame_idx]
-    print("frame {} writed".format(frame_idx), end="\r")
-    frame_idx += 1
-
-import json
-with open(io_args["output_json"], "wb") as f:
-    pickle.dump(object_states, f)
-    print("Data written to JSON")
+for path, states in zip(io_args["output_json"], object_states):
+    with open(path, "wb") as f:
+        pickle.dump(states, f)
+    print("Data written to {}".format(path))
 
-with open(io_args["output_masks"], "wb") as f:
-    np.save(f, np.array(masks))
-    print("Data written to npy")
+for path in io_args["output_masks"]:
+    print("Data written to {}".format(path))
 
-cap.release()
-print("\n{} saved".format(io_args["output_video"]))
-print("\nfinished")
+# merged per-frame records of all captions, stitch_results.py only renders the overlay video
+merged_json = [sum(frame_states, []) for frame_states in zip(*object_states)]
+with open(io_args["output_merged_json"], "w") as f:
+    json.dump(merged_json, f)
+print("Data written to {}".format(io_args["output_merged_json"]))
@@ -8,21 +8,49 @@ sam_args = {
         'stability_score_thresh': 0.9,
         'crop_n_layers': 1,
         'crop_n_points_downscale_factor': 2,
+        'crop_batch_size': 4, # the 4 crops of layer 1 go through the SAM image encoder in one forward, 4x its activation memory, use 1 on small CPU nodes
         'min_mask_region_area': 200,
+        'postprocess_workers': 4, # threads removing small regions and holes, each on the box around its mask
+        'point_texture_thresh': 0., # > 0 skips point prompts on flat regions (mean gray level gradient below it), tracked objects are always skipped on keyframes
+        'low_res_stability': True, # stability score on the 256x256 logits, only masks passing both filters are upscaled
+        'output_mode': 'uncompressed_rle', # SegTracker.seg paints the RLEs into its label map without dense masks
     },
     'gpu_id': 0,
+    'device': 'auto', # 'auto' uses CUDA gpu_id when available, else CPU
+    # box and click prompts on onnxruntime (CPU), models from sam/scripts/export_onnx_model.py --batched-prompts [--encoder-output ...]
+    # e.g. {'decoder_path': 'ckpt/sam_vit_b_decoder.onnx', 'encoder_path': None, 'num_threads': 0}
+    'onnx': None,
 }
 aot_args = {
     'phase': 'PRE_YTB_DAV',
     'model': 'r50_deaotl',
     'model_path': 'ckpt/R50_DeAOTL_PRE_YTB_DAV.pth',
     'long_term_mem_gap': 9999,
-    'max_len_long_term': 9999,
+    'max_len_long_term': 9999, # long-term memory frames (every keyframe adds one), caps the preallocated memory on long videos
+    'long_term_memory': {'policy': 'fifo', 'token_budget': None}, # once full, 'fifo' drops the oldest frame, 'usage' the least attended one, 'merge' also averages near duplicates, see LongTermMemory
+    'long_term_attention': {'kv_chunk_size': -1, 'index_block_size': 64, 'index_top_blocks': -1}, # kv_chunk_size > 0: online softmax over chunks of the memory, index_top_blocks > 0: only attend to the best blocks of the memory
+    'feature_cache': 8, # encoder outputs of the last 8 frames (by frame index), a keyframe is encoded once for tracking and reference
+    'batch_sub_engines': True, # more than max_aot_obj_num objects: one batched LSTT / decoder forward for all sub-engines instead of one each
+    'compile': None, # e.g. {'mode': None, 'cache_dir': 'ckpt/compile_cache'}: torch.compile encoder and LSTT + decoder step, the cache_dir keeps compiled kernels for the next run, needs the 'fifo' long_term_memory policy
+    'local_attention': 'auto', # short-term attention backend, 'auto': 'corr' with spatial_correlation_sampler, else 'window' (CPU and GPU)
+    'upsample': 'present', # 'logits': full resolution logits, 'nearest' / 'present': argmax at decoder resolution, see aot_tracker.upsample_label
     'gpu_id': 0,
 }
 segtracker_args = {
     'sam_gap': 10, # the interval to run sam to segment new objects
     'min_area': 200, # minimal mask area to add a new mask as a new object
     'max_obj_num': 255, # maximal object number to track in a video
+    'num_threads': None, # CPU only: torch threads of this process, None splits the cores between num_workers
+    'num_workers': 1, # CPU only: number of tracker processes sharing the node
     'min_new_obj_iou': 0.8, # the background area ratio of a new object should > 80% 
+    'retire_after': None, # stop tracking objects missing from the tracked mask on this many keyframes in a row, None never retires
+    # keyframe policy: 'fixed' (every sam_gap frames), 'frame_diff', 'histogram' or 'entropy',
+    # the adaptive policies keep keyframes between min_gap and max_gap frames apart
+    'keyframe': {'policy': 'fixed'},
+    'memory_policy': {
+        'cuda_high_water_ratio': 0.9, # release cached CUDA memory once reserved memory exceeds 90% of the device
+        'release_on_keyframe': True, # release after SAM keyframes
+        'gc_every': 0, # run gc.collect() every n frames, 0 disables it
+        'legacy': False, # True releases after every frame (old behavior), to compare frames/s
+    },
 }
\ No newline at end of file
@@ -1,9 +1,11 @@
 #!/usr/bin/env bash
 
 export VIDEO="ukraine_tank_cut"
+# captions separated by "," are tracked in a single pass over the video
 #CAPTION="person.human.soldier" python3 demo_inst.py
-CAPTION="tank.vehicle.car" python3 demo_inst.py
-CAPTION="smoke.fire" python3 demo_inst.py
+export CAPTION="tank.vehicle.car,smoke.fire"
+python3 demo_inst.py
 # CAPTION="gun.weapon" python3 demo_inst.py
 
+# overlay video of the same captions, the merged JSON is written by demo_inst.py
 python3 stitch_results.py
\ No newline at end of file
@@ -11,6 +11,7 @@ from segment_anything.utils.onnx import SamOnnxModel
 
 import argparse
 import warnings
+from typing import Optional
 
 try:
     import onnxruntime  # type: ignore
@@ -83,6 +84,26 @@ parser.add_argument(
     ),
 )
 
+parser.add_argument(
+    "--batched-prompts",
+    action="store_true",
+    help=(
+        "Export the number of prompts (the first axis of point_coords, point_labels "
+        "and mask_input) as a dynamic axis, so several boxes or clicks on the same "
+        "image embedding are decoded in one run."
+    ),
+)
+
+parser.add_argument(
+    "--encoder-output",
+    type=str,
+    default=None,
+    help=(
+        "If set, also export the image encoder to this filename. It takes the "
+        "normalized and padded 1x3x1024x1024 image, see Sam.preprocess."
+    ),
+)
+
 parser.add_argument(
     "--return-extra-metrics",
     action="store_true",
@@ -103,6 +124,8 @@ def run_export(
     gelu_approximate: bool = False,
     use_stability_score: bool = False,
     return_extra_metrics=False,
+    batched_prompts: bool = False,
+    encoder_output: Optional[str] = None,
 ):
     print("Loading model...")
     sam = sam_model_registry[model_type](checkpoint=checkpoint)
@@ -123,6 +146,10 @@ def run_export(
         "point_coords": {1: "num_points"},
         "point_labels": {1: "num_points"},
     }
+    if batched_prompts:
+        dynamic_axes["point_coords"][0] = "num_prompts"
+        dynamic_axes["point_labels"][0] = "num_prompts"
+        dynamic_axes["mask_input"] = {0: "num_prompts"}
 
     embed_dim = sam.prompt_encoder.embed_dim
     embed_size = sam.prompt_encoder.image_embedding_size
@@ -164,6 +191,42 @@ def run_export(
         _ = ort_session.run(None, ort_inputs)
         print("Model has successfully been run with ONNXRuntime.")
 
+    if encoder_output is not None:
+        run_encoder_export(sam, encoder_output, opset, gelu_approximate)
+
+
+def run_encoder_export(sam, output: str, opset: int, gelu_approximate: bool = False):
+    image_encoder = sam.image_encoder.eval()
+    if gelu_approximate:
+        for n, m in image_encoder.named_modules():
+            if isinstance(m, torch.nn.GELU):
+                m.approximate = "tanh"
+
+    img_size = image_encoder.img_size
+    dummy_input = torch.randn(1, 3, img_size, img_size, dtype=torch.float)
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+        warnings.filterwarnings("ignore", category=UserWarning)
+        with open(output, "wb") as f:
+            print(f"Exporing onnx image encoder to {output}...")
+            torch.onnx.export(
+                image_encoder,
+                (dummy_input,),
+                f,
+                export_params=True,
+                verbose=False,
+                opset_version=opset,
+                do_constant_folding=True,
+                input_names=["input_image"],
+                output_names=["image_embeddings"],
+            )
+
+    if onnxruntime_exists:
+        ort_session = onnxruntime.InferenceSession(output)
+        _ = ort_session.run(None, {"input_image": to_numpy(dummy_input)})
+        print("Image encoder has successfully been run with ONNXRuntime.")
+
 
 def to_numpy(tensor):
     return tensor.cpu().numpy()
@@ -180,6 +243,8 @@ if __name__ == "__main__":
         gelu_approximate=args.gelu_approximate,
         use_stability_score=args.use_stability_score,
         return_extra_metrics=args.return_extra_metrics,
+        batched_prompts=args.batched_prompts,
+        encoder_output=args.encoder_output,
     )
 
     if args.quantize_out is not None:
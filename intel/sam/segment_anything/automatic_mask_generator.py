@@ -6,6 +6,7 @@
 
 import numpy as np
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
 from typing import Any, Dict, List, Optional, Tuple
@@ -24,8 +25,11 @@ from .utils.amg import (
     generate_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
-    remove_small_regions,
+    prune_points,
+    remove_small_regions_in_box,
+    rle_to_coco_format,
     rle_to_mask,
+    texture_map,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
@@ -49,6 +53,10 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        crop_batch_size: int = 1,
+        postprocess_workers: int = 1,
+        point_texture_thresh: float = 0.0,
+        low_res_stability: bool = False,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -93,6 +101,19 @@ class SamAutomaticMaskGenerator:
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
             memory.
+          crop_batch_size (int): The number of crops of one crop layer whose
+            image embeddings are computed in one image encoder forward. Higher
+            numbers are faster but hold the activations of that many images.
+          postprocess_workers (int): The number of threads removing small
+            regions and holes when min_mask_region_area > 0.
+          point_texture_thresh (float): If >0, point prompts are dropped where
+            the mean absolute gray level gradient around them is below this
+            value, flat regions such as sky or road rarely start new objects.
+            Requires opencv.
+          low_res_stability (bool): If True, the stability score is computed
+            on the 256x256 low resolution logits, and only the masks that pass
+            both filters are upscaled to the image resolution. Faster, the
+            score differs slightly from the one at image resolution.
         """
 
         assert (points_per_side is None) != (
@@ -117,7 +138,7 @@ class SamAutomaticMaskGenerator:
         if output_mode == "coco_rle":
             from pycocotools import mask as mask_utils  # type: ignore # noqa: F401
 
-        if min_mask_region_area > 0:
+        if min_mask_region_area > 0 or point_texture_thresh > 0:
             import cv2  # type: ignore # noqa: F401
 
         self.predictor = SamPredictor(model)
@@ -132,14 +153,23 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.crop_batch_size = max(int(crop_batch_size), 1)
+        self.postprocess_workers = max(int(postprocess_workers), 1)
+        self.point_texture_thresh = point_texture_thresh
+        self.low_res_stability = low_res_stability
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self, image: np.ndarray, exclude_mask: Optional[np.ndarray] = None
+    ) -> List[Dict[str, Any]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          exclude_mask (np.ndarray or None): An HW bool array of regions that
+            are already segmented, e.g. tracked objects. Grid points inside it
+            are not prompted, and crops left without points are not encoded.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -160,7 +190,7 @@ class SamAutomaticMaskGenerator:
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, exclude_mask)
 
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
@@ -168,6 +198,7 @@ class SamAutomaticMaskGenerator:
                 mask_data,
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
+                self.postprocess_workers,
             )
 
         # Encode masks
@@ -176,7 +207,7 @@ class SamAutomaticMaskGenerator:
         elif self.output_mode == "binary_mask":
             mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
         else:
-            mask_data["segmentations"] = mask_data["rles"]
+            mask_data["segmentations"] = [rle_to_coco_format(rle) for rle in mask_data["rles"]]
 
         # Write mask records
         curr_anns = []
@@ -194,17 +225,64 @@ class SamAutomaticMaskGenerator:
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(
+        self, image: np.ndarray, exclude_mask: Optional[np.ndarray] = None
+    ) -> MaskData:
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
-        data = MaskData()
+        # Only prompt where new objects can appear
+        texture = texture_map(image) if self.point_texture_thresh > 0 else None
+        crop_points = []
         for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+            x0, y0, x1, y1 = crop_box
+            points_for_image = self.point_grids[layer_idx] * np.array([[x1 - x0, y1 - y0]])
+            if exclude_mask is not None or texture is not None:
+                points_for_image = prune_points(
+                    points_for_image, crop_box, exclude_mask, texture, self.point_texture_thresh
+                )
+            crop_points.append(points_for_image)
+
+        # Iterate over image crops, up to crop_batch_size crops of the same
+        # layer share one image encoder forward
+        batches: List[Tuple[List[List[int]], List[np.ndarray], int]] = []
+        for crop_box, points_for_image, layer_idx in zip(crop_boxes, crop_points, layer_idxs):
+            if len(points_for_image) == 0:
+                continue
+            if (
+                len(batches) == 0
+                or batches[-1][2] != layer_idx
+                or len(batches[-1][0]) == self.crop_batch_size
+            ):
+                batches.append(([], [], layer_idx))
+            batches[-1][0].append(crop_box)
+            batches[-1][1].append(points_for_image)
+
+        if len(batches) == 0:
+            data = MaskData(
+                rles=[],
+                boxes=torch.zeros(0, 4),
+                iou_preds=torch.zeros(0),
+                points=torch.zeros(0, 2),
+                stability_score=torch.zeros(0),
+                crop_boxes=torch.zeros(0, 4),
+            )
+            data.to_numpy()
+            return data
+
+        data = MaskData()
+        for batch_boxes, batch_points, layer_idx in batches:
+            if len(batch_boxes) > 1:
+                features = self._encode_crops(image, batch_boxes)
+            else:
+                features = [None]
+            for crop_box, points_for_image, crop_features in zip(batch_boxes, batch_points, features):
+                crop_data = self._process_crop(
+                    image, crop_box, layer_idx, orig_size, crop_features, points_for_image
+                )
+                data.cat(crop_data)
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -228,16 +306,23 @@ class SamAutomaticMaskGenerator:
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        features: Optional[torch.Tensor] = None,
+        points_for_image: Optional[np.ndarray] = None,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
+        # Crop the image and calculate embeddings, unless they were computed
+        # with the other crops of the batch
         x0, y0, x1, y1 = crop_box
         cropped_im = image[y0:y1, x0:x1, :]
         cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        if features is None:
+            self.predictor.set_image(cropped_im)
+        else:
+            self.predictor.set_features(features[None], cropped_im_size)
 
         # Get points for this crop
-        points_scale = np.array(cropped_im_size)[None, ::-1]
-        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        if points_for_image is None:
+            points_scale = np.array(cropped_im_size)[None, ::-1]
+            points_for_image = self.point_grids[crop_layer_idx] * points_scale
 
         # Generate masks for this crop in batches
         data = MaskData()
@@ -263,6 +348,25 @@ class SamAutomaticMaskGenerator:
 
         return data
 
+    def _encode_crops(self, image: np.ndarray, crop_boxes: List[List[int]]) -> torch.Tensor:
+        """
+        Image embeddings of several crops in one image encoder forward. Every
+        crop is resized and padded to the encoder input size as in set_image.
+
+        Returns:
+          (torch.Tensor): The embeddings in BxCxHxW format, one per crop box.
+        """
+        model = self.predictor.model
+        if model.image_format != "RGB":
+            image = image[..., ::-1]
+        input_images = []
+        for x0, y0, x1, y1 in crop_boxes:
+            input_image = self.predictor.transform.apply_image(image[y0:y1, x0:x1, :])
+            input_image_torch = torch.as_tensor(input_image, device=self.predictor.device)
+            input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+            input_images.append(model.preprocess(input_image_torch))
+        return model.image_encoder(torch.cat(input_images, dim=0))
+
     def _process_batch(
         self,
         points: np.ndarray,
@@ -276,33 +380,47 @@ class SamAutomaticMaskGenerator:
         transformed_points = self.predictor.transform.apply_coords(points, im_size)
         in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
         in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
-        masks, iou_preds, _ = self.predictor.predict_torch(
+        low_res_masks, iou_preds = self.predictor.predict_low_res_torch(
             in_points[:, None, :],
             in_labels[:, None],
             multimask_output=True,
-            return_logits=True,
         )
 
         # Serialize predictions and store in MaskData
         data = MaskData(
-            masks=masks.flatten(0, 1),
+            low_res_masks=low_res_masks.flatten(0, 1),
             iou_preds=iou_preds.flatten(0, 1),
-            points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
+            points=torch.as_tensor(points.repeat(low_res_masks.shape[1], axis=0)),
         )
-        del masks
+        del low_res_masks
 
-        # Filter by predicted IoU
+        # Filter by predicted IoU, before any mask is upscaled
         if self.pred_iou_thresh > 0.0:
             keep_mask = data["iou_preds"] > self.pred_iou_thresh
             data.filter(keep_mask)
 
-        # Calculate stability score
-        data["stability_score"] = calculate_stability_score(
-            data["masks"], self.predictor.model.mask_threshold, self.stability_score_offset
-        )
-        if self.stability_score_thresh > 0.0:
-            keep_mask = data["stability_score"] >= self.stability_score_thresh
-            data.filter(keep_mask)
+        if self.low_res_stability:
+            low_res_h, low_res_w = self.predictor.low_res_size(data["low_res_masks"])
+            data["stability_score"] = calculate_stability_score(
+                data["low_res_masks"][..., :low_res_h, :low_res_w],
+                self.predictor.model.mask_threshold,
+                self.stability_score_offset,
+            )
+            if self.stability_score_thresh > 0.0:
+                keep_mask = data["stability_score"] >= self.stability_score_thresh
+                data.filter(keep_mask)
+
+        # Upscale the remaining masks to the crop resolution
+        data["masks"] = self.predictor.upscale_masks(data["low_res_masks"][:, None])[:, 0]
+        del data["low_res_masks"]
+
+        if not self.low_res_stability:
+            data["stability_score"] = calculate_stability_score(
+                data["masks"], self.predictor.model.mask_threshold, self.stability_score_offset
+            )
+            if self.stability_score_thresh > 0.0:
+                keep_mask = data["stability_score"] >= self.stability_score_thresh
+                data.filter(keep_mask)
 
         # Threshold masks and calculate boxes
         data["masks"] = data["masks"] > self.predictor.model.mask_threshold
@@ -322,11 +440,12 @@ class SamAutomaticMaskGenerator:
 
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData, min_area: int, nms_thresh: float, num_workers: int = 1
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
-        box NMS to remove any new duplicates.
+        box NMS to remove any new duplicates. Every mask is cleaned on the
+        box around it, on num_workers threads (OpenCV releases the GIL).
 
         Edits mask_data in place.
 
@@ -336,24 +455,29 @@ class SamAutomaticMaskGenerator:
             return mask_data
 
         # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
+        def clean(rle: Dict[str, Any]) -> Tuple[np.ndarray, Tuple[int, int], bool]:
+            return remove_small_regions_in_box(rle, min_area)
 
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                results = list(pool.map(clean, mask_data["rles"]))
+        else:
+            results = [clean(rle) for rle in mask_data["rles"]]
 
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
+        new_boxes = []
+        scores = []
+        for mask, (x0, y0), changed in results:
+            rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+            if len(rows) == 0:
+                new_boxes.append([0, 0, 0, 0])
+            else:
+                new_boxes.append([x0 + cols[0], y0 + rows[0], x0 + cols[-1], y0 + rows[-1]])
             # Give score=0 to changed masks and score=1 to unchanged masks
             # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
+            scores.append(float(not changed))
 
         # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        boxes = torch.as_tensor(new_boxes)
         keep_by_nms = batched_nms(
             boxes.float(),
             torch.as_tensor(scores),
@@ -361,11 +485,16 @@ class SamAutomaticMaskGenerator:
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
+        # Only recalculate RLEs for masks that have changed, in one batch
+        changed = [int(i_mask) for i_mask in keep_by_nms if scores[i_mask] == 0.0]
+        if len(changed) > 0:
+            h, w = mask_data["rles"][0]["size"]
+            masks = torch.zeros(len(changed), h, w, dtype=torch.bool)
+            for mask_torch, i_mask in zip(masks, changed):
+                mask, (x0, y0), _ = results[i_mask]
+                mask_torch[y0 : y0 + mask.shape[0], x0 : x0 + mask.shape[1]] = torch.as_tensor(mask)
+            for i_mask, rle in zip(changed, mask_to_rle_pytorch(masks)):
+                mask_data["rles"][i_mask] = rle
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
         mask_data.filter(keep_by_nms)
 
@@ -7,6 +7,8 @@
 import numpy as np
 import torch
 
+import math
+
 from segment_anything.modeling import Sam
 
 from typing import Optional, Tuple
@@ -89,6 +91,30 @@ class SamPredictor:
         self.features = self.model.image_encoder(input_image)
         self.is_image_set = True
 
+    def set_features(
+        self,
+        features: torch.Tensor,
+        original_image_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Sets image embeddings computed elsewhere, e.g. for several images in
+        one image encoder forward, allowing masks to be predicted with the
+        'predict' method.
+
+        Arguments:
+          features (torch.Tensor): The image embedding, with shape 1xCxHxW.
+          original_image_size (tuple(int, int)): The size of the image
+            before transformation, in (H, W) format.
+        """
+        self.reset_image()
+
+        self.original_size = original_image_size
+        self.input_size = self.transform.get_preprocess_shape(
+            original_image_size[0], original_image_size[1], self.transform.target_length
+        )
+        self.features = features
+        self.is_image_set = True
+
     def predict(
         self,
         point_coords: Optional[np.ndarray] = None,
@@ -210,6 +236,39 @@ class SamPredictor:
             of masks and H=W=256. These low res logits can be passed to
             a subsequent iteration as mask input.
         """
+        low_res_masks, iou_predictions = self.predict_low_res_torch(
+            point_coords, point_labels, boxes, mask_input, multimask_output
+        )
+
+        # Upscale the masks to the original image resolution
+        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+
+        return masks, iou_predictions, low_res_masks
+
+    @torch.no_grad()
+    def predict_low_res_torch(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor] = None,
+        mask_input: Optional[torch.Tensor] = None,
+        multimask_output: bool = True,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Like predict_torch, without upscaling the masks to the original image
+        size, e.g. to filter candidate masks before the upscaling. See
+        predict_torch for the arguments.
+
+        Returns:
+          (torch.Tensor): The low resolution mask logits in BxCxHxW format,
+            where H=W=256 covers the padded model input (see
+            upscale_masks).
+          (torch.Tensor): An array of shape BxC containing the model's
+            predictions for the quality of each mask.
+        """
         if not self.is_image_set:
             raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
 
@@ -233,14 +292,22 @@ class SamPredictor:
             dense_prompt_embeddings=dense_embeddings,
             multimask_output=multimask_output,
         )
+        return low_res_masks, iou_predictions
 
-        # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
-
-        if not return_logits:
-            masks = masks > self.model.mask_threshold
-
-        return masks, iou_predictions, low_res_masks
+    def upscale_masks(self, low_res_masks: torch.Tensor) -> torch.Tensor:
+        """
+        Removes the padding from low resolution mask logits in BxCxHxW format
+        and upscales them to the original size of the current image.
+        """
+        return self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+
+    def low_res_size(self, low_res_masks: torch.Tensor) -> Tuple[int, int]:
+        """The (H, W) of the low resolution masks that is not padding."""
+        scale = low_res_masks.shape[-1] / self.model.image_encoder.img_size
+        return (
+            min(math.ceil(self.input_size[0] * scale), low_res_masks.shape[-2]),
+            min(math.ceil(self.input_size[1] * scale), low_res_masks.shape[-1]),
+        )
 
     def get_image_embedding(self) -> torch.Tensor:
         """
@@ -10,7 +10,7 @@ import torch
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple
 
 
 class MaskData:
@@ -72,6 +72,9 @@ class MaskData:
     def to_numpy(self) -> None:
         for k, v in self._stats.items():
             if isinstance(v, torch.Tensor):
+                if v.dtype == torch.bfloat16:
+                    # e.g. IoU predictions under CPU autocast, numpy has no bfloat16
+                    v = v.float()
                 self._stats[k] = v.detach().cpu().numpy()
 
 
@@ -107,50 +110,113 @@ def batch_iterator(batch_size: int, *args) -> Generator[List[Any], None, None]:
 def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     """
     Encodes masks to an uncompressed RLE, in the format expected by
-    pycoco tools.
+    pycoco tools, with the counts as an int32 array (see rle_to_coco_format).
+    All masks are encoded in one segmented pass over the change indices.
     """
     # Put in fortran order and flatten h,w
     b, h, w = tensor.shape
+    if b == 0:
+        return []
     tensor = tensor.permute(0, 2, 1).flatten(1)
 
-    # Compute change indices
+    # Compute change indices, sorted by mask then by position
     diff = tensor[:, 1:] ^ tensor[:, :-1]
     change_indices = diff.nonzero()
+    first_values = tensor[:, 0].detach().cpu().numpy()
+    mask_idxs = change_indices[:, 0].detach().cpu().numpy()
+    change_idxs = change_indices[:, 1].detach().cpu().numpy().astype(np.int32) + 1
 
-    # Encode run length
+    # Run boundaries of mask i are [0, change_idxs of i, h * w]
+    offsets = np.searchsorted(mask_idxs, np.arange(b + 1))
+    run_ends = np.insert(change_idxs, offsets[1:], h * w)
+    run_starts = np.insert(change_idxs, offsets[:-1], 0)
+    all_counts = np.split(run_ends - run_starts, offsets[1:-1] + np.arange(1, b))
+
+    # Counts start with a run of zeros
     out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
+    for counts, first_value in zip(all_counts, first_values):
+        if first_value != 0:
+            counts = np.concatenate([np.zeros(1, dtype=np.int32), counts])
         out.append({"size": [h, w], "counts": counts})
     return out
 
 
+def rle_to_coco_format(rle: Dict[str, Any]) -> Dict[str, Any]:
+    """Uncompressed RLE with the counts as a list, as pycoco tools and json expect."""
+    return {"size": list(rle["size"]), "counts": np.asarray(rle["counts"]).tolist()}
+
+
+def _rle_runs(rle: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """Start indices and lengths of the foreground runs, in fortran order."""
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    ends = np.cumsum(counts)
+    return (ends - counts)[1::2], counts[1::2]
+
+
+def rle_to_indices(rle: Dict[str, Any]) -> np.ndarray:
+    """
+    Indices of the foreground pixels in the fortran order flattened mask, so
+    that mask.T.flat[indices] addresses them in a HxW array.
+    """
+    starts, lengths = _rle_runs(rle)
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    # start of every pixel's run, minus the pixels of the preceding runs
+    run_offsets = starts - (np.cumsum(lengths) - lengths)
+    return np.repeat(run_offsets, lengths) + np.arange(total)
+
+
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"])
+    parity = np.arange(len(counts)) % 2 == 1
+    mask = np.repeat(parity, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
 
 def area_from_rle(rle: Dict[str, Any]) -> int:
-    return sum(rle["counts"][1::2])
+    return int(np.asarray(rle["counts"])[1::2].sum())
+
+
+def box_from_rle(rle: Dict[str, Any]) -> np.ndarray:
+    """
+    Calculates the box in XYXY format around an RLE mask, as
+    batched_mask_to_box does for a dense mask. Returns [0,0,0,0] for
+    an empty mask.
+    """
+    h, w = rle["size"]
+    starts, lengths = _rle_runs(rle)
+    keep = lengths > 0
+    if not np.any(keep):
+        return np.zeros(4, dtype=np.int64)
+    starts, ends = starts[keep], starts[keep] + lengths[keep] - 1
+    # a run that spans columns covers every row between its ends
+    same_column = starts // h == ends // h
+    y0 = np.where(same_column, starts % h, 0).min()
+    y1 = np.where(same_column, ends % h, h - 1).max()
+    return np.array([starts[0] // h, y0, ends[-1] // h, y1])
+
+
+def rle_intersection(rle_a: Dict[str, Any], rle_b: Dict[str, Any]) -> int:
+    """Number of foreground pixels two RLE masks of the same size share."""
+    ends_a = np.cumsum(np.asarray(rle_a["counts"], dtype=np.int64))
+    ends_b = np.cumsum(np.asarray(rle_b["counts"], dtype=np.int64))
+    # segments on which neither mask changes value
+    bounds = np.union1d(ends_a, ends_b)
+    starts = np.concatenate([[0], bounds[:-1]])
+    in_a = np.searchsorted(ends_a, starts, side="right") % 2 == 1
+    in_b = np.searchsorted(ends_b, starts, side="right") % 2 == 1
+    return int((bounds - starts)[in_a & in_b].sum())
+
+
+def rle_iou(rle_a: Dict[str, Any], rle_b: Dict[str, Any]) -> float:
+    """IoU of two RLE masks of the same size, 0 if both are empty."""
+    intersection = rle_intersection(rle_a, rle_b)
+    union = area_from_rle(rle_a) + area_from_rle(rle_b) - intersection
+    return intersection / union if union > 0 else 0.0
 
 
 def calculate_stability_score(
@@ -264,6 +330,55 @@ def uncrop_masks(
     return torch.nn.functional.pad(masks, pad, value=0)
 
 
+def texture_map(image: np.ndarray, stride: int = 4, window: int = 5) -> np.ndarray:
+    """
+    Cheap texture measure of an HWC uint8 image: the mean absolute gray level
+    gradient over window x window pixels of the image downscaled by stride.
+    Returns an array of shape (ceil(H / stride), ceil(W / stride)).
+    """
+    import cv2  # type: ignore
+
+    h, w = image.shape[:2]
+    small_size = (math.ceil(w / stride), math.ceil(h / stride))
+    gray = cv2.resize(np.ascontiguousarray(image), small_size, interpolation=cv2.INTER_AREA)
+    gray = gray.astype(np.float32)
+    if gray.ndim == 3:
+        gray = gray.mean(axis=2)
+    gradient = np.abs(cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)) + np.abs(
+        cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    )
+    return cv2.blur(gradient, (window, window))
+
+
+def prune_points(
+    points: np.ndarray,
+    crop_box: List[int],
+    exclude_mask: Optional[np.ndarray] = None,
+    texture: Optional[np.ndarray] = None,
+    texture_thresh: float = 0.0,
+    texture_stride: int = 4,
+) -> np.ndarray:
+    """
+    Drops point prompts where no new object can appear: inside exclude_mask
+    (HxW bool in the original image frame, e.g. the tracked objects) or
+    where texture (see texture_map) is below texture_thresh. Points are
+    given in XY format relative to crop_box.
+    """
+    x0, y0, _, _ = crop_box
+    keep = np.ones(len(points), dtype=bool)
+    xs = points[:, 0].astype(np.int64) + x0
+    ys = points[:, 1].astype(np.int64) + y0
+    if exclude_mask is not None:
+        h, w = exclude_mask.shape
+        keep &= ~exclude_mask[np.clip(ys, 0, h - 1), np.clip(xs, 0, w - 1)]
+    if texture is not None and texture_thresh > 0:
+        h, w = texture.shape
+        texture_ys = np.clip(ys // texture_stride, 0, h - 1)
+        texture_xs = np.clip(xs // texture_stride, 0, w - 1)
+        keep &= texture[texture_ys, texture_xs] >= texture_thresh
+    return points[keep]
+
+
 def remove_small_regions(
     mask: np.ndarray, area_thresh: float, mode: str
 ) -> Tuple[np.ndarray, bool]:
@@ -291,11 +406,60 @@ def remove_small_regions(
     return mask, True
 
 
+def remove_small_regions_in_box(
+    rle: Dict[str, Any], area_thresh: float
+) -> Tuple[np.ndarray, Tuple[int, int], bool]:
+    """
+    remove_small_regions in 'holes' then 'islands' mode, on the box around an
+    RLE mask instead of the full frame. The crop gets a one pixel border of
+    background on every side where the frame continues past the box, weighted
+    by the frame area it stands for, so holes connected to the outside keep
+    their full-frame size. Falls back to the full frame in the rare case that
+    this outside region itself is a small hole.
+
+    Returns the cleaned mask cropped to the box, the (x, y) offset of the
+    crop in the frame and an indicator of if the mask has been modified.
+    """
+    import cv2  # type: ignore
+
+    h, w = rle["size"]
+    x0, y0, x1, y1 = (int(v) for v in box_from_rle(rle))
+    crop_h, crop_w = y1 - y0 + 1, x1 - x0 + 1
+    indices = rle_to_indices(rle)
+    crop = np.zeros((crop_h, crop_w), dtype=bool)
+    crop[indices % h - y0, indices // h - x0] = True
+
+    # Holes: background regions of the padded crop
+    top, bottom, left, right = int(y0 > 0), int(y1 < h - 1), int(x0 > 0), int(x1 < w - 1)
+    working_mask = np.pad(~crop, ((top, bottom), (left, right)), constant_values=True)
+    row_weights = np.array([y0] * top + [1] * crop_h + [h - 1 - y1] * bottom)
+    col_weights = np.array([x0] * left + [1] * crop_w + [w - 1 - x1] * right)
+    n_labels, regions, _, _ = cv2.connectedComponentsWithStats(working_mask.astype(np.uint8), 8)
+    sizes = np.bincount(
+        regions.ravel(), np.outer(row_weights, col_weights).ravel(), minlength=n_labels
+    )[1:]
+    inner = regions[top : top + crop_h, left : left + crop_w]
+    small_regions = np.flatnonzero(sizes < area_thresh) + 1
+    changed = len(small_regions) > 0
+    if changed:
+        border = np.ones(regions.shape, dtype=bool)
+        border[top : top + crop_h, left : left + crop_w] = False
+        if np.isin(regions[border], small_regions).any():
+            mask, holes_changed = remove_small_regions(rle_to_mask(rle), area_thresh, mode="holes")
+            mask, islands_changed = remove_small_regions(mask, area_thresh, mode="islands")
+            return mask, (0, 0), holes_changed or islands_changed
+        crop = np.isin(inner, np.concatenate([[0], small_regions]))
+
+    # Islands: foreground regions never leave the box
+    crop, islands_changed = remove_small_regions(crop, area_thresh, mode="islands")
+    return crop, (x0, y0), changed or islands_changed
+
+
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     from pycocotools import mask as mask_utils  # type: ignore
 
     h, w = uncompressed_rle["size"]
-    rle = mask_utils.frPyObjects(uncompressed_rle, h, w)
+    rle = mask_utils.frPyObjects(rle_to_coco_format(uncompressed_rle), h, w)
     rle["counts"] = rle["counts"].decode("utf-8")  # Necessary to serialize with json
     return rle
 
@@ -8,6 +8,9 @@ import torch
 import gc
 import imageio
 from scipy.ndimage import binary_dilation
+from tool.mask_analytics import label_boundaries
+from tool.video_pipeline import FrameReader, FrameWriterPool, PipelineStats
+from tool.device import autocast
 
 def save_prediction(pred_mask,output_dir,file_name):
     save_mask = Image.fromarray(pred_mask.astype(np.uint8))
@@ -26,24 +29,12 @@ def draw_mask(img, mask, alpha=0.5, id_countour=False):
     img_mask = np.zeros_like(img)
     img_mask = img
     if id_countour:
-        # very slow ~ 1s per image
-        obj_ids = np.unique(mask)
-        obj_ids = obj_ids[obj_ids!=0]
-
-        for id in obj_ids:
-            # Overlay color on  binary mask
-            if id <= 255:
-                color = _palette[id*3:id*3+3]
-            else:
-                color = [0,0,0]
-            foreground = img * (1-alpha) + np.ones_like(img) * alpha * np.array(color)
-            binary_mask = (mask == id)
-
-            # Compose image
-            img_mask[binary_mask] = foreground[binary_mask]
-
-            countours = binary_dilation(binary_mask,iterations=1) ^ binary_mask
-            img_mask[countours, :] = 0
+        # outlines between touching objects as well, one pass for all ids
+        binary_mask = (mask!=0)
+        countours = label_boundaries(mask)
+        foreground = img*(1-alpha)+colorize_mask(mask)*alpha
+        img_mask[binary_mask] = foreground[binary_mask]
+        img_mask[countours,:] = 0
     else:
         binary_mask = (mask!=0)
         countours = binary_dilation(binary_mask,iterations=1) ^ binary_mask
@@ -70,8 +61,8 @@ aot_model2ckpt = {
 }
 
 
-def tracking_objects_in_video(SegTracker, input_video, input_img_seq, fps, frame_num=0):
-    
+def tracking_objects_in_video(SegTracker, input_video, input_img_seq, fps, frame_num=0, pipeline=False):
+    # pipeline: video input only, see video_type_input_tracking_pipelined (no GIF output)
     if input_video is not None:
         video_name = os.path.basename(input_video).split('.')[0]
     elif input_img_seq is not None:
@@ -95,6 +86,8 @@ def tracking_objects_in_video(SegTracker, input_video, input_img_seq, fps, frame
     }
 
     if input_video is not None:
+        if pipeline:
+            return video_type_input_tracking_pipelined(SegTracker, input_video, io_args, video_name, frame_num)
         return video_type_input_tracking(SegTracker, input_video, io_args, video_name, frame_num)
     elif input_img_seq is not None:
         return img_seq_type_input_tracking(SegTracker, io_args, video_name, imgs_path, fps, frame_num)
@@ -129,37 +122,34 @@ def video_type_input_tracking(SegTracker, input_video, io_args, video_name, fram
     create_dir(io_args['output_mask_dir'])
     create_dir(io_args['output_masked_frame_dir'])
 
-    torch.cuda.empty_cache()
-    gc.collect()
-    sam_gap = SegTracker.sam_gap
+    SegTracker.memory_policy.release()
+    SegTracker.keyframe_scheduler.reset()
     frame_idx = 0
 
-    with torch.cuda.amp.autocast():
+    with autocast(SegTracker.device):
         while cap.isOpened():
             ret, frame  = cap.read()  
             if not ret:
                 break
             frame = cv2.cvtColor(frame,cv2.COLOR_BGR2RGB)
+            keyframe = SegTracker.keyframe_scheduler.is_keyframe(frame_idx, frame)
             
             if frame_idx == 0:
                 pred_mask = SegTracker.first_frame_mask
-                torch.cuda.empty_cache()
-                gc.collect()
-            elif (frame_idx % sam_gap) == 0:
-                seg_mask = SegTracker.seg(frame)
-                torch.cuda.empty_cache()
-                gc.collect()
-                track_mask = SegTracker.track(frame)
+            elif keyframe:
+                track_mask = SegTracker.track(frame, frame_idx=frame_idx + frame_num)
+                # only prompt SAM outside the tracked objects
+                seg_mask = SegTracker.seg(frame, track_mask)
                 # find new objects, and update tracker with new objects
                 new_obj_mask = SegTracker.find_new_objs(track_mask,seg_mask)
                 save_prediction(new_obj_mask, output_mask_dir, str(frame_idx+frame_num).zfill(5) + '_new.png')
                 pred_mask = track_mask + new_obj_mask
                 # segtracker.restart_tracker()
-                SegTracker.add_reference(frame, pred_mask)
+                SegTracker.retire_lost_objects(track_mask)
+                SegTracker.add_objects(frame, pred_mask, frame_idx=frame_idx + frame_num)
             else:
-                pred_mask = SegTracker.track(frame,update_memory=True)
-            torch.cuda.empty_cache()
-            gc.collect()
+                pred_mask = SegTracker.track(frame,update_memory=True,frame_idx=frame_idx + frame_num)
+            SegTracker.memory_policy.step(frame_idx, keyframe=keyframe)
             
             save_prediction(pred_mask, output_mask_dir, str(frame_idx + frame_num).zfill(5) + '.png')
             pred_list.append(pred_mask)
@@ -168,6 +158,8 @@ def video_type_input_tracking(SegTracker, input_video, io_args, video_name, fram
             frame_idx += 1
         cap.release()
         print('\nfinished')
+        print(SegTracker.memory_policy.summary())
+        print(SegTracker.keyframe_scheduler.summary())
     
     ##################
     # Visualization
@@ -229,6 +221,98 @@ def video_type_input_tracking(SegTracker, input_video, io_args, video_name, fram
     return io_args['output_video'], f"{io_args['tracking_result_dir']}/{video_name}_pred_mask.zip"
 
 
+def video_type_input_tracking_pipelined(SegTracker, input_video, io_args, video_name, frame_num=0,
+                                        prefetch=8, num_writers=2, max_pending=16):
+    '''
+    Same outputs as video_type_input_tracking except the GIF, produced in a single pass over the video.
+    Decoding runs on a reader thread `prefetch` frames ahead, palette PNGs and the
+    overlay video are encoded on writer threads, and tracking stays on this thread.
+    Both queues are bounded and every frame is written out once done, so memory does
+    not grow with the video length. For that reason no GIF is saved: the GIF encoders
+    hold all frames until the file is closed. The overlays are kept as PNGs in
+    output_masked_frame_dir.
+    '''
+    stats = PipelineStats()
+    reader = FrameReader(input_video, prefetch=prefetch, skip=frame_num, stats=stats)
+    writers = FrameWriterPool(num_workers=num_writers, max_pending=max_pending, stats=stats)
+
+    # create dir to save predicted mask and masked frame
+    if frame_num == 0:
+        if os.path.isdir(io_args['output_mask_dir']):
+            os.system(f"rm -r {io_args['output_mask_dir']}")
+        if os.path.isdir(io_args['output_masked_frame_dir']):
+            os.system(f"rm -r {io_args['output_masked_frame_dir']}")
+    output_mask_dir = io_args['output_mask_dir']
+    create_dir(io_args['output_mask_dir'])
+    create_dir(io_args['output_masked_frame_dir'])
+
+    fourcc =  cv2.VideoWriter_fourcc(*"mp4v")
+    out = cv2.VideoWriter(io_args['output_video'], fourcc, reader.fps, (reader.width, reader.height))
+
+    # frames tracked by a previous run are only re-encoded into the video
+    if frame_num > 0:
+        output_masked_frame_name = sorted([img_name for img_name in os.listdir(io_args['output_masked_frame_dir'])])
+        for i in range(0, frame_num):
+            masked_frame = cv2.imread(os.path.join(io_args['output_masked_frame_dir'], output_masked_frame_name[i]))
+            out.write(masked_frame)
+
+    def write_overlay(frame, pred_mask, file_name):
+        masked_frame = draw_mask(frame, pred_mask)
+        cv2.imwrite(f"{io_args['output_masked_frame_dir']}/{file_name}", masked_frame[:, :, ::-1])
+        out.write(cv2.cvtColor(masked_frame,cv2.COLOR_RGB2BGR))
+
+    SegTracker.memory_policy.release()
+    SegTracker.keyframe_scheduler.reset()
+    frame_idx = 0
+
+    try:
+        with autocast(SegTracker.device):
+            for _, frame in reader:
+                keyframe = SegTracker.keyframe_scheduler.is_keyframe(frame_idx, frame)
+                with stats.timed('track'):
+                    if frame_idx == 0:
+                        pred_mask = SegTracker.first_frame_mask
+                    elif keyframe:
+                        track_mask = SegTracker.track(frame, frame_idx=frame_idx + frame_num)
+                        # only prompt SAM outside the tracked objects
+                        seg_mask = SegTracker.seg(frame, track_mask)
+                        # find new objects, and update tracker with new objects
+                        new_obj_mask = SegTracker.find_new_objs(track_mask,seg_mask)
+                        writers.submit('save_mask', save_prediction, new_obj_mask, output_mask_dir, str(frame_idx+frame_num).zfill(5) + '_new.png')
+                        pred_mask = track_mask + new_obj_mask
+                        SegTracker.retire_lost_objects(track_mask)
+                        SegTracker.add_objects(frame, pred_mask, frame_idx=frame_idx + frame_num)
+                    else:
+                        pred_mask = SegTracker.track(frame,update_memory=True,frame_idx=frame_idx + frame_num)
+                    SegTracker.memory_policy.step(frame_idx, keyframe=keyframe)
+
+                file_name = str(frame_idx + frame_num).zfill(5) + '.png'
+                writers.submit('save_mask', save_prediction, pred_mask, output_mask_dir, file_name)
+                writers.submit('overlay', write_overlay, frame, pred_mask, file_name, ordered=True)
+
+                print("processed frame {}, obj_num {}".format(frame_idx + frame_num, SegTracker.get_obj_num()),end='\r')
+                frame_idx += 1
+    finally:
+        reader.close()
+        writers.close()
+        out.release()
+    print('\nfinished')
+    print(stats.report())
+    print(SegTracker.memory_policy.summary())
+    print(SegTracker.keyframe_scheduler.summary())
+    print("{} saved".format(io_args['output_video']))
+
+    # zip predicted mask
+    os.system(f"zip -r {io_args['tracking_result_dir']}/{video_name}_pred_mask.zip {io_args['output_mask_dir']}")
+
+    # manually release memory (after cuda out of memory)
+    del SegTracker
+    torch.cuda.empty_cache()
+    gc.collect()
+
+    return io_args['output_video'], f"{io_args['tracking_result_dir']}/{video_name}_pred_mask.zip"
+
+
 def img_seq_type_input_tracking(SegTracker, io_args, video_name, imgs_path, fps, frame_num=0):
 
     pred_list = []
@@ -255,12 +339,11 @@ def img_seq_type_input_tracking(SegTracker, io_args, video_name, imgs_path, fps,
 
     i_frame_num = frame_num
 
-    torch.cuda.empty_cache()
-    gc.collect()
-    sam_gap = SegTracker.sam_gap
+    SegTracker.memory_policy.release()
+    SegTracker.keyframe_scheduler.reset()
     frame_idx = 0
 
-    with torch.cuda.amp.autocast():
+    with autocast(SegTracker.device):
         for img_path in imgs_path:
             if i_frame_num > 0:
                 i_frame_num = i_frame_num - 1
@@ -269,26 +352,24 @@ def img_seq_type_input_tracking(SegTracker, io_args, video_name, imgs_path, fps,
             frame_name = os.path.basename(img_path).split('.')[0]
             frame = cv2.imread(img_path)
             frame = cv2.cvtColor(frame,cv2.COLOR_BGR2RGB)
+            keyframe = SegTracker.keyframe_scheduler.is_keyframe(frame_idx, frame)
             
             if frame_idx == 0:
                 pred_mask = SegTracker.first_frame_mask
-                torch.cuda.empty_cache()
-                gc.collect()
-            elif (frame_idx % sam_gap) == 0:
-                seg_mask = SegTracker.seg(frame)
-                torch.cuda.empty_cache()
-                gc.collect()
-                track_mask = SegTracker.track(frame)
+            elif keyframe:
+                track_mask = SegTracker.track(frame, frame_idx=frame_idx + frame_num)
+                # only prompt SAM outside the tracked objects
+                seg_mask = SegTracker.seg(frame, track_mask)
                 # find new objects, and update tracker with new objects
                 new_obj_mask = SegTracker.find_new_objs(track_mask,seg_mask)
                 save_prediction(new_obj_mask, output_mask_dir, f'{frame_name}_new.png')
                 pred_mask = track_mask + new_obj_mask
                 # segtracker.restart_tracker()
-                SegTracker.add_reference(frame, pred_mask)
+                SegTracker.retire_lost_objects(track_mask)
+                SegTracker.add_objects(frame, pred_mask, frame_idx=frame_idx + frame_num)
             else:
-                pred_mask = SegTracker.track(frame,update_memory=True)
-            torch.cuda.empty_cache()
-            gc.collect()
+                pred_mask = SegTracker.track(frame,update_memory=True,frame_idx=frame_idx + frame_num)
+            SegTracker.memory_policy.step(frame_idx, keyframe=keyframe)
             
             save_prediction(pred_mask, output_mask_dir, f'{frame_name}.png')
             pred_list.append(pred_mask)
@@ -296,6 +377,8 @@ def img_seq_type_input_tracking(SegTracker, io_args, video_name, imgs_path, fps,
             print("processed frame {}, obj_num {}".format(frame_idx+frame_num, SegTracker.get_obj_num()),end='\r')
             frame_idx += 1
         print('\nfinished')
+        print(SegTracker.memory_policy.summary())
+        print(SegTracker.keyframe_scheduler.summary())
     
     ##################
     # Visualization
@@ -1,4 +1,5 @@
 from tool.detector import Detector
+from tool.device import resolve_device, set_num_threads
 
 import os
 import json
@@ -26,8 +27,12 @@ app.add_middleware(
 
 logging.basicConfig(level=logging.INFO)
 
+if resolve_device(os.environ.get("DEVICE")).type == "cpu":
+    # cores of the node are shared by NUM_WORKERS replicas
+    logging.info(f"CPU threads: {set_num_threads(num_workers=int(os.environ.get('NUM_WORKERS', 1)))}")
+
 logging.info("Loading grounding-dino")
-detector = Detector("cuda",
+detector = Detector(resolve_device(os.environ.get("DEVICE")),
                 config_file = "/home/parvus/src/hack/Segment-and-Track-Anything/src/groundingdino/groundingdino/config/GroundingDINO_SwinT_OGC.py",
                 grounding_dino_ckpt = '/home/parvus/src/hack/Segment-and-Track-Anything/ckpt/groundingdino_swint_ogc.pth')
 logging.info("Loaded grounding-dino")
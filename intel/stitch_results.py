@@ -1,21 +1,20 @@
 import os
-import json
 import cv2
 from scipy.ndimage import binary_dilation
 from aot_tracker import _palette
 from PIL import Image
 import numpy as np
 import pickle
+from tool.mask_store import MaskStoreReader
 
+# overlay video of the captions tracked by demo_inst.py, same VIDEO and CAPTION,
+# the merged per-frame JSON is written by demo_inst.py
 video_id = os.environ["VIDEO"]
+simple_captions = [caption.split(".")[0] for caption in os.environ["CAPTION"].split(",") if caption]
 
 video_file = f"./assets/{video_id}.mp4"
-json_file = f"./assets/{video_id}.json"
 output_video = f"./assets/output/{video_id}_seg.mp4"
-label_files = [
-    f"./assets/output/{video_id}_tank",
-    f"./assets/output/{video_id}_smoke",
-]
+label_files = [f"./assets/output/{video_id}_{caption}" for caption in simple_captions]
 
 def colorize_mask(pred_mask):
     save_mask = Image.fromarray(pred_mask.astype(np.uint8))
@@ -62,8 +61,8 @@ for file in label_files:
     with open(file + "_output.pkl", "rb") as f:
         labels.append(pickle.load(f))
     print(f"loaded labels for {file}")
-    masks.append(np.load(file + "_masks.npy").tolist())
-    print(f"loaded mesh for {file}")
+    masks.append(MaskStoreReader(file + "_masks.bin"))
+    print(f"opened masks for {file}")
 
 cap = cv2.VideoCapture(video_file)
 
@@ -84,7 +83,6 @@ line_space = 30
 
 frame_idx = 0
 
-merged_json = []
 while cap.isOpened():
     ret, frame = cap.read()
     if not ret:
@@ -92,32 +90,25 @@ while cap.isOpened():
     
     frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
-    json_per_frame = []
     for all_label, mask in zip(labels, masks):
-        frame = draw_mask(frame, np.array(mask[frame_idx]))
+        frame = draw_mask(frame, mask[frame_idx])
         one_labels = all_label[frame_idx]
         for label in one_labels:
             if "id" not in label:
                 continue
 
-            json_per_frame.append(label)
             id = label["id"]
             prompt = label["prompt"]
             centroid = label["centroid"]
 
             frame = cv2.putText(frame, f"{id} - {prompt}", centroid, font, font_scale, color, thickness)
-    
-    merged_json.append(json_per_frame)
 
     masked_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
     out.write(masked_frame)
     print("frame {} written".format(frame_idx), end="\r")
     frame_idx += 1
 
-with open(json_file, "w") as f:
-    json.dump(merged_json, f)
-
-print("finished writing JSON")
-
 out.release()
-cap.release()
\ No newline at end of file
+cap.release()
+for mask in masks:
+    mask.close()
\ No newline at end of file
@@ -10,20 +10,23 @@ from groundingdino.util.inference import annotate, load_image, predict
 import groundingdino.datasets.transforms as T
 
 from torchvision.ops import box_convert
+from tool.device import resolve_device
 
 class Detector:
     def __init__(self, 
                  device, 
                  config_file = "src/groundingdino/groundingdino/config/GroundingDINO_SwinT_OGC.py",
                  grounding_dino_ckpt = './ckpt/groundingdino_swint_ogc.pth'):
+        device = resolve_device(device)
         args = SLConfig.fromfile(config_file) 
-        args.device = device
+        args.device = str(device)
         self.deivce = device
         self.gd = build_grounding_dino(args)
 
         checkpoint = torch.load(grounding_dino_ckpt, map_location='cpu')
         log = self.gd.load_state_dict(clean_state_dict(checkpoint['model']), strict=False)
         print("Model loaded from {} \n => {}".format(grounding_dino_ckpt, log))
+        self.gd.to(device)
         self.gd.eval()
     
     def image_transform_grounding(self, init_image):
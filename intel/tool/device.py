@@ -0,0 +1,189 @@
+import os
+import time
+import contextlib
+from functools import lru_cache
+import torch
+
+# One place that decides where SegTracker runs. Everything else asks for a
+# torch.device here instead of calling .cuda(gpu_id), so the whole stack runs
+# on CPU-only nodes.
+
+
+def resolve_device(device=None, gpu_id=0):
+    '''
+    Arguments:
+        device: None / 'auto' (CUDA when available, else CPU), 'cpu', 'cuda',
+            'cuda:1', an int gpu id or a torch.device
+        gpu_id: CUDA device used by None / 'auto' / 'cuda'
+    Return:
+        torch.device
+    '''
+    if isinstance(device, torch.device):
+        return device
+    if isinstance(device, int):
+        return torch.device('cuda', device)
+    if device is None or device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device == 'cuda':
+        return torch.device('cuda', gpu_id)
+    return torch.device(device)
+
+
+@lru_cache(maxsize=1)
+def cpu_supports_bf16():
+    # native bf16 (avx512_bf16 / amx) makes CPU autocast faster than fp32,
+    # elsewhere bf16 is emulated and slower
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def autocast(device, enabled=True):
+    '''
+    Mixed precision context for device: fp16 autocast on CUDA, bf16 autocast
+    on CPUs with native bf16, a no-op otherwise.
+    '''
+    device = resolve_device(device)
+    if not enabled:
+        return contextlib.nullcontext()
+    if device.type == 'cuda':
+        return torch.autocast('cuda', dtype=torch.float16)
+    if device.type == 'cpu' and cpu_supports_bf16():
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def channels_last(module_or_tensor, device):
+    '''
+    Use NHWC memory format on CPU, where oneDNN convolutions are faster with
+    it. Tensors / modules on other devices are returned unchanged.
+    '''
+    if resolve_device(device).type != 'cpu':
+        return module_or_tensor
+    if isinstance(module_or_tensor, torch.Tensor):
+        if module_or_tensor.dim() != 4:
+            return module_or_tensor
+        return module_or_tensor.contiguous(memory_format=torch.channels_last)
+    return module_or_tensor.to(memory_format=torch.channels_last)
+
+
+def set_num_threads(num_threads=None, num_workers=1):
+    '''
+    Split the cores of the node between worker processes.
+    Arguments:
+        num_threads: intra-op threads of this worker, None divides
+            os.cpu_count() by num_workers
+        num_workers: number of workers sharing the node
+    Return:
+        num_threads: the value that was set
+    '''
+    if num_threads is None:
+        num_threads = max((os.cpu_count() or 1) // max(num_workers, 1), 1)
+    torch.set_num_threads(num_threads)
+    try:
+        import cv2
+        cv2.setNumThreads(num_threads)
+    except ImportError:
+        pass
+    return num_threads
+
+
+def synchronize(device):
+    if resolve_device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class Timer():
+    def __init__(self, device):
+        '''
+        Wall clock timer that waits for queued kernels, replaces
+        torch.cuda.Event timing on any device.
+        '''
+        self.device = resolve_device(device)
+        self.elapsed = 0.
+
+    def __enter__(self):
+        synchronize(self.device)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        synchronize(self.device)
+        self.elapsed = time.perf_counter() - self.start
+
+
+def _benchmark(aot_model='r50_deaotl', sam_model='vit_b', size=(480, 864), num_frames=5,
+               points_per_side=8):
+    # CPU reference for fp32 / channels-last / bf16 autocast on the real
+    # stack with random weights: AOT propagate + decode per frame
+    # (build_vos_model + AOTInferEngine) and one SAM everything pass
+    # (SamAutomaticMaskGenerator.generate), run from intel/:
+    # python -m tool.device
+    import sys
+    import importlib
+    sys.path.append('./aot')
+    sys.path.append('./sam')
+    from networks.models import build_vos_model
+    from networks.engines import build_engine
+    from sam.segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+    device = resolve_device('cpu')
+    num_threads = set_num_threads()
+    torch.manual_seed(0)
+    cfg = importlib.import_module('configs.pre_ytb_dav').EngineConfig('benchmark', aot_model)
+    cfg.MODEL_ENCODER_PRETRAIN = ''
+    aot = build_vos_model(cfg.MODEL_VOS, cfg).eval()
+    sam = sam_model_registry[sam_model]().eval()
+    frames = [torch.randn(1, 3, size[0], size[1]) for _ in range(num_frames + 2)]
+    mask = torch.zeros(1, 1, size[0], size[1])
+    mask[:, :, size[0] // 4:size[0] // 2, size[1] // 4:size[1] // 2] = 1
+    mask[:, :, size[0] // 2:, size[1] // 2:] = 2
+    image = torch.randint(0, 256, (size[0], size[1], 3), dtype=torch.uint8).numpy()
+
+    def track(frames):
+        engine = build_engine(cfg.MODEL_ENGINE, phase='eval', aot_model=aot, gpu_id=0,
+                              long_term_mem_gap=2)
+        engine.add_reference_frame(frames[0], mask, obj_nums=[2], frame_step=0)
+
+        def step(frame):
+            engine.match_propogate_one_frame(frame)
+            pred_logit = engine.decode_current_logits(size)
+            engine.update_memory(torch.argmax(pred_logit, dim=1, keepdim=True).float())
+
+        step(frames[1])  # warm-up
+        with Timer(device) as timer:
+            for frame in frames[2:]:
+                step(frame)
+        return timer.elapsed / num_frames * 1000
+
+    def segment():
+        # no IoU / stability filter, random weights would keep no mask and
+        # skip the postprocessing
+        generator = SamAutomaticMaskGenerator(sam, points_per_side=points_per_side,
+                                              pred_iou_thresh=0., stability_score_thresh=0.)
+        generator.generate(image)  # warm-up
+        with Timer(device) as timer:
+            masks = generator.generate(image)
+        return timer.elapsed * 1000, len(masks)
+
+    bf16 = 'channels_last+bf16' + ('' if cpu_supports_bf16() else ' (emulated)')
+    for name in ('fp32', 'channels_last', bf16):
+        if name != 'fp32':
+            # modules convert in place, the bf16 run keeps channels-last
+            channels_last(aot, device)
+            channels_last(sam, device)
+        inputs = [channels_last(frame, device) for frame in frames] if name != 'fp32' else frames
+        # tool.device.autocast skips emulated bf16, the benchmark shows why
+        precision = torch.autocast('cpu', dtype=torch.bfloat16) if name == bf16 else contextlib.nullcontext()
+        with torch.no_grad(), precision:
+            aot_ms = track(inputs)
+            sam_ms, num_masks = segment()
+        print(f'{name:30s}: {aot_model} {aot_ms:8.2f} ms/frame, {sam_model} everything '
+              f'{sam_ms:9.2f} ms ({points_per_side}x{points_per_side} points, {num_masks} masks), '
+              f'{num_threads} threads')
+
+
+if __name__ == '__main__':
+    _benchmark()
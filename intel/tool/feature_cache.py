@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+# Encoder outputs of recent frames, so a frame that is tracked and then added
+# as a reference (keyframes), or tracked again after a refinement, goes
+# through the backbone once.
+
+
+class FeatureCache():
+    def __init__(self, capacity=8):
+        '''
+        LRU cache of encoder outputs keyed by frame index.
+        Arguments:
+            capacity: number of frames kept, the least recently used frame is
+                evicted first
+        '''
+        self.capacity = max(int(capacity), 1)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+        Return:
+            the cached value, None on a miss
+        '''
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def summary(self):
+        total = self.hits + self.misses
+        return 'feature cache: {} hits / {} lookups ({:.0%}), {} frames held'.format(
+            self.hits, total, self.hits / max(total, 1), len(self.entries))
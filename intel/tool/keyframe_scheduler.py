@@ -0,0 +1,166 @@
+import cv2
+import numpy as np
+
+# Decides on which frames SegTracker runs the expensive segment / detect stage
+# (SAM everything or GroundingDINO + SAM) to look for new objects. Every trigger
+# is cheap: a downsampled frame difference, a colour histogram distance, or the
+# softmax entropy of the AOT prediction of the previous frame.
+
+TRIGGERS = ('first', 'max_gap', 'frame_diff', 'histogram', 'entropy')
+
+
+class KeyframeScheduler():
+    def __init__(self,
+                 min_gap=1,
+                 max_gap=None,
+                 frame_diff_thresh=None,
+                 hist_thresh=None,
+                 entropy_thresh=None,
+                 entropy_rise=None,
+                 thumb_width=64,
+                 hist_bins=16):
+        '''
+        A frame becomes a keyframe when at least min_gap frames passed since the
+        last keyframe and one trigger fires, or when max_gap frames passed.
+        Triggers left at None are disabled, with only max_gap set this is the
+        fixed sam_gap cadence.
+        Arguments:
+            min_gap: minimal number of frames between two keyframes
+            max_gap: force a keyframe after this many frames, None never forces
+            frame_diff_thresh: mean absolute difference (0~1) between the gray
+                thumbnails of the frame and of the last keyframe
+            hist_thresh: Bhattacharyya distance (0~1) between the hue / saturation
+                histograms of the frame and of the last keyframe
+            entropy_thresh: mean normalized softmax entropy (0~1) of the tracker
+                prediction on the previous frame
+            entropy_rise: relative rise of that entropy over its value on the
+                first frame tracked after the last keyframe
+            thumb_width: width of the thumbnails the scene triggers work on
+            hist_bins: histogram bins per channel
+        '''
+        self.min_gap = max(int(min_gap), 1)
+        self.max_gap = max_gap
+        self.frame_diff_thresh = frame_diff_thresh
+        self.hist_thresh = hist_thresh
+        self.entropy_thresh = entropy_thresh
+        self.entropy_rise = entropy_rise
+        self.thumb_width = thumb_width
+        self.hist_bins = hist_bins
+
+        self.last_keyframe = None
+        self.key_thumb = None
+        self.key_hist = None
+        self.entropy = None
+        self.base_entropy = None
+        self.counts = dict.fromkeys(TRIGGERS, 0)
+
+    @property
+    def needs_entropy(self):
+        return self.entropy_thresh is not None or self.entropy_rise is not None
+
+    def reset(self):
+        self.last_keyframe = None
+        self.key_thumb = None
+        self.key_hist = None
+        self.entropy = None
+        self.base_entropy = None
+
+    def observe_entropy(self, entropy):
+        '''
+        Report the tracker entropy of the frame just tracked, it is used to
+        decide on the next frame.
+        '''
+        self.entropy = entropy
+        if self.base_entropy is None:
+            self.base_entropy = entropy
+
+    def is_keyframe(self, frame_idx, frame):
+        '''
+        Call once per frame, before tracking it.
+        Arguments:
+            frame: numpy array (h,w,3), RGB
+        Return:
+            keyframe: bool, run the segment / detect stage on this frame
+        '''
+        trigger = self._trigger(frame_idx, frame)
+        if trigger is None:
+            return False
+        self.counts[trigger] += 1
+        self.last_keyframe = frame_idx
+        self.entropy = None
+        self.base_entropy = None
+        if self.frame_diff_thresh is not None:
+            self.key_thumb = self._thumbnail(frame)
+        if self.hist_thresh is not None:
+            self.key_hist = self._histogram(frame)
+        return True
+
+    def _trigger(self, frame_idx, frame):
+        if self.last_keyframe is None:
+            return 'first'
+        gap = frame_idx - self.last_keyframe
+        if gap < self.min_gap:
+            return None
+        if self.max_gap is not None and gap >= self.max_gap:
+            return 'max_gap'
+
+        if self.entropy is not None:
+            if self.entropy_thresh is not None and self.entropy > self.entropy_thresh:
+                return 'entropy'
+            if self.entropy_rise is not None and self.base_entropy is not None \
+                    and self.entropy > self.base_entropy * (1 + self.entropy_rise):
+                return 'entropy'
+        if self.frame_diff_thresh is not None:
+            diff = cv2.absdiff(self._thumbnail(frame), self.key_thumb)
+            if diff.mean() / 255. > self.frame_diff_thresh:
+                return 'frame_diff'
+        if self.hist_thresh is not None:
+            dist = cv2.compareHist(self._histogram(frame), self.key_hist, cv2.HISTCMP_BHATTACHARYYA)
+            if dist > self.hist_thresh:
+                return 'histogram'
+        return None
+
+    def _resize(self, frame):
+        h, w = frame.shape[:2]
+        thumb_h = max(int(round(h * self.thumb_width / w)), 1)
+        return cv2.resize(frame, (self.thumb_width, thumb_h), interpolation=cv2.INTER_AREA)
+
+    def _thumbnail(self, frame):
+        return cv2.cvtColor(self._resize(frame), cv2.COLOR_RGB2GRAY)
+
+    def _histogram(self, frame):
+        hsv = cv2.cvtColor(self._resize(frame), cv2.COLOR_RGB2HSV)
+        hist = cv2.calcHist([hsv], [0, 1], None, [self.hist_bins, self.hist_bins], [0, 180, 0, 256])
+        return cv2.normalize(hist, hist).astype(np.float32)
+
+    def summary(self):
+        fired = ', '.join(f'{name} {count}' for name, count in self.counts.items() if count > 0)
+        return 'keyframes: {} ({})'.format(sum(self.counts.values()), fired)
+
+
+def build_keyframe_scheduler(sam_gap, args=None):
+    '''
+    Arguments:
+        sam_gap: the fixed interval, used when no policy is configured
+        args: dict, 'policy' is one of
+            'fixed': a keyframe every sam_gap frames (previous behavior)
+            'frame_diff', 'histogram', 'entropy': the corresponding trigger,
+                bounded by min_gap / max_gap
+        the other entries are passed to KeyframeScheduler
+    '''
+    args = dict(args) if args is not None else {}
+    policy = args.pop('policy', 'fixed')
+    if policy == 'fixed':
+        return KeyframeScheduler(min_gap=sam_gap, max_gap=sam_gap)
+
+    args.setdefault('min_gap', max(sam_gap // 4, 1))
+    args.setdefault('max_gap', sam_gap * 4)
+    if policy == 'frame_diff':
+        args.setdefault('frame_diff_thresh', 0.08)
+    elif policy == 'histogram':
+        args.setdefault('hist_thresh', 0.25)
+    elif policy == 'entropy':
+        args.setdefault('entropy_rise', 0.5)
+    else:
+        raise NotImplementedError
+    return KeyframeScheduler(**args)
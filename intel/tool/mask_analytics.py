@@ -0,0 +1,152 @@
+import time
+from functools import lru_cache
+import numpy as np
+
+# Per-label statistics of (h, w) integer label maps. Every function here makes
+# a constant number of passes over the frame, independent of the number of
+# objects, instead of one `mask == id` scan per object.
+
+
+@lru_cache(maxsize=4)
+def _pixel_coords(h, w):
+    # flattened row / column index of every pixel, shared by all frames of a video
+    rows, cols = np.indices((h, w), dtype=np.int64)
+    return rows.ravel(), cols.ravel()
+
+
+def label_areas(mask, minlength=0):
+    '''
+    Arguments:
+        mask: numpy array (h,w), non-negative integer labels
+    Return:
+        areas: numpy array (max(mask)+1,), pixel count of every label
+    '''
+    return np.bincount(mask.ravel(), minlength=minlength)
+
+
+def label_stats(mask, ignore_background=True):
+    '''
+    Area, centroid, bbox and first-seen pixel (raster order) of every label.
+    Arguments:
+        mask: numpy array (h,w), non-negative integer labels
+        ignore_background: drop label 0 from the result
+    Return:
+        dict of numpy arrays, row i describes label ids[i]:
+            ids: (k,) sorted labels present in the mask
+            area: (k,) pixel count
+            centroid: (k,2) mean (x, y)
+            bbox: (k,4) inclusive [x0, y0, x1, y1]
+            first_pixel: (k,2) (x, y) of the first pixel in raster order
+    '''
+    h, w = mask.shape
+    labels = mask.ravel().astype(np.int64)
+    rows, cols = _pixel_coords(h, w)
+    num_labels = int(labels.max()) + 1 if labels.size > 0 else 1
+
+    # joint (label, row) and (label, column) histograms, two bincounts over
+    # the frame give area, coordinate sums and bbox extents for every label
+    row_counts = np.bincount(labels * h + rows, minlength=num_labels * h).reshape(num_labels, h)
+    col_counts = np.bincount(labels * w + cols, minlength=num_labels * w).reshape(num_labels, w)
+
+    area = row_counts.sum(axis=1)
+    ids = np.flatnonzero(area)
+    if ignore_background:
+        ids = ids[ids != 0]
+    area = area[ids]
+    row_counts = row_counts[ids]
+    col_counts = col_counts[ids]
+    row_sums = row_counts @ np.arange(h)
+    col_sums = col_counts @ np.arange(w)
+
+    row_hit = row_counts > 0
+    col_hit = col_counts > 0
+    y0 = np.argmax(row_hit, axis=1)
+    y1 = h - 1 - np.argmax(row_hit[:, ::-1], axis=1)
+    x0 = np.argmax(col_hit, axis=1)
+    x1 = w - 1 - np.argmax(col_hit[:, ::-1], axis=1)
+
+    # the first pixel lies on the top row of the bbox
+    first_x = np.argmax(mask[y0] == ids[:, None], axis=1)
+
+    return {
+        'ids': ids,
+        'area': area,
+        'centroid': np.stack([col_sums / np.maximum(area, 1), row_sums / np.maximum(area, 1)], axis=1),
+        'bbox': np.stack([x0, y0, x1, y1], axis=1),
+        'first_pixel': np.stack([first_x, y0], axis=1),
+    }
+
+
+def relabel(mask, keep_ids, start_id=1):
+    '''
+    Map keep_ids to consecutive ids starting from start_id, every other label to 0.
+    Arguments:
+        mask: numpy array (h,w), uint8 labels
+        keep_ids: labels to keep, in the order the new ids are assigned
+    Return:
+        relabeled mask, same dtype as mask
+    '''
+    lut = np.zeros(max(int(mask.max()), int(np.max(keep_ids, initial=0))) + 1, dtype=mask.dtype)
+    lut[np.asarray(keep_ids, dtype=np.int64)] = np.arange(start_id, start_id + len(keep_ids))
+    return lut[mask]
+
+
+def label_boundaries(mask):
+    '''
+    Pixels that touch (4-connectivity) a foreground pixel with a different label,
+    i.e. the outline of every object, including outlines between adjacent objects.
+    Arguments:
+        mask: numpy array (h,w)
+    Return:
+        boundary: bool numpy array (h,w)
+    '''
+    boundary = np.zeros(mask.shape, dtype=bool)
+    # vertical neighbours
+    diff = mask[1:] != mask[:-1]
+    boundary[:-1] |= diff & (mask[1:] != 0)
+    boundary[1:] |= diff & (mask[:-1] != 0)
+    # horizontal neighbours
+    diff = mask[:, 1:] != mask[:, :-1]
+    boundary[:, :-1] |= diff & (mask[:, 1:] != 0)
+    boundary[:, 1:] |= diff & (mask[:, :-1] != 0)
+    return boundary
+
+
+def _legacy_label_stats(mask):
+    # the per-id pattern this module replaces, kept for the benchmark below
+    stats = {}
+    for value in np.unique(mask):
+        if value == 0:
+            continue
+        indices = np.argwhere(mask == value)
+        stats[value] = (len(indices), indices.mean(axis=0), indices.min(axis=0), indices.max(axis=0))
+    return stats
+
+
+def _random_label_map(h, w, num_objs, rng):
+    mask = np.zeros((h, w), dtype=np.uint8)
+    for obj_id in range(1, num_objs + 1):
+        y, x = rng.integers(0, h - 64), rng.integers(0, w - 64)
+        bh, bw = rng.integers(16, 64, size=2)
+        mask[y:y + bh, x:x + bw] = obj_id
+    return mask
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    repeats = 10
+    for num_objs in [1, 32, 255]:
+        mask = _random_label_map(1080, 1920, num_objs, rng)
+        label_stats(mask)  # warm up the coordinate cache
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            label_stats(mask)
+        fast = (time.perf_counter() - start) / repeats * 1000
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            _legacy_label_stats(mask)
+        legacy = (time.perf_counter() - start) / repeats * 1000
+
+        print(f'K={num_objs:3d} 1080p: label_stats {fast:7.2f} ms/frame, per-id loop {legacy:8.2f} ms/frame')
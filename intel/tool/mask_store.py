@@ -0,0 +1,210 @@
+import os
+import json
+import zlib
+import struct
+import bisect
+import numpy as np
+
+# Append-only, chunked container for per-frame label masks.
+#
+# Layout of a store file:
+#     [block 0][block 1]...[block n][json index][u64 index offset][MAGIC]
+#
+# Every block holds up to `chunk_size` consecutive (h, w) masks, stored raw,
+# zlib-compressed or run-length encoded. The json index records the frame
+# shape / dtype and the byte offset of every block, so readers can jump to
+# any frame without touching the rest of the file.
+
+MAGIC = b'OWMASK01'
+_FOOTER = struct.Struct('<Q')
+COMPRESSIONS = ('none', 'zlib', 'rle')
+
+
+def rle_encode(data):
+    '''
+    Run-length encode a flat uint8 array.
+    Return:
+        bytes: uint32 run count, uint8 values, uint32 run lengths
+    '''
+    data = data.ravel()
+    if data.size == 0:
+        return struct.pack('<I', 0)
+    starts = np.flatnonzero(np.diff(data)) + 1
+    starts = np.concatenate([[0], starts])
+    lengths = np.diff(np.concatenate([starts, [data.size]])).astype('<u4')
+    values = data[starts].astype(np.uint8)
+    return struct.pack('<I', len(starts)) + values.tobytes() + lengths.tobytes()
+
+
+def rle_decode(buf):
+    num_runs, = struct.unpack_from('<I', buf, 0)
+    values = np.frombuffer(buf, dtype=np.uint8, count=num_runs, offset=4)
+    lengths = np.frombuffer(buf, dtype='<u4', count=num_runs, offset=4 + num_runs)
+    return np.repeat(values, lengths)
+
+
+class MaskStoreWriter():
+    def __init__(self, path, chunk_size=64, compression='zlib', level=1):
+        '''
+        Arguments:
+            path: output file
+            chunk_size: number of frames per block, bounds the writer memory
+            compression: 'none', 'zlib' or 'rle'
+            level: zlib compression level
+        '''
+        assert compression in COMPRESSIONS, f'unknown compression {compression}'
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.level = level
+        self.shape = None
+        self.dtype = None
+        self.num_frames = 0
+        self.blocks = []
+        self.pending = []
+        self.file = open(path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.num_frames
+
+    def append(self, mask):
+        '''
+        Arguments:
+            mask: numpy array (h,w), every frame must share shape and dtype
+        '''
+        mask = np.ascontiguousarray(mask)
+        if self.shape is None:
+            self.shape = mask.shape
+            self.dtype = mask.dtype
+        elif mask.shape != self.shape or mask.dtype != self.dtype:
+            raise ValueError(f'mask {mask.shape}/{mask.dtype} does not match store {self.shape}/{self.dtype}')
+        self.pending.append(mask)
+        self.num_frames += 1
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        block = np.stack(self.pending)
+        if self.compression == 'zlib':
+            payload = zlib.compress(block.tobytes(), self.level)
+        elif self.compression == 'rle':
+            payload = rle_encode(block.view(np.uint8))
+        else:
+            payload = block.tobytes()
+        self.blocks.append({
+            'offset': self.file.tell(),
+            'nbytes': len(payload),
+            'first_frame': self.num_frames - len(self.pending),
+            'num_frames': len(self.pending),
+        })
+        self.file.write(payload)
+        self.pending = []
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        index = {
+            'shape': list(self.shape) if self.shape is not None else None,
+            'dtype': self.dtype.str if self.dtype is not None else None,
+            'num_frames': self.num_frames,
+            'chunk_size': self.chunk_size,
+            'compression': self.compression,
+            'blocks': self.blocks,
+        }
+        index_offset = self.file.tell()
+        self.file.write(json.dumps(index).encode('utf-8'))
+        self.file.write(_FOOTER.pack(index_offset))
+        self.file.write(MAGIC)
+        self.file.close()
+
+
+class MaskStoreReader():
+    def __init__(self, path):
+        '''
+        Random access to a store written by MaskStoreWriter. Raw blocks are
+        memory-mapped, compressed blocks are decoded on demand and the last
+        decoded block is kept for sequential reads.
+        '''
+        self.path = path
+        self.file = open(path, 'rb')
+        self.file.seek(-(_FOOTER.size + len(MAGIC)), os.SEEK_END)
+        footer = self.file.read(_FOOTER.size + len(MAGIC))
+        if footer[_FOOTER.size:] != MAGIC:
+            raise ValueError(f'{path} is not a mask store or was not closed')
+        index_offset, = _FOOTER.unpack(footer[:_FOOTER.size])
+        end = self.file.tell() - len(footer)
+        self.file.seek(index_offset)
+        index = json.loads(self.file.read(end - index_offset).decode('utf-8'))
+
+        self.num_frames = index['num_frames']
+        self.shape = tuple(index['shape']) if index['shape'] is not None else None
+        self.dtype = np.dtype(index['dtype']) if index['dtype'] is not None else None
+        self.compression = index['compression']
+        self.blocks = index['blocks']
+        self.block_starts = [block['first_frame'] for block in self.blocks]
+
+        self.mmap = None
+        if self.compression == 'none' and self.num_frames > 0:
+            self.mmap = np.memmap(path, dtype=np.uint8, mode='r', shape=(index_offset,))
+        self.cached_block_idx = None
+        self.cached_block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.num_frames
+
+    def __iter__(self):
+        for frame_idx in range(self.num_frames):
+            yield self[frame_idx]
+
+    def __getitem__(self, frame_idx):
+        '''
+        Return:
+            mask: numpy array (h,w), read-only
+        '''
+        if frame_idx < 0:
+            frame_idx += self.num_frames
+        if frame_idx < 0 or frame_idx >= self.num_frames:
+            raise IndexError(f'frame {frame_idx} out of range for {self.num_frames} frames')
+        block_idx = bisect.bisect_right(self.block_starts, frame_idx) - 1
+        block = self.read_block(block_idx)
+        return block[frame_idx - self.blocks[block_idx]['first_frame']]
+
+    def read_block(self, block_idx):
+        meta = self.blocks[block_idx]
+        shape = (meta['num_frames'],) + self.shape
+        if self.mmap is not None:
+            raw = self.mmap[meta['offset']:meta['offset'] + meta['nbytes']]
+            return raw.view(self.dtype).reshape(shape)
+
+        if self.cached_block_idx == block_idx:
+            return self.cached_block
+        self.file.seek(meta['offset'])
+        payload = self.file.read(meta['nbytes'])
+        if self.compression == 'zlib':
+            data = np.frombuffer(zlib.decompress(payload), dtype=self.dtype)
+        else:
+            data = rle_decode(payload).view(self.dtype)
+        block = data.reshape(shape)
+        self.cached_block_idx = block_idx
+        self.cached_block = block
+        return block
+
+    def close(self):
+        self.mmap = None
+        self.cached_block = None
+        self.file.close()
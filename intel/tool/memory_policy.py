@@ -0,0 +1,142 @@
+import gc
+import time
+from collections import deque
+import torch
+
+
+class MemoryPolicy():
+    def __init__(self,
+                 cuda_high_water_mb=None,
+                 cuda_high_water_ratio=0.9,
+                 release_on_keyframe=True,
+                 gc_every=0,
+                 legacy=False,
+                 record_stats=True,
+                 history_len=1000,
+                 device=None):
+        '''
+        Decides when a SegTracker run gives cached memory back, instead of
+        calling torch.cuda.empty_cache() and gc.collect() on every frame.
+        Arguments:
+            cuda_high_water_mb: release the CUDA caching allocator once reserved
+                memory exceeds this many MB
+            cuda_high_water_ratio: used when cuda_high_water_mb is None, fraction
+                of the device memory
+            release_on_keyframe: release (and collect) right after SAM keyframes,
+                which allocate the largest transient buffers
+            gc_every: also run gc.collect() every n frames, 0 disables it
+            legacy: release and collect after every frame (previous behavior),
+                kept to compare frames/s
+            record_stats: keep per-frame allocator statistics in self.history
+            history_len: number of recent frames kept in self.history, the
+                frame count and peak in summary() cover the whole run
+            device: device the run uses (SegTracker.device), CUDA work only
+                happens on a CUDA device, defaults to the current CUDA device
+                when available
+        '''
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.release_on_keyframe = release_on_keyframe
+        self.gc_every = gc_every
+        self.legacy = legacy
+        self.record_stats = record_stats
+
+        self.cuda_high_water = None
+        if self.cuda:
+            if cuda_high_water_mb is not None:
+                self.cuda_high_water = cuda_high_water_mb * 1024**2
+            else:
+                total = torch.cuda.get_device_properties(self.device).total_memory
+                self.cuda_high_water = int(total * cuda_high_water_ratio)
+
+        self.history = deque(maxlen=history_len)
+        self.num_frames = 0
+        self.peak_reserved = 0
+        self.num_releases = 0
+        self.num_collects = 0
+
+    def release(self, collect=True):
+        # unconditional release, e.g. before / after a whole run
+        if collect:
+            gc.collect()
+            self.num_collects += 1
+        if self.cuda:
+            self._empty_cache()
+        self.num_releases += 1
+
+    def step(self, frame_idx, keyframe=False):
+        '''
+        Call once per processed frame.
+        Return:
+            stats: dict of allocator statistics for this frame
+        '''
+        released = collected = False
+        reserved = self._reserved()
+        if self.legacy or (keyframe and self.release_on_keyframe):
+            released = collected = True
+        elif self.cuda_high_water is not None and reserved > self.cuda_high_water:
+            released = True
+        if self.gc_every > 0 and frame_idx % self.gc_every == 0:
+            collected = True
+
+        if collected:
+            gc.collect()
+            self.num_collects += 1
+        if released:
+            if self.cuda:
+                self._empty_cache()
+            self.num_releases += 1
+
+        stats = self.frame_stats(frame_idx)
+        stats['reserved_before'] = reserved
+        stats['released'] = released
+        stats['collected'] = collected
+        self.num_frames += 1
+        self.peak_reserved = max(self.peak_reserved, reserved)
+        if self.record_stats:
+            self.history.append(stats)
+        return stats
+
+    def frame_stats(self, frame_idx=None):
+        stats = {'frame_idx': frame_idx, 'allocated': 0, 'reserved': 0, 'max_allocated': 0}
+        if self.cuda:
+            stats['allocated'] = torch.cuda.memory_allocated(self.device)
+            stats['reserved'] = torch.cuda.memory_reserved(self.device)
+            stats['max_allocated'] = torch.cuda.max_memory_allocated(self.device)
+        return stats
+
+    def summary(self):
+        return 'memory policy: {} frames, {} releases, {} gc collects, peak reserved {:.1f} MB'.format(
+            self.num_frames, self.num_releases, self.num_collects, self.peak_reserved / 1024**2)
+
+    def _empty_cache(self):
+        # empty_cache works on the current device
+        with torch.cuda.device(self.device):
+            torch.cuda.empty_cache()
+
+    def _reserved(self):
+        return torch.cuda.memory_reserved(self.device) if self.cuda else 0
+
+
+def _benchmark(policy, num_frames=60, sam_gap=10, size=(1, 3, 480, 854)):
+    # stand-in for a tracking loop: a few conv layers per frame, heavier on keyframes
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    conv = torch.nn.Conv2d(3, 32, 3, padding=1).to(device)
+    frame = torch.randn(size, device=device)
+    start = time.perf_counter()
+    with torch.no_grad():
+        for frame_idx in range(num_frames):
+            keyframe = frame_idx % sam_gap == 0
+            for _ in range(4 if keyframe else 1):
+                conv(frame).relu().sum().item()
+            policy.step(frame_idx, keyframe=keyframe)
+    return num_frames / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    for name, kwargs in [('legacy', {'legacy': True}), ('policy', {})]:
+        policy = MemoryPolicy(**kwargs)
+        fps = _benchmark(policy)
+        print(f'{name:6s}: {fps:6.2f} frames/s, {policy.summary()}')
@@ -0,0 +1,216 @@
+import numpy as np
+import torch
+from sam.segment_anything import SamPredictor
+
+# SAM prompt decoding with onnxruntime on CPU. The model is exported with
+# sam/scripts/export_onnx_model.py (--batched-prompts for several boxes or
+# clicks in one run, --encoder-output for the optional image encoder). The
+# image embedding is bound once per frame with IO binding, every prompt of
+# that frame only binds its few small inputs.
+
+
+class OnnxSamPredictor(SamPredictor):
+    def __init__(self, sam_model, decoder_path, encoder_path=None, num_threads=0):
+        '''
+        Drop-in SamPredictor, set_image / predict / predict_torch run the
+        exported models, the PyTorch sam_model is used for the image
+        transforms and as image encoder when no encoder_path is given.
+        Arguments:
+            sam_model: Sam, the model the ONNX files were exported from
+            decoder_path: ONNX prompt encoder + mask decoder, exported
+                without --return-single-mask and --return-extra-metrics
+            encoder_path: optional ONNX image encoder
+            num_threads: onnxruntime intra-op threads, 0 lets onnxruntime
+                choose
+        '''
+        import onnxruntime  # type: ignore
+        super().__init__(sam_model)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider']
+        self.decoder = onnxruntime.InferenceSession(decoder_path, options, providers=providers)
+        self.encoder = onnxruntime.InferenceSession(
+            encoder_path, options, providers=providers) if encoder_path else None
+        self.binding = self.decoder.io_binding()
+        # the upscaled masks of the export are cropped to the padding of the
+        # traced example image, only the low resolution outputs are bound and
+        # the masks are upscaled as SamPredictor does
+        self.output_names = ['iou_predictions', 'low_res_masks']
+        self.ort_features = None
+        self.batched = isinstance(self.decoder.get_inputs()[1].shape[0], str)
+
+    @property
+    def device(self):
+        # prompts and outputs live on the CPU, where onnxruntime runs
+        return torch.device('cpu')
+
+    @torch.no_grad()
+    def set_torch_image(self, transformed_image, original_image_size):
+        if self.encoder is None:
+            super().set_torch_image(transformed_image.to(self.model.device), original_image_size)
+        else:
+            self.reset_image()
+            self.original_size = original_image_size
+            self.input_size = tuple(transformed_image.shape[-2:])
+            input_image = self.model.preprocess(transformed_image.to(self.model.device)).cpu().numpy()
+            features = self.encoder.run(None, {'input_image': input_image})[0]
+            self.features = torch.from_numpy(features)
+            self.is_image_set = True
+        self._bind_features()
+
+    def set_features(self, features, original_image_size):
+        super().set_features(features, original_image_size)
+        self._bind_features()
+
+    def reset_image(self):
+        super().reset_image()
+        self.ort_features = None
+
+    def _bind_features(self):
+        # one copy of the embedding per frame, it stays bound for all prompts
+        import onnxruntime  # type: ignore
+        features = np.ascontiguousarray(self.features.detach().cpu().numpy(), dtype=np.float32)
+        self.ort_features = onnxruntime.OrtValue.ortvalue_from_numpy(features)
+        self.binding.bind_ortvalue_input('image_embeddings', self.ort_features)
+
+    def _prompt_inputs(self, point_coords, point_labels, boxes, mask_input):
+        '''
+        Arguments:
+            point_coords: tensor (B, N, 2) or None, in the transformed frame
+            point_labels: tensor (B, N) or None
+            boxes: tensor (B, 4) or None, in the transformed frame
+            mask_input: tensor (B, 1, 256, 256) or None
+        Return:
+            dict of the decoder inputs besides image_embeddings, the box
+            corners are points labeled 2 and 3, points without a box get a
+            padding point labeled -1 and a mask alone no point, as in the
+            PyTorch prompt encoder
+        '''
+        coords, labels = [], []
+        if point_coords is not None:
+            coords.append(point_coords.detach().cpu().numpy().astype(np.float32))
+            labels.append(point_labels.detach().cpu().numpy().astype(np.float32))
+        if boxes is not None:
+            boxes = boxes.detach().cpu().numpy().astype(np.float32)
+            coords.append(boxes.reshape(-1, 2, 2))
+            labels.append(np.tile(np.array([[2, 3]], dtype=np.float32), (len(boxes), 1)))
+        elif point_coords is not None:
+            batch = len(coords[0])
+            coords.append(np.zeros((batch, 1, 2), dtype=np.float32))
+            labels.append(-np.ones((batch, 1), dtype=np.float32))
+        elif mask_input is not None:
+            # mask only prompt, no sparse tokens as in the PyTorch prompt encoder
+            coords.append(np.zeros((len(mask_input), 0, 2), dtype=np.float32))
+            labels.append(np.zeros((len(mask_input), 0), dtype=np.float32))
+        else:
+            raise ValueError('SAM needs a point, box or mask prompt.')
+        coords = np.concatenate(coords, axis=1)
+        labels = np.concatenate(labels, axis=1)
+        mask_size = [4 * x for x in self.model.prompt_encoder.image_embedding_size]
+        if mask_input is not None:
+            mask_input = mask_input.detach().cpu().numpy().astype(np.float32)
+            has_mask_input = np.ones(1, dtype=np.float32)
+        else:
+            mask_input = np.zeros((len(coords), 1, *mask_size), dtype=np.float32)
+            has_mask_input = np.zeros(1, dtype=np.float32)
+        return {
+            'point_coords': np.ascontiguousarray(coords),
+            'point_labels': np.ascontiguousarray(labels),
+            'mask_input': np.ascontiguousarray(mask_input),
+            'has_mask_input': has_mask_input,
+            'orig_im_size': np.array(self.original_size, dtype=np.float32),
+        }
+
+    def _run(self, inputs):
+        for name, value in inputs.items():
+            self.binding.bind_cpu_input(name, value)
+        for name in self.output_names:
+            self.binding.bind_output(name, 'cpu')
+        self.decoder.run_with_iobinding(self.binding)
+        return [torch.from_numpy(output) for output in self.binding.copy_outputs_to_cpu()]
+
+    @torch.no_grad()
+    def predict_torch(self, point_coords, point_labels, boxes=None, mask_input=None,
+                      multimask_output=True, return_logits=False):
+        '''
+        See SamPredictor.predict_torch, the outputs are CPU tensors.
+        '''
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        inputs = self._prompt_inputs(point_coords, point_labels, boxes, mask_input)
+        if self.batched or len(inputs['point_coords']) == 1:
+            outputs = self._run(inputs)
+        else:
+            # the decoder was exported for a single prompt
+            prompts = [{name: value[idx:idx + 1] if name in ('point_coords', 'point_labels', 'mask_input')
+                        else value for name, value in inputs.items()}
+                       for idx in range(len(inputs['point_coords']))]
+            outputs = [torch.cat(output) for output in zip(*[self._run(prompt) for prompt in prompts])]
+        iou_predictions, low_res_masks = outputs
+
+        # the decoder returns every mask token, select as MaskDecoder.forward
+        mask_slice = slice(1, None) if multimask_output else slice(0, 1)
+        iou_predictions = iou_predictions[:, mask_slice]
+        low_res_masks = low_res_masks[:, mask_slice]
+        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+        return masks, iou_predictions, low_res_masks
+
+
+def _benchmark(model_type, checkpoint, decoder_path, encoder_path=None, num_boxes=16, repeats=10):
+    # parity and latency of onnxruntime against the PyTorch predictor on CPU,
+    # run from intel/:
+    # python -m tool.onnx_predictor vit_b ckpt/sam_vit_b_01ec64.pth sam_decoder.onnx [sam_encoder.onnx]
+    import time
+    from sam.segment_anything import sam_model_registry
+    num_boxes, repeats = int(num_boxes), int(repeats)
+    sam = sam_model_registry[model_type](checkpoint=checkpoint).eval()
+    torch_predictor = SamPredictor(sam)
+    onnx_predictor = OnnxSamPredictor(sam, decoder_path, encoder_path)
+    rng = np.random.default_rng(0)
+    image = (rng.random((480, 640, 3)) * 255).astype(np.uint8)
+
+    def timed(fn):
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            out = fn()
+            latencies.append(time.perf_counter() - start)
+        return out, np.median(latencies) * 1000
+
+    with torch.no_grad():
+        _, torch_ms = timed(lambda: torch_predictor.set_image(image))
+        _, onnx_ms = timed(lambda: onnx_predictor.set_image(image))
+        print(f'set_image        torch {torch_ms:8.2f} ms  onnx {onnx_ms:8.2f} ms  embedding difference '
+              f'{(onnx_predictor.features.cpu() - torch_predictor.features.cpu()).abs().max().item():.2e}')
+        if encoder_path:
+            # decode from the same embedding, only the decoder is compared below
+            onnx_predictor.set_features(torch_predictor.features, torch_predictor.original_size)
+
+        corners = np.sort(rng.random((num_boxes, 2, 2)) * [[640, 480]], axis=1)
+        boxes = torch.as_tensor(corners.reshape(-1, 4), dtype=torch.float)
+        clicks = rng.random((num_boxes, 2)) * [640, 480]
+        low_res = torch_predictor.predict(clicks[:1], np.ones(1))[2][None, :1]
+        cases = {
+            'click': lambda p: p.predict(clicks[:2], np.array([1, 0]), return_logits=True),
+            'box': lambda p: p.predict(box=corners[0].reshape(-1), return_logits=True),
+            'click + mask': lambda p: p.predict(clicks[:1], np.ones(1), mask_input=low_res[0],
+                                                multimask_output=False, return_logits=True),
+            f'{num_boxes} boxes': lambda p: p.predict_torch(
+                None, None, p.transform.apply_boxes_torch(boxes, p.original_size).to(p.device),
+                return_logits=True),
+        }
+        for name, case in cases.items():
+            (torch_masks, torch_scores, _), torch_ms = timed(lambda: case(torch_predictor))
+            (onnx_masks, onnx_scores, _), onnx_ms = timed(lambda: case(onnx_predictor))
+            torch_masks, onnx_masks = torch.as_tensor(torch_masks).cpu(), torch.as_tensor(onnx_masks).cpu()
+            agreement = ((torch_masks > 0) == (onnx_masks > 0)).float().mean().item()
+            print(f'{name:16} torch {torch_ms:8.2f} ms  onnx {onnx_ms:8.2f} ms  '
+                  f'score difference {(torch.as_tensor(torch_scores).cpu() - torch.as_tensor(onnx_scores)).abs().max().item():.2e}  '
+                  f'mask agreement {agreement:.5f}')
+
+
+if __name__ == '__main__':
+    import sys
+    _benchmark(*sys.argv[1:])
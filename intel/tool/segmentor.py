@@ -2,6 +2,8 @@ import torch
 import cv2
 import numpy as np
 from sam.segment_anything import sam_model_registry, SamPredictor, SamAutomaticMaskGenerator
+from tool.device import resolve_device
+from tool.onnx_predictor import OnnxSamPredictor
 
 class Segmentor:
     def __init__(self, sam_args):
@@ -9,13 +11,19 @@ class Segmentor:
         sam_args:
             sam_checkpoint: path of SAM checkpoint
             generator_args: args for everything_generator
-            gpu_id: device
+            gpu_id: CUDA device
+            device: optional, 'auto' / 'cpu' / 'cuda', see tool.device.resolve_device
+            onnx: optional, {'decoder_path', 'encoder_path', 'num_threads'}, box and click
+                prompts run on onnxruntime, see tool.onnx_predictor.OnnxSamPredictor
         """
-        self.device = sam_args["gpu_id"]
+        self.device = resolve_device(sam_args.get("device"), sam_args["gpu_id"])
         self.sam = sam_model_registry[sam_args["model_type"]](checkpoint=sam_args["sam_checkpoint"])
         self.sam.to(device=self.device)
         self.everything_generator = SamAutomaticMaskGenerator(model=self.sam, **sam_args['generator_args'])
-        self.interactive_predictor = self.everything_generator.predictor
+        if sam_args.get("onnx"):
+            self.interactive_predictor = OnnxSamPredictor(self.sam, **sam_args["onnx"])
+        else:
+            self.interactive_predictor = self.everything_generator.predictor
         self.have_embedded = False
         
     @torch.no_grad()
@@ -25,6 +33,12 @@ class Segmentor:
             self.interactive_predictor.set_image(image)
             self.have_embedded = True
     @torch.no_grad()
+    def embed_image(self, image):
+        # (re)compute the embedding of a new frame, later set_image / reset_image=False calls reuse it
+        self.interactive_predictor.set_image(image)
+        self.have_embedded = True
+
+    @torch.no_grad()
     def interactive_predict(self, prompts, mode, multimask=True):
         assert self.have_embedded, 'image embedding for sam need be set before predict.'        
         
@@ -94,3 +108,51 @@ class Segmentor:
         mask = masks[np.argmax(scores)]
         
         return [mask]
+
+    @torch.no_grad()
+    def segment_with_boxes(self, origin_frame, bboxes, reset_image=False, batch_size=32):
+        '''
+        Batched segment_with_box: the frame is embedded once and all boxes go
+        through the mask decoder together, both for the first pass and for
+        the refinement pass.
+        Arguments:
+            bboxes: nd.array [N, 2, 2]: [[x0, y0], [x1, y1]]
+            batch_size: max number of boxes per decoder call
+        Return:
+            masks: bool torch tensor (N, h, w) on the device of the predictor
+        '''
+        if reset_image:
+            self.interactive_predictor.set_image(origin_frame)
+        else:
+            self.set_image(origin_frame)
+        predictor = self.interactive_predictor
+
+        boxes = torch.as_tensor(np.asarray(bboxes, dtype=np.float32).reshape(-1, 4), device=predictor.device)
+        boxes = predictor.transform.apply_boxes_torch(boxes, predictor.original_size)
+
+        masks = []
+        for start in range(0, len(boxes), batch_size):
+            box_batch = boxes[start:start + batch_size]
+            rows = torch.arange(len(box_batch), device=box_batch.device)
+
+            _, scores, logits = predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=box_batch,
+                multimask_output=True,
+            )
+            logit = logits[rows, scores.argmax(dim=1)][:, None, :, :]
+
+            mask_batch, scores, _ = predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=box_batch,
+                mask_input=logit,
+                multimask_output=True,
+            )
+            masks.append(mask_batch[rows, scores.argmax(dim=1)])
+
+        if len(masks) == 0:
+            h, w = predictor.original_size
+            return torch.zeros((0, h, w), dtype=torch.bool, device=predictor.device)
+        return torch.cat(masks, dim=0)
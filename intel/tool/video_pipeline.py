@@ -0,0 +1,174 @@
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+# Building blocks for running decode -> track -> encode as overlapping stages.
+# Decoding runs on a reader thread, encoding (PNG, overlay video, mask store)
+# runs on writer threads, and the tracking loop stays on the caller's thread.
+# Both sides are bounded queues, so a slow stage blocks its producer instead of
+# buffering the whole video. cv2 / PIL release the GIL while they work, which is
+# what lets the stages actually overlap.
+
+
+class StageStats():
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.
+        self.lock = threading.Lock()
+
+    def add(self, seconds, count=1):
+        with self.lock:
+            self.busy += seconds
+            self.count += count
+
+    def __str__(self):
+        fps = self.count / self.busy if self.busy > 0 else float('inf')
+        return f'{self.name}: {self.count} items, {self.busy:.2f}s busy, {fps:.2f} items/s'
+
+
+class PipelineStats():
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def stage(self, name):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats(name)
+            return self.stages[name]
+
+    def timed(self, name):
+        return _Timer(self.stage(name))
+
+    def report(self):
+        wall = time.perf_counter() - self.start
+        lines = [str(stage) for stage in self.stages.values()]
+        lines.append(f'wall: {wall:.2f}s')
+        return '\n'.join(lines)
+
+
+class _Timer():
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stage.add(time.perf_counter() - self.start)
+
+
+class FrameReader():
+    def __init__(self, video_path, prefetch=8, skip=0, to_rgb=True, stats=None):
+        '''
+        Decode a video on a background thread, at most `prefetch` frames ahead
+        of the consumer.
+        Arguments:
+            video_path: input video
+            prefetch: bound of the decoded frame queue
+            skip: number of leading frames to drop (resume)
+            to_rgb: convert frames from BGR to RGB on the reader thread
+        '''
+        self.cap = cv2.VideoCapture(video_path)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.num_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.skip = skip
+        self.to_rgb = to_rgb
+        self.stats = stats if stats is not None else PipelineStats()
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        stage = self.stats.stage('decode')
+        try:
+            for _ in range(self.skip):
+                self.cap.grab()
+            frame_idx = self.skip
+            while not self.stopped.is_set():
+                start = time.perf_counter()
+                ret, frame = self.cap.read()
+                if not ret:
+                    break
+                if self.to_rgb:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                stage.add(time.perf_counter() - start)
+                self._put((frame_idx, frame))
+                frame_idx += 1
+        except Exception as inst:
+            self.error = inst
+        finally:
+            self.cap.release()
+            self._put(None)
+
+    def _put(self, item):
+        # blocks while the queue is full (backpressure), gives up once stopped
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class FrameWriterPool():
+    def __init__(self, num_workers=2, max_pending=16, stats=None):
+        '''
+        Run encode jobs off the tracking thread.
+        Unordered jobs (e.g. PNG saves) go to a pool of `num_workers` threads,
+        ordered jobs (e.g. VideoWriter.write) go to a single thread and run in
+        submission order. submit() blocks once `max_pending` jobs are in flight.
+        '''
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.ordered_pool = ThreadPoolExecutor(max_workers=1)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.stats = stats if stats is not None else PipelineStats()
+        self.errors = []
+
+    def submit(self, stage_name, fn, *args, ordered=False):
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        self.slots.acquire()
+        stage = self.stats.stage(stage_name)
+        pool = self.ordered_pool if ordered else self.pool
+        future = pool.submit(self._run, stage, fn, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def _run(self, stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception as inst:
+            self.errors.append(inst)
+            raise
+        finally:
+            stage.add(time.perf_counter() - start)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.ordered_pool.shutdown(wait=True)
+        if len(self.errors) > 0:
+            raise self.errors[0]